@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+"""
+aggregate.py:
+Zero-copy aggregation of chunk files into period files
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import os
+import logging
+
+from .manifest import Manifest, STATUS_DONE
+from .grib_index import index_path, append_index, write_index
+
+
+# Split keys finer than the period of an aggregated file
+PERIOD_KEYS = {
+    "month": ["day", "time"],
+    "year": ["month", "day", "time"],
+}
+
+
+def copy_range(src_fd, dst_fd, offset, length, dst_offset):
+    """Copy length bytes at offset of src_fd to dst_offset of dst_fd inside
+    the kernel with copy_file_range, or sendfile on older systems. Data is
+    only buffered in python if neither is available."""
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < length:
+                n = os.copy_file_range(src_fd, dst_fd, length - copied,
+                                       offset + copied, dst_offset + copied)
+                if n == 0:
+                    break
+                copied += n
+            return copied
+        except OSError:
+            # e.g. EXDEV or filesystems without support
+            pass
+
+    os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+    if hasattr(os, "sendfile"):
+        try:
+            while copied < length:
+                n = os.sendfile(dst_fd, src_fd, offset + copied, length - copied)
+                if n == 0:
+                    break
+                copied += n
+            return copied
+        except OSError:
+            os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+
+    os.lseek(src_fd, offset + copied, os.SEEK_SET)
+    while copied < length:
+        block = os.read(src_fd, min(1 << 20, length - copied))
+        if not block:
+            break
+        os.write(dst_fd, block)
+        copied += len(block)
+    return copied
+
+
+class Aggregator(object):
+    """The :class:`Aggregator` class merges chunk files of a data collection
+    into files of a longer period, e.g. daily chunks into monthly files.
+
+    GRIB files are concatenations of messages, hence a chunk is appended to
+    its period file by the kernel (:func:`copy_range`) without decoding or
+    buffering the data. The period file drops the split keys finer than the
+    period from its name. The manifest records the byte range of every chunk
+    in its period file in the same transaction that commits the append, the
+    chunk file is removed afterwards. Bytes of an append, which was not
+    committed due to a crash, are truncated before the next append. A chunk,
+    which is downloaded again, replaces its old range with an atomic rewrite
+    of the period file.
+
+    """
+
+    def __init__(self, storage_path, cds_product, split_keys, period="month",
+                 file_format="grib", manifest=None):
+        """
+        Parameters
+        ----------
+        storage_path : string
+            storage path of the data collection
+        cds_product : string
+            the cds product string
+        split_keys : list of strings
+            split keys of the data collection
+        period : string, optional
+            'month' or 'year'
+        file_format : string, optional
+            format of the data collection, only grib files can be aggregated
+        manifest : cds_downloader.manifest.Manifest, optional
+            manifest of the storage path
+        """
+        if period not in PERIOD_KEYS:
+            raise ValueError("The parameter period has to be one of {}".format(sorted(PERIOD_KEYS)))
+        if file_format != "grib":
+            raise ValueError("Only grib files can be aggregated")
+        self.keep = [i for i, k in enumerate(split_keys) if k not in PERIOD_KEYS[period]]
+        if len(self.keep) == len(split_keys):
+            raise ValueError("None of the split keys {} is finer than a {}".format(split_keys, period))
+
+        self.storage_path = str(storage_path)
+        self.cds_product = cds_product
+        self.split_keys = list(split_keys)
+        self.period = period
+        self.file_format = file_format
+        self.manifest = manifest or Manifest(storage_path)
+
+
+    def target_name(self, split_values):
+        """File name of the period file of a chunk"""
+        return '_'.join([split_values[i] for i in self.keep] or ["all"]) + \
+            "_" + self.cds_product + "." + self.file_format
+
+
+    def add(self, file_name, split_values):
+        """Append a finished chunk to its period file
+
+        Parameters
+        ----------
+        file_name : string
+            path of the chunk file
+        split_values : list of strings
+            labels of the split key values of the chunk
+
+        Returns
+        -------
+        target : string
+            path of the period file
+        """
+        chunk = os.path.basename(file_name)
+        target = self.target_name(split_values)
+        path_target = os.path.join(self.storage_path, target)
+        members = [(f, o, l) for f, t, o, l in self.manifest.members(target)]
+
+        if any(f == chunk for f, o, l in members):
+            # A chunk downloaded again replaces its old range
+            members = self._rewrite(path_target, [m for m in members if m[0] != chunk])
+        else:
+            self._recover(path_target, members)
+
+        offset = sum(l for f, o, l in members)
+        length = os.path.getsize(file_name)
+        src_fd = os.open(file_name, os.O_RDONLY)
+        dst_fd = os.open(path_target, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if copy_range(src_fd, dst_fd, 0, length, offset) != length:
+                raise OSError("Aggregation of {} into {} is incomplete".format(file_name, path_target))
+            os.fsync(dst_fd)
+        finally:
+            os.close(src_fd)
+            os.close(dst_fd)
+
+        self.manifest.set_members(target, members + [(chunk, offset, length)])
+        append_index(path_target, file_name, offset)
+        for path in (file_name, index_path(file_name)):
+            if os.path.exists(path):
+                os.remove(path)
+        logging.info('Aggregated {} into {} at byte {}'.format(chunk, target, offset))
+        return path_target
+
+
+    def add_pending(self):
+        """Aggregate all finished chunk files of the collection, which are not
+        part of a period file yet, e.g. of a collection downloaded before
+
+        Returns
+        -------
+        targets : set of strings
+            paths of the updated period files
+        """
+        merged = {m[0] for m in self.manifest.members()}
+        targets = set()
+        for entry in self.manifest.entries(STATUS_DONE):
+            if entry["product"] != self.cds_product or entry["split_keys"] != self.split_keys:
+                continue
+            path = os.path.join(self.storage_path, entry["file_name"])
+            if entry["file_name"] in merged or not os.path.exists(path):
+                continue
+            targets.add(self.add(path, entry["split_values"]))
+        return targets
+
+
+    def _recover(self, path_target, members):
+        # Drop bytes of an append, which was not committed to the manifest
+        size = sum(l for f, o, l in members)
+        if os.path.exists(path_target) and os.path.getsize(path_target) > size:
+            logging.warning('Truncate uncommitted data of {} at byte {}'.format(path_target, size))
+            os.truncate(path_target, size)
+
+
+    def _rewrite(self, path_target, members):
+        # Copy the remaining ranges into a new file and replace the period file atomically
+        path_temp = path_target + ".partial"
+        rewritten, offset = [], 0
+        src_fd = os.open(path_target, os.O_RDONLY)
+        dst_fd = os.open(path_temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            for file_name, start, length in members:
+                copy_range(src_fd, dst_fd, start, length, offset)
+                rewritten.append((file_name, offset, length))
+                offset += length
+            os.fsync(dst_fd)
+        finally:
+            os.close(src_fd)
+            os.close(dst_fd)
+
+        os.replace(path_temp, path_target)
+        self.manifest.set_members(os.path.basename(path_target), rewritten)
+        write_index(path_target)
+        return rewritten
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+
+"""
+batch.py:
+Batch mode of many configurations with one global scheduler
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import os
+import json
+import glob
+import logging
+
+from .cds_downloader import Downloader
+from .coalesce import Coalescer, UnionRequest, COALESCE_MODES
+from .scheduler import Scheduler
+from .session import create_session
+from .metadata import MetadataCache
+from .metrics import Metrics
+
+
+BATCH_MODES = ["download", "update", "daily"]
+
+# Keys of a configuration file, which configure the batch job instead of the Downloader
+JOB_KEYS = ["storage_path", "mode", "split_keys", "date_latency", "start_from_files", "priority", "urgency",
+            "days"]
+
+
+def config_paths(paths):
+    """Configuration files of a list of files and directories, directories
+    contribute their json files in alphabetical order"""
+    config_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            config_files.extend(sorted(glob.glob(os.path.join(path, "*.json"))))
+        else:
+            config_files.append(path)
+    return config_files
+
+
+def _retrieve(downloader, *args):
+    return downloader._retrieve_chunk(*args)
+
+
+class BatchJob(object):
+    """A configuration of a batch with its storage path and operational mode"""
+
+    def __init__(self, name, downloader, storage_path, mode="download", split_keys=None, priority=None,
+                 urgency=0, **kwargs):
+        """
+        Parameters
+        ----------
+        name : string
+            name of the job, e.g. the name of the configuration file
+        downloader : cds_downloader.Downloader
+            downloader of the configuration
+        storage_path : string
+            storage path of the data collection
+        mode : string, optional
+            'download', 'update' or 'daily'
+        split_keys : list of strings, optional
+            split keys of the data collection
+        priority : string or callable, optional
+            order of the chunks of the job, see
+            :func:`cds_downloader.priority.priority_key`
+        urgency : int, optional
+            jobs with a higher urgency take free workers first, jobs of lower
+            urgency only get the workers left over
+        kwargs : optional
+            further arguments of the mode, e.g. date_latency
+        """
+        if mode not in BATCH_MODES:
+            raise ValueError("The mode of job {} has to be one of {}".format(name, BATCH_MODES))
+        self.name = name
+        self.downloader = downloader
+        self.storage_path = str(storage_path)
+        self.mode = mode
+        self.split_keys = split_keys
+        self.priority = priority
+        self.urgency = urgency
+        self.kwargs = kwargs
+        self.done = 0
+        self.failed = 0
+
+
+    @property
+    def product(self):
+        return self.downloader.cds_product
+
+
+class Batch(object):
+    """The :class:`Batch` class runs the chunks of many configurations with a
+    single bounded worker pool.
+
+    All configurations are planned up front, their chunks are drawn lazily
+    into one shared queue. At most `max_workers` requests are active for the
+    whole batch, hence the cds queue slots of the account are used without
+    overcommitting them. Workers are shared fairly between the products (see
+    :meth:`cds_downloader.scheduler.Scheduler.run_fair`), the configurations of
+    a product take turns.
+
+    Examples
+    --------
+    >>> batch = Batch.from_paths(["configs/"], "/data", max_workers=8)
+    >>> summary = batch.run()
+
+    """
+
+    def __init__(self, jobs, max_workers=None, worker_type="thread", max_per_product=None, metrics=None,
+                 concurrency=None):
+        """
+        Parameters
+        ----------
+        jobs : list of BatchJob
+            jobs of the batch
+        max_workers : int, optional
+            global maximum number of concurrent requests
+        worker_type : string, optional
+            Run requests in 'thread' (default) or 'process' workers
+        max_per_product : int, optional
+            maximum number of concurrent requests of a single product
+        metrics : cds_downloader.metrics.Metrics, optional
+            receiver of the events of all jobs
+        concurrency : cds_downloader.concurrency.AdaptiveLimit, optional
+            adaptive global number of concurrent requests, max_workers is
+            its upper bound
+        """
+        self.jobs = list(jobs)
+        self.metrics = metrics or Metrics()
+        if concurrency is not None:
+            max_workers = max_workers or concurrency.max_limit
+            self.metrics.add_sink(concurrency)
+            concurrency.metrics = self.metrics
+        self.scheduler = Scheduler(max_workers=max_workers, worker_type=worker_type, limit=concurrency)
+        self.max_per_product = max_per_product
+        for job in self.jobs:
+            job.downloader.metrics = self.metrics
+
+
+    @classmethod
+    def from_paths(cls, paths, storage_path, mode="download", split_keys=None, session=None,
+                   metadata_cache=None, downloader_kwargs=None, job_kwargs=None, **kwargs):
+        """Create a batch from configuration files and directories
+
+        A configuration may contain the keys of :data:`JOB_KEYS` next to
+        cds_product and cds_filter, otherwise the arguments apply. A relative
+        storage path is resolved against storage_path, the default is a
+        directory per configuration named after its file.
+
+        Parameters
+        ----------
+        paths : list of strings
+            json configuration files and directories of them
+        storage_path : string
+            root of the storage paths
+        mode : string, optional
+            default operational mode
+        split_keys : list of strings, optional
+            default split keys
+        session : requests.Session, optional
+            http session shared by all downloaders
+        metadata_cache : cds_downloader.metadata.MetadataCache, optional
+            metadata cache shared by all downloaders
+        downloader_kwargs : dict, optional
+            keyword arguments of every Downloader
+        job_kwargs : dict, optional
+            default arguments of the modes, e.g. date_latency
+        kwargs : optional
+            keyword arguments of the Batch
+        """
+        session = session or create_session()
+        metadata_cache = metadata_cache or MetadataCache(session=session)
+        downloader_kwargs = dict(downloader_kwargs or {}, session=session, metadata_cache=metadata_cache)
+
+        jobs = []
+        for path in config_paths(paths):
+            name = os.path.splitext(os.path.basename(path))[0]
+            with open(path, 'r') as f:
+                config = json.load(f)
+            job_config = dict(job_kwargs or {}, **{k: config.pop(k) for k in JOB_KEYS if k in config})
+            job_config.setdefault("mode", mode)
+            job_config.setdefault("split_keys", split_keys)
+            job_config["storage_path"] = os.path.join(storage_path, job_config.get("storage_path", name))
+            downloader = Downloader(**dict(config, **downloader_kwargs))
+            jobs.append(BatchJob(name, downloader, **job_config))
+        return cls(jobs, **kwargs)
+
+
+    def run(self, dry_run=False, resume=False, coalesce=False):
+        """Plan the chunks of all jobs and download them
+
+        Parameters
+        ----------
+        dry_run : boolean, optional
+            plan all chunks without requesting them
+        resume : boolean, optional
+            continue the last incomplete run of every job from its journal
+            instead of planning the chunks again, see
+            :meth:`cds_downloader.Downloader.resume`
+        coalesce : boolean, optional
+            request the chunks, which several jobs share, once with union
+            requests, see :class:`cds_downloader.coalesce.Coalescer`. The
+            chunks of all jobs are planned up front.
+
+        Returns
+        -------
+        summary : dict
+            aggregates of the whole batch (see
+            :meth:`cds_downloader.metrics.Metrics.summary`), number of done
+            and failed chunks of each job in 'jobs' and the summary of the
+            union requests in 'coalesced'
+        """
+        self.metrics.start_run()
+        runs = {}
+        planned = []
+        for job in self.jobs:
+            logging.info('Plan batch job {} ({} mode)'.format(job.name, "resume" if resume else job.mode))
+            downloader = job.downloader
+            split_filter, kwargs_run = downloader._prepare("resume" if resume else job.mode, job.storage_path,
+                                                           job.split_keys, **job.kwargs)
+            if kwargs_run is None:
+                # Nothing to continue
+                continue
+            tasks, runs[id(downloader)] = downloader._open_run(job.storage_path, split_filter,
+                                                               dry_run=dry_run, priority=job.priority,
+                                                               **kwargs_run)
+            planned.append((job, tasks))
+
+        jobs = {id(job.downloader): job for job in self.jobs}
+        coalesced = None
+        groups = {}
+        if coalesce and not dry_run:
+            planned, requests = self._coalesce(planned)
+            coalesced = {"requests": len(requests), "files": 0, "failed": 0}
+            unions = {}
+            for request in requests:
+                # Union requests are as urgent as the most urgent of their jobs
+                urgency = max(jobs[id(d)].urgency for d, _ in request.targets)
+                unions.setdefault((request.cds_product, urgency), []).append(request.task)
+            for (product, urgency), tasks in unions.items():
+                groups.setdefault(product, []).append((urgency, iter(tasks)))
+        for job, tasks in planned:
+            groups.setdefault(job.product, []).append((job.urgency, _with_downloader(job.downloader, tasks)))
+
+        # A product is as urgent as its most urgent job
+        futures = self.scheduler.run_fair(
+            _retrieve, {product: _by_urgency(iterators) for product, iterators in groups.items()},
+            max_per_group=self.max_per_product,
+            priorities={product: max(u for u, _ in iterators) for product, iterators in groups.items()})
+        for future in futures:
+            downloader = future.task[0]
+            if isinstance(downloader, UnionRequest):
+                for member, done in downloader.finish(runs, future):
+                    if done:
+                        jobs[id(member)].done += 1
+                    else:
+                        jobs[id(member)].failed += 1
+                    coalesced["files" if done else "failed"] += 1
+                continue
+            job = jobs[id(downloader)]
+            # The result of the worker is the task without its downloader
+            future.task = future.task[1:]
+            downloader._finish_task(runs[id(downloader)], future)
+            if future.exception() is not None:
+                job.failed += 1
+            elif future.result() is not None:
+                # Chunks leased by other hosts count for them
+                job.done += 1
+
+        for job in self.jobs:
+            if id(job.downloader) not in runs:
+                continue
+            job.downloader._close_run(runs[id(job.downloader)])
+            logging.info('Batch job {}: {} chunks done, {} failed'.format(job.name, job.done, job.failed))
+
+        summary = self.metrics.finish_run() if not dry_run else self.metrics.summary()
+        summary["jobs"] = {job.name: {"product": job.product, "storage_path": job.storage_path,
+                                      "mode": job.mode, "done": job.done, "failed": job.failed}
+                           for job in self.jobs}
+        summary["coalesced"] = coalesced
+        return summary
+
+
+    def _coalesce(self, planned):
+        # The chunks of the coalesced jobs are planned up front, the shared chunks are taken out of their tasks
+        planned = [(job, list(tasks) if job.mode in COALESCE_MODES else tasks) for job, tasks in planned]
+        requests = Coalescer([job.downloader for job, _ in planned]).plan(
+            (job.downloader, task) for job, tasks in planned if job.mode in COALESCE_MODES for task in tasks)
+        shared = {id(task) for request in requests for _, task in request.targets}
+        return [(job, [t for t in tasks if id(t) not in shared] if job.mode in COALESCE_MODES else tasks)
+                for job, tasks in planned], requests
+
+
+def _with_downloader(downloader, tasks):
+    for task in tasks:
+        yield (downloader,) + task
+
+
+def _by_urgency(iterators):
+    # Jobs of a product take turns, less urgent jobs start when the urgent ones are exhausted
+    for urgency in sorted({u for u, _ in iterators}, reverse=True):
+        for task in _round_robin([it for u, it in iterators if u == urgency]):
+            yield task
+
+
+def _round_robin(iterators):
+    # Take turns between the configurations of a product
+    iterators = list(iterators)
+    while iterators:
+        for iterator in list(iterators):
+            task = next(iterator, None)
+            if task is None:
+                iterators.remove(iterator)
+            else:
+                yield task
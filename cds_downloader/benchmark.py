@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+"""
+benchmark.py:
+End-to-end throughput benchmarks of the downloader against the local fake cds
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import os
+import time
+import datetime
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from .cds_downloader import Downloader
+from .metadata import MetadataCache
+from .manifest import Manifest
+from .fake_cds import FakeCDS
+
+
+SCENARIOS = ["get_data", "update_data", "get_data_for_date"]
+
+PRODUCT = "reanalysis-era5-single-levels"
+
+
+def _proc_stat(pid):
+    # Parent pid and resident set size in pages of a process from /proc
+    with open("/proc/{}/stat".format(pid), 'r') as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return int(fields[1]), int(fields[21])
+
+
+class ProcessSampler(object):
+    """Samples the resident memory and the number of processes of the
+    benchmark (this process and its children) in a background thread
+
+    Without /proc (e.g. on Windows) the peak memory is the one traced by
+    :mod:`tracemalloc`, which only covers the python allocations of this
+    process, and the processes are this process and its multiprocessing
+    children.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_processes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._proc = resource is not None and os.path.isdir("/proc")
+        self._page_size = resource.getpagesize() if self._proc else None
+        self._tracing = False
+
+
+    def sample(self):
+        if self._proc:
+            rss, processes = self._sample_proc()
+        else:
+            rss = tracemalloc.get_traced_memory()[1]
+            processes = 1 + len(multiprocessing.active_children())
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_processes = max(self.peak_processes, processes)
+
+
+    def _sample_proc(self):
+        pid = os.getpid()
+        rss, processes = 0, 0
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                ppid, pages = _proc_stat(entry)
+            except (OSError, IndexError, ValueError):
+                continue
+            if int(entry) == pid or ppid == pid:
+                rss += pages * self._page_size
+                processes += 1
+        return rss, processes
+
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+
+    def __enter__(self):
+        if not self._proc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        self._thread.start()
+        return self
+
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+        if self._tracing:
+            tracemalloc.stop()
+
+
+def _downloader(scenario, chunks, fake, work_dir, **kwargs):
+    metadata_cache = MetadataCache(cache_dir=os.path.join(work_dir, "metadata"),
+                                   url=fake.url + "/api/v2.ui/resources/{}")
+    if scenario == "update_data":
+        cds_filter = {"format": "grib", "variable": "2m_temperature"}
+    else:
+        cds_filter = {"format": "grib", "variable": ["variable_{}".format(i) for i in range(chunks)],
+                      "year": ["2000"], "month": ["01"], "day": ["01"], "time": ["00:00"]}
+    return Downloader(PRODUCT, cds_filter, metadata_cache=metadata_cache, **kwargs)
+
+
+def _run_scenario(scenario, chunks, downloader, storage_path, kwargs_exec):
+    if scenario == "get_data":
+        return downloader.get_data(storage_path, ["variable"], **kwargs_exec)
+
+    if scenario == "get_data_for_date":
+        return downloader.get_data_for_date(storage_path, eval_date=datetime.datetime(2000, 1, 1),
+                                            **kwargs_exec)
+
+    # Existing collection up to the first day, the last existing day is requested again
+    first_day = datetime.datetime(2000, 1, 1)
+    split_keys = ["year", "month", "day"]
+    os.makedirs(storage_path, exist_ok=True)
+    file_name = "2000_01_01_{}.grib".format(PRODUCT)
+    open(os.path.join(storage_path, file_name), 'wb').close()
+    Manifest(storage_path).record(file_name, PRODUCT, dict(downloader.cds_filter, year="2000",
+                                                           month="01", day="01"), split_keys)
+    return downloader.update_data(storage_path, split_keys, start_from_files=True,
+                                  date_until=first_day + datetime.timedelta(days=chunks - 1),
+                                  **kwargs_exec)
+
+
+def run_benchmark(scenario="get_data", chunks=16, engine="pool", worker_type="thread",
+                  max_workers=None, download_workers=None, download_segments=1,
+                  queue_delay=0., result_size=1 << 20, bandwidth=None, work_dir=None):
+    """Run one scenario against a fresh fake cds and measure its throughput
+
+    Parameters
+    ----------
+    scenario : string
+        'get_data', 'update_data' or 'get_data_for_date'
+    chunks : int
+        number of chunks (requests) of the scenario
+    engine, worker_type, max_workers, download_workers : optional
+        execution parameters of the downloader
+    download_segments : int, optional
+        parallel connections of a single download
+    queue_delay : float, optional
+        seconds every request stays queued at the fake cds
+    result_size : int, optional
+        minimum size of every result in bytes
+    bandwidth : int, optional
+        bytes per second of every transfer, unlimited if None
+    work_dir : string, optional
+        directory of the storage path, a temporary directory by default
+
+    Returns
+    -------
+    results : dict
+        parameters and measurements (wall time, requests per hour, bytes per
+        second, peak rss in bytes and peak number of processes)
+    """
+    if scenario not in SCENARIOS:
+        raise ValueError("The parameter scenario has to be one of {}".format(SCENARIOS))
+
+    fake = FakeCDS(queued_polls=0, running_polls=0, result_size=result_size,
+                   queue_delay=queue_delay, bandwidth=bandwidth).start()
+    temp_dir = tempfile.TemporaryDirectory() if work_dir is None else None
+    work_dir = work_dir or temp_dir.name
+    rc_file = os.path.join(work_dir, ".cdsapirc")
+    with open(rc_file, 'w') as f:
+        f.write("url: {}\nkey: 1:abcdef\n".format(fake.api_url))
+    env_rc = os.environ.get("CDSAPI_RC")
+    os.environ["CDSAPI_RC"] = rc_file
+
+    try:
+        downloader = _downloader(scenario, chunks, fake, work_dir, download_segments=download_segments,
+                                 reuse_requests=False)
+        storage_path = os.path.join(work_dir, "data")
+        kwargs_exec = {"max_workers": max_workers, "worker_type": worker_type,
+                       "engine": engine, "download_workers": download_workers}
+
+        with ProcessSampler() as sampler:
+            start = time.time()
+            futures = _run_scenario(scenario, chunks, downloader, storage_path, kwargs_exec)
+            wall_time = time.time() - start
+    finally:
+        fake.stop()
+        if env_rc is None:
+            os.environ.pop("CDSAPI_RC", None)
+        else:
+            os.environ["CDSAPI_RC"] = env_rc
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+    requests = len(fake.submitted)
+    return {
+        "scenario": scenario,
+        "engine": engine,
+        "worker_type": worker_type,
+        "max_workers": max_workers,
+        "chunks": chunks,
+        "requests": requests,
+        "failed": sum(1 for f in futures if f.exception() is not None),
+        "wall_time": wall_time,
+        "requests_per_hour": requests / wall_time * 3600. if wall_time else None,
+        "bytes": fake.bytes_sent,
+        "bytes_per_second": fake.bytes_sent / wall_time if wall_time else None,
+        "connections": fake.connections,
+        "peak_rss": sampler.peak_rss,
+        "peak_processes": sampler.peak_processes,
+    }
@@ -6,8 +6,6 @@ Climate Data Store Downloader
 
 TODO:
  - Adapt requirements.txt
- - Check requests queue from api and do not add new request if already pending
- - Delete failed requests from queue via api
  - Check configuration
    + config not complete, use criterias from cds_webapi
 """
@@ -19,22 +17,37 @@ __status__ = "Development"
 
 import os
 import json
-import requests
 import copy
-import itertools
-import shutil
-import tempfile
+import time
 import datetime
 import logging
 import re
 
 import operator
-from functools import reduce
-
-from multiprocessing import Process
+import itertools
+from functools import reduce, partial
 
 from pathlib import Path
-import cdsapi
+
+from .scheduler import Scheduler, backoff_delay
+from .engine import AsyncEngine
+from .metadata import MetadataCache
+from .manifest import Manifest, STATUS_DONE, STATUS_FAILED
+from .gaps import GapDetector
+from .planner import Planner, value_label
+from .chunk_plan import ChunkPlan
+from .priority import prioritize
+from .transfer import download_result, resume_result
+from .session import Client, create_session, log_session_stats
+from .cds_queue import RequestQueue, submit_request, wait_request, check_reply, reattach_request
+from .metrics import (Metrics, EVENT_PLANNED, EVENT_SUBMITTED, EVENT_DOWNLOADING,
+                      EVENT_DONE, EVENT_FAILED, EVENT_RETRY)
+from .journal import Journal, CHUNK_DONE
+from .lease import LeaseTable, LeaseLost, DEFAULT_TTL
+from .daily import DailyBatcher, DAILY_SPLIT_KEYS
+from .integrity import Checksum, verify_download, verify_file
+from .grib_index import index_download, index_path
+from .aggregate import Aggregator
 
 
 class Downloader(object):
@@ -48,7 +61,11 @@ class Downloader(object):
 
     """
 
-    def __init__(self, cds_product, cds_filter, **kwargs):
+    def __init__(self, cds_product, cds_filter, metadata_cache=None, download_segments=1,
+                 session=None, reuse_requests=True, delete_failed=False, result_cache=None,
+                 verify=True, index=True, aggregate=None, metrics=None, concurrency=None,
+                 journal=True, retries=0, retry_backoff=60., leases=False, lease_ttl=DEFAULT_TTL,
+                 grib_params=None, **kwargs):
         """
         Parameters
         ----------
@@ -56,17 +73,130 @@ class Downloader(object):
             the cds product string
         cds_filter : dict
             the cds filter dictionary
-
+        metadata_cache : cds_downloader.metadata.MetadataCache, optional
+            cache for the product metadata from the cds webapi, the metadata
+            is loaded lazily on first access of :attr:`cds_webapi`
+        download_segments : int, optional
+            maximum number of parallel connections for the transfer of a
+            single result, large results are downloaded in byte range segments
+            (see :func:`cds_downloader.transfer.segmented_download`)
+        session : requests.Session, optional
+            http session shared by the metadata fetch, request submission,
+            status polling and downloads, defaults to a keep-alive session
+            from :func:`cds_downloader.session.create_session`
+        reuse_requests : boolean, optional
+            attach to queued, running or completed requests of the account
+            with the same product and filter instead of submitting them again,
+            see :class:`cds_downloader.cds_queue.RequestQueue`
+        delete_failed : boolean, optional
+            delete failed requests of the product from the cds queue
+        result_cache : cds_downloader.result_cache.ResultCache, optional
+            content-addressed cache of results shared by storage paths,
+            configurations and split layouts, cached results are linked or
+            extracted instead of requested
+        verify : boolean, optional
+            verify every download against the number of fields of its
+            filter, see :func:`cds_downloader.integrity.verify_download`
+        index : boolean, optional
+            write a sidecar index of the message offsets of every GRIB file,
+            see :class:`cds_downloader.grib_index.GribIndex`
+        aggregate : string, optional
+            merge finished chunks into 'month' or 'year' files, see
+            :class:`cds_downloader.aggregate.Aggregator`
+        metrics : cds_downloader.metrics.Metrics, optional
+            receiver of the timing events of every chunk and of the aggregates
+            of every run, e.g. with json lines or prometheus sinks
+        concurrency : cds_downloader.concurrency.AdaptiveLimit, optional
+            adapt the number of concurrent requests to the observed queue
+            waits, rejections and throughput, max_workers is its upper bound,
+            requires 'thread' workers
+        journal : boolean, optional
+            record the planned chunks, request ids and state transitions of
+            every run in the storage path page by page, a killed run is continued with
+            :meth:`resume`, see :class:`cds_downloader.journal.Journal`
+        retries : int, optional
+            number of retries of a failed chunk
+        retry_backoff : float, optional
+            base delay of the retries in seconds, the delay grows
+            exponentially with random jitter, see
+            :func:`cds_downloader.scheduler.backoff_delay`
+        leases : boolean, optional
+            claim every chunk in a lease table of the storage path before it
+            is requested, hence several hosts share the chunks of a storage
+            path without duplicate requests, see
+            :class:`cds_downloader.lease.LeaseTable`
+        lease_ttl : float, optional
+            seconds until the lease of a dead host expires
+        grib_params : dict, optional
+            GRIB parameter ('number.table') of variables, which are missing
+            in :data:`cds_downloader.daily.GRIB_PARAMS`, the daily mode only
+            combines variables with a known parameter into one request
 
         """
         self.cds_product = cds_product
         self.cds_filter = cds_filter
-        self.cds_webapi = requests.get(
-            url='https://cds.climate.copernicus.eu/api/v2.ui/resources/{}'.format(cds_product)).json()
+        self.session = session or create_session()
+        self.metadata_cache = metadata_cache or MetadataCache(session=self.session)
+        if self.metadata_cache.session is None:
+            self.metadata_cache.session = self.session
+        self._cds_webapi = None
+        self.download_segments = download_segments
+        self.reuse_requests = reuse_requests
+        self.delete_failed = delete_failed
+        self.request_queue = None
+        self.result_cache = result_cache
+        self.verify = verify
+        self.index = index
+        self.aggregate = aggregate
+        self.metrics = metrics or Metrics()
+        self.concurrency = concurrency
+        self.journal = journal
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.leases = leases
+        self.lease_ttl = lease_ttl
+        self.grib_params = grib_params
+        # Journal, leases and combined daily requests of the current run
+        self.run_journal = None
+        self.lease_table = None
+        self.run_batcher = None
+        # Streamed checksums of downloads in this process
+        self.checksums = {}
 
         logging.info('New downloader object initialized')
 
 
+    def __getstate__(self):
+        # Process workers get neither the product metadata nor the session,
+        # they open their own session and read the metadata from the cache if needed
+        state = self.__dict__.copy()
+        state["_cds_webapi"] = None
+        state["session"] = None
+        state["metadata_cache"] = copy.copy(self.metadata_cache)
+        state["metadata_cache"].session = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        client = getattr(self, "cdsapi_client", None)
+        self.session = client.session if client is not None else create_session()
+        self.metadata_cache.session = self.session
+
+
+    @property
+    def cds_webapi(self):
+        """Product metadata from the cds webapi, fetched on first access"""
+        if self._cds_webapi is None:
+            self._cds_webapi = self.metadata_cache.get(self.cds_product)
+        return self._cds_webapi
+
+
+    @cds_webapi.setter
+    def cds_webapi(self, value):
+        self._cds_webapi = value
+
+
     @classmethod
     def from_cds(cls, cds_product, cds_filter, **kwargs):
         """
@@ -111,7 +241,7 @@ class Downloader(object):
 
 
     @classmethod
-    def from_json(cls, json_config_path):
+    def from_json(cls, json_config_path, **kwargs):
         """
         Create Downloader from json file
 
@@ -119,11 +249,13 @@ class Downloader(object):
         ----------
         json_config_path : string
             path to json config file
+        kwargs : optional
+            additional keyword arguments of the Downloader, e.g. metadata_cache
         """
         try:
             #Read JSON config file
             with open(json_config_path, 'r') as f:
-                cds_downloader = cls(**json.load(f))
+                cds_downloader = cls(**dict(json.load(f), **kwargs))
 
             return cds_downloader
         except Exception as e:
@@ -131,7 +263,9 @@ class Downloader(object):
             raise
 
 
-    def get_data(self, storage_path, split_keys=None, overwrite=False):
+    def get_data(self, storage_path, split_keys=None, overwrite=False,
+                 max_workers=None, worker_type="thread", engine="pool", download_workers=None,
+                 priority=None):
         """This method downloads requested data from climate data store.
 
         Parameters
@@ -142,21 +276,40 @@ class Downloader(object):
             The maximum single data request size depends on the copernicus
             climate data store and is automatically extracted from their
             metadata webapi. If split_keys=None, the method automatically
-            chunks the cds request into multiple smaller requests and spawns a
-            single process for each of them. Therefore, it extracts all
-            list-like objects from the cds_filter (e.g. "year, "month, ...) and
-            splits the data into single requests/files.
+            chunks the cds request into multiple smaller requests and hands
+            them over to a bounded worker pool. Therefore, it partitions all
+            list-like objects from the cds_filter (e.g. "year, "month, ...)
+            into groups with :class:`cds_downloader.planner.Planner`, such
+            that the number of requests/files is minimal, see :meth:`plan`.
 
             By setting split_keys as a list of keys from the cds_filter, one can
             manually control the splitting (e.g. split_keys=["year", "month", "day"])
         overwrite: boolean
             Default is False, Set to true if you want to overwrite existing files.
             This implies new requests on the climate data store.
+        max_workers : int, optional
+            Maximum number of concurrent requests, defaults to
+            :data:`cds_downloader.scheduler.DEFAULT_MAX_WORKERS`
+        worker_type : string, optional
+            Run requests in 'thread' (default) or 'process' workers
+        engine : string, optional
+            Execution mode, either 'pool' (default) where each worker blocks
+            for the whole request cycle, or 'async' where requests are
+            submitted up front and polled from one event loop, see
+            :class:`cds_downloader.engine.AsyncEngine`. In 'async' mode
+            max_workers limits the number of submitted requests.
+        download_workers : int, optional
+            Number of concurrent transfers in 'async' mode
+        priority : string or callable, optional
+            Order of the requests, 'plan' (default), 'newest', 'oldest',
+            'round-robin' across variables, 'cheapest' or a key function of
+            the cds filter of a chunk, see
+            :func:`cds_downloader.priority.priority_key`
 
         Returns
         -------
-        processes : list of multiprocessing.Process
-            List of download process objects
+        futures : list of concurrent.futures.Future
+            Finished download tasks in order of completion
 
         Examples
         --------
@@ -180,10 +333,17 @@ class Downloader(object):
 
         """
 
+        split_filter, kwargs_run = self._prepare_data(storage_path, split_keys, overwrite)
+        return self._retrieve_files(storage_path, split_filter, max_workers=max_workers,
+                                    worker_type=worker_type, engine=engine,
+                                    download_workers=download_workers, priority=priority, **kwargs_run)
+
+
+    def _prepare_data(self, storage_path, split_keys=None, overwrite=False):
         # User Credentials from environment variables
         # 'CDSAPI_URL' and 'CDSAPI_KEY'
         try:
-            self.cdsapi_client = cdsapi.Client()
+            self.cdsapi_client = Client(session=self.session)
         except Exception as e:
             logging.exception("cdsapi client could not be initialized: \n" + e.args)
             raise("cdsapi client not initialized")
@@ -192,13 +352,48 @@ class Downloader(object):
         Path(storage_path).mkdir(parents=True, exist_ok=True)
 
         # If necessary, find keys for download chunking
-        if split_keys is None:
-            self.split_keys = self._get_split_keys()
-        else:
-            self.split_keys = split_keys
+        self.split_keys, split_filter = self._plan(split_keys)
+        return split_filter, {"overwrite": overwrite}
+
+
+    def plan(self, split_keys=None):
+        """This method plans the chunks of :meth:`get_data` without
+        downloading anything.
 
-        split_filter = self._expand_by_keys(self.cds_filter, self.split_keys)
-        return self._retrieve_files(storage_path, split_filter, overwrite)
+        Parameters
+        ----------
+        split_keys : list-like, optional
+            If split_keys=None, the value lists of the cds_filter are
+            partitioned into the minimal number of requests below the
+            selection limit of the cds webapi, otherwise the given keys are
+            split into single values.
+
+        Returns
+        -------
+        chunks : cds_downloader.chunk_plan.ChunkPlan
+            sequence of the cds filters of the requests, split keys with more
+            than one value per request contain the list of values
+
+        Examples
+        --------
+        A request that barely exceeds the selection limit is split into two
+        half years instead of twelve months
+
+        >>> x.cds_webapi["selection_limit"] = 6
+        >>> [c["month"] for c in x.plan()]
+        [['01', '02', '03', '04', '05', '06'], ['07', '08', '09', '10', '11', '12']]
+
+        """
+        split_keys, split_filter = self._plan(split_keys)
+        return split_filter
+
+
+    def _plan(self, split_keys=None):
+        if split_keys is None:
+            planner = Planner(self.cds_webapi["selection_limit"])
+            split_keys, groups = planner.plan(self.cds_filter)
+            return split_keys, planner.expand(self.cds_filter, split_keys, groups)
+        return split_keys, self._expand_by_keys(self.cds_filter, split_keys)
 
 
     def get_latest_daily_data(self, storage_path, date_latency=None, **kwargs):
@@ -214,6 +409,11 @@ class Downloader(object):
             Latency with respect to the current utc date and time. If integer is passed the latency is interpreted as days.
 
         """
+        return self.get_data_for_date(storage_path=storage_path, eval_date=self._daily_date(date_latency),
+                                      **kwargs)
+
+
+    def _daily_date(self, date_latency=None):
         # If latency is defined, subtract from actual UTC date
         if date_latency is None:
             date_download=datetime.datetime.utcnow()
@@ -225,30 +425,57 @@ class Downloader(object):
             date_download = datetime.datetime.utcnow() - date_latency
         else:
             raise("The parameter date_latency has to be an integer, str or datetime.timedelta object")
+        return date_download
 
-        self.get_data_for_date(storage_path=storage_path, eval_date=date_download, **kwargs)
 
-    def get_data_for_date(self, storage_path, eval_date=datetime.datetime.utcnow(), **kwargs):
+    def get_data_for_date(self, storage_path, eval_date=datetime.datetime.utcnow(),
+                          max_workers=None, worker_type="thread", engine="pool",
+                          download_workers=None, priority=None, days=1, **kwargs):
         """This method uses temporal information from the webapi and downloads 
         data for a specified date.
 
+        Every variable and day is stored in its own file, but the missing
+        files are combined into as few requests as the selection limit
+        allows, see :class:`cds_downloader.daily.DailyBatcher`.
+
         Parameters
         ----------
         storage_path : string
             storage path of data collection as string
         eval_date : datetime.timedelta or str
             date of the data fields
+        max_workers : int, optional
+            Maximum number of concurrent requests
+        worker_type : string, optional
+            Run requests in 'thread' (default) or 'process' workers
+        engine : string, optional
+            Execution mode, either 'pool' (default) or 'async'
+        download_workers : int, optional
+            Number of concurrent transfers in 'async' mode
+        priority : string or callable, optional
+            Order of the requests, see :meth:`get_data`
+        days : int, optional
+            Number of days up to eval_date. The files of eval_date are always
+            requested again, the files of the days before only if they are
+            missing (e.g. to catch up after an outage).
 
         """
+        split_filter, kwargs_run = self._prepare_data_for_date(storage_path, eval_date, days, **kwargs)
+        return self._retrieve_files(storage_path, split_filter, max_workers=max_workers,
+                                    worker_type=worker_type, engine=engine,
+                                    download_workers=download_workers, priority=priority, **kwargs_run)
+
+
+    def _prepare_data_for_date(self, storage_path, eval_date, days=1, **kwargs):
         # User Credentials from environment variables
         # 'CDSAPI_URL' and 'CDSAPI_KEY'
         try:
-            self.cdsapi_client = cdsapi.Client(**kwargs)
+            self.cdsapi_client = Client(session=self.session, **kwargs)
         except Exception as e:
             logging.exception("cdsapi client could not be initialized: \n" + e.args)
             raise("cdsapi client not initialized")
 
-        self.split_keys = ["variable","year","month","day"]
+        self.split_keys = DAILY_SPLIT_KEYS
 
         # input handling for date_download
         if isinstance(eval_date, str):
@@ -260,35 +487,49 @@ class Downloader(object):
 
         # Update temporal filter from webapi
         temporal_filter = self._full_time_filter_from_webapi()
-        temporal_filter.update(
-            {"year": str(date_download.year),
-             "month": str(date_download.month),
-             "day": str(date_download.day)
-            }
-        )
         cds_filter = copy.deepcopy(self.cds_filter)
         cds_filter.update(temporal_filter)
 
-        split_filter = self._expand_by_keys(cds_filter, self.split_keys)
+        # The latest day is always requested again, the days before only if they are missing
+        manifest = Manifest(storage_path)
+        dates = [(date_download - datetime.timedelta(days=i)).date() for i in reversed(range(days))]
+        variables = cds_filter.get("variable")
+        missing = []
+        for date in dates:
+            for variable in variables if isinstance(variables, list) else [variables]:
+                file_path = self._file_name(dict(cds_filter, variable=variable, year=str(date.year),
+                                                 month=str(date.month), day=str(date.day)))
+                if date == dates[-1] or not self._exists(storage_path, file_path, manifest):
+                    missing.append((variable, date))
+
+        batcher = self._daily_batcher()
+        split_filter = batcher.plan(cds_filter, missing)
 
         # Create storage path
         Path(storage_path).mkdir(parents=True, exist_ok=True)
+        return split_filter, {"overwrite": True, "manifest": manifest, "batcher": batcher}
 
-        return self._retrieve_files(storage_path, split_filter, overwrite=True)
+
+    def _daily_batcher(self):
+        return DailyBatcher(self.cds_webapi["selection_limit"], self.grib_params)
 
 
 
     def update_data(self, storage_path, split_keys,
                     date_until=datetime.datetime.utcnow(), date_latency=None,
-                    start_from_files=False):
+                    start_from_files=False, max_workers=None, worker_type="thread",
+                    engine="pool", download_workers=None, date_from=None, keep_last=True, priority=None):
         """This method provides update functionality for climate data collections
         retrieved with :meth:`cds_downloader.Downloader.get_data`
 
         It uses temporal information from cds metadata webapi and evaluates
-        missing data. Redownload latest file in order to avoid missing data.
+        missing data with :class:`cds_downloader.gaps.GapDetector`. Redownload
+        latest file in order to avoid missing data, it is replaced atomically
+        as soon as the new download is complete.
 
-        Under development, only temporal split_keys allowed:
-        split_keys in ["year", "month", "day", "time"]
+        Temporal split_keys have to be a chain of ["year", "month", "day",
+        "time"], they can be mixed with non temporal split_keys (e.g.
+        ["variable", "year", "month"]).
 
         Parameters
         ----------
@@ -302,12 +543,34 @@ class Downloader(object):
             temporal latency in relation to date_until
         start_from_files : boolean, optional
              use first file of sorted file list as start reference date
+        max_workers : int, optional
+            Maximum number of concurrent requests
+        worker_type : string, optional
+            Run requests in 'thread' (default) or 'process' workers
+        engine : string, optional
+            Execution mode, either 'pool' (default) or 'async'
+        download_workers : int, optional
+            Number of concurrent transfers in 'async' mode
+        date_from : datetime.datetime, optional
+            first date of the update, overrides start_from_files
+        keep_last : boolean, optional
+            redownload the last existing chunk, which may be incomplete
+        priority : string or callable, optional
+            Order of the requests, e.g. 'newest' fetches recent data before
+            a long backfill, see :meth:`get_data`
 
         """
+        split_filter, kwargs_run = self._prepare_update(storage_path, split_keys, date_until=date_until,
+                                                        date_latency=date_latency,
+                                                        start_from_files=start_from_files,
+                                                        date_from=date_from, keep_last=keep_last)
+        return self._retrieve_files(storage_path, split_filter, max_workers=max_workers,
+                                    worker_type=worker_type, engine=engine,
+                                    download_workers=download_workers, priority=priority, **kwargs_run)
 
-        # TODO:
-        # - split_keys includes non temporal attributes (e.g. variable)
 
+    def _prepare_update(self, storage_path, split_keys, date_until=datetime.datetime.utcnow(),
+                        date_latency=None, start_from_files=False, date_from=None, keep_last=True):
         if isinstance(date_latency, str):
             date_until = date_until - self._parse_time(date_latency)
         elif isinstance(date_latency, datetime.timedelta):
@@ -316,7 +579,7 @@ class Downloader(object):
         # User Credentials from environment variables
         # 'CDSAPI_URL' and 'CDSAPI_KEY'
         try:
-            self.cdsapi_client = cdsapi.Client()
+            self.cdsapi_client = Client(session=self.session)
         except Exception as e:
             logging.exception("cdsapi client could not be initialized: \n" + e.args)
             raise("cdsapi client not initialized")
@@ -325,53 +588,219 @@ class Downloader(object):
 
         path_files = Path(storage_path)
 
-        if path_files.is_dir():
-            lst_existing_files = [f for f in path_files.glob("*." + self.cds_filter.get("format", "grib"))]
-            lst_existing_files = sorted(lst_existing_files)
-        else:
+        if not path_files.is_dir():
             logging.exception("No valid path specified")
             raise("No valid path")
 
         temporal_filter = self._full_time_filter_from_webapi()
 
-        file_split_keys = [tuple(f.name.rsplit("_")[:len(self.split_keys)]) for f in lst_existing_files]
-        all_split_keys = [i for i in itertools.product(
-            *[dict(self.cds_filter, **temporal_filter)[k] for k in self.split_keys])
-        ]
+        # Existing chunks from the manifest, index existing collections once
+        manifest = Manifest(storage_path)
+        file_split_keys = manifest.split_values(self.cds_product, self.split_keys)
+        if not file_split_keys:
+            self.rebuild_manifest(storage_path, self.split_keys)
+            file_split_keys = manifest.split_values(self.cds_product, self.split_keys)
+
+        # Missing chunks until present date, keep last chunk
+        gap_detector = GapDetector(self.split_keys, dict(self.cds_filter, **temporal_filter))
+        missing_ranges = gap_detector.missing(
+            file_split_keys,
+            until=date_until,
+            # Exclude dates earlier than date of first file
+            start=date_from or ("existing" if start_from_files else None),
+            keep_last=keep_last)
+        logging.info('Missing chunks: {}'.format(sum(r.count for r in missing_ranges)))
+
+        # Downloads are written to partial files and renamed into place when complete
+        split_filter = (dict(self.cds_filter, **dict(temporal_filter, **upd))
+                        for upd in gap_detector.expand(missing_ranges))
+
+        return split_filter, {"overwrite": True, "manifest": manifest}
+
+
+    def _prepare(self, mode, storage_path, split_keys=None, **kwargs):
+        # Plan the chunks of an operational mode without downloading them
+        if mode == "download":
+            return self._prepare_data(storage_path, split_keys, overwrite=kwargs.get("overwrite", False))
+        if mode == "update":
+            return self._prepare_update(storage_path, split_keys, **{
+                k: v for k, v in kwargs.items() if k in ("date_until", "date_latency", "start_from_files", "date_from", "keep_last")})
+        if mode == "daily":
+            return self._prepare_data_for_date(storage_path, self._daily_date(kwargs.get("date_latency")),
+                                               kwargs.get("days", 1))
+        if mode == "resume":
+            return self._prepare_resume(storage_path, kwargs.get("run_id"))
+        raise ValueError("The parameter mode has to be 'download', 'update', 'daily' or 'resume'")
+
+
+    def resume(self, storage_path, run_id=None, max_workers=None, worker_type="thread", engine="pool",
+               download_workers=None):
+        """This method continues the last run of the product in the storage
+        path, which is not complete, e.g. because it was killed or some of its
+        chunks failed.
+
+        The chunks of the run, which are not done, are taken from the journal
+        of the storage path (see :class:`cds_downloader.journal.Journal`)
+        instead of planning them again, a run of :meth:`get_data`, which was
+        killed while planning, continues the rest of its plan. Requests, which the run already
+        submitted, are reattached by their request id as long as the cds
+        knows them, the others are submitted again.
 
-        # Until present date
-        index_present = all_split_keys.index(
-            tuple(str(date_until.__getattribute__(k)).zfill(2) for k in self.split_keys if k in temporal_filter.keys())
-        )
+        Parameters
+        ----------
+        storage_path : string
+            storage path of data collection as string
+        run_id : int, optional
+            continue this run instead of the last incomplete one
+        max_workers : int, optional
+            Maximum number of concurrent requests
+        worker_type : string, optional
+            Run requests in 'thread' (default) or 'process' workers
+        engine : string, optional
+            Execution mode, either 'pool' (default) or 'async'
+        download_workers : int, optional
+            Number of concurrent transfers in 'async' mode
+
+        Returns
+        -------
+        futures : list of concurrent.futures.Future
+            Finished download tasks in order of completion, empty if there
+            is no run to continue
 
-        # Keep last tuple
-        missing_split_keys = [keys for keys in all_split_keys[:index_present+1] if keys not in file_split_keys[:-1]]
+        """
+        split_filter, kwargs_run = self._prepare_resume(storage_path, run_id)
+        if kwargs_run is None:
+            return []
+        return self._retrieve_files(storage_path, split_filter, max_workers=max_workers,
+                                    worker_type=worker_type, engine=engine,
+                                    download_workers=download_workers, **kwargs_run)
 
-        # Exclude dates earlier than date of first file
-        if start_from_files:
-            index_first = all_split_keys.index(file_split_keys[0])
-            missing_split_keys = [keys for keys in all_split_keys[index_first:index_present+1] if keys not in file_split_keys[:-1]]
 
+    def _prepare_resume(self, storage_path, run_id=None):
+        journal = Journal(storage_path)
+        run = journal.resume_run(self.cds_product, run_id)
+        if run is None:
+            logging.warning('No incomplete run of {} in {}'.format(self.cds_product, storage_path))
+            return None, None
 
-        # Download new data in temporary folder
-        with tempfile.TemporaryDirectory() as path_temp:
-            dct_update = [{k:v for k,v in zip(self.split_keys, missing_split_key)} for missing_split_key in missing_split_keys]
-            dct_update = [dict(temporal_filter, **upd) for upd in dct_update]
-            split_filter = (dict(self.cds_filter, **upd) for upd in dct_update)
+        # User Credentials from environment variables
+        # 'CDSAPI_URL' and 'CDSAPI_KEY'
+        try:
+            self.cdsapi_client = Client(session=self.session)
+        except Exception as e:
+            logging.exception("cdsapi client could not be initialized: \n{}".format(e))
+            raise
 
-            all_processes = self._retrieve_files(path_temp, split_filter)
+        self.split_keys = run["split_keys"]
+        kwargs_run = {"overwrite": True, "journal": journal}
+        if self.split_keys == DAILY_SPLIT_KEYS:
+            # Combined requests of the daily mode
+            kwargs_run["batcher"] = self._daily_batcher()
+        return None, kwargs_run
 
-            lst_new_files = [f for f in Path(path_temp).iterdir()]
 
-            # Move files from tmp folder to storage path
-            for f in lst_new_files:
-                # Move and overwrite file if necessary
-                try:
-                    shutil.move(f, path_files.joinpath(f.name))
-                    logging.info("Move file from tmp to storage path: " + f.as_posix())
-                except Exception as e:
-                    logging.exception("Move file from tmp to storage path: " + f.as_posix())
-                    print(e.args)
+    def rebuild_manifest(self, storage_path, split_keys):
+        """This method indexes an existing data collection, e.g. downloaded
+        before the manifest was introduced, in the manifest of the storage path.
+
+        Parameters
+        ----------
+        storage_path : string
+            storage path of data collection as string
+        split_keys : list of strings
+            split keys of the data collection
+
+        Returns
+        -------
+        count : int
+            number of indexed files
+        """
+        candidates = {k: v if isinstance(v, list) else [v] for k, v in self.cds_filter.items()}
+        if any(k not in candidates for k in split_keys):
+            candidates = dict(self._full_time_filter_from_webapi(), **candidates)
+        return Manifest(storage_path).rebuild(self.cds_product, split_keys, candidates,
+                                              self.cds_filter.get("format", "grib"))
+
+
+    def aggregate_data(self, storage_path, split_keys, period="month"):
+        """This method merges the chunk files of an existing data collection
+        into files of a longer period, e.g. daily chunks into monthly files.
+        The manifest keeps track of every chunk, hence :meth:`update_data`
+        continues an aggregated collection.
+
+        Parameters
+        ----------
+        storage_path : string
+            storage path of data collection as string
+        split_keys : list of strings
+            split keys of the data collection
+        period : string, optional
+            'month' or 'year'
+
+        Returns
+        -------
+        targets : set of strings
+            paths of the updated period files
+        """
+        return Aggregator(storage_path, self.cds_product, split_keys, period=period,
+                          file_format=self.cds_filter.get("format", "grib")).add_pending()
+
+
+    def verify_data(self, storage_path, split_keys=None, checksum=True):
+        """This method verifies an existing data collection. Corrupt files are
+        marked as failed in the manifest, hence the next run of :meth:`get_data`
+        or :meth:`update_data` requests them again.
+
+        Files of the planned chunks (see :meth:`plan`) are checked against the
+        number of fields of their filter, all files of the manifest against
+        their recorded size and checksum.
+
+        Parameters
+        ----------
+        storage_path : string
+            storage path of data collection as string
+        split_keys : list-like, optional
+            split keys of the data collection, see :meth:`get_data`
+        checksum : boolean, optional
+            compare the recorded checksums, requires a full read of all files
+
+        Returns
+        -------
+        problems : dict
+            list of problems for each corrupt file name
+        """
+        manifest = Manifest(storage_path)
+        self.split_keys, split_filter = self._plan(split_keys)
+        chunks = {self._file_name(cds_filter): cds_filter for cds_filter in split_filter}
+        entries = {entry["file_name"]: entry for entry in manifest.entries(STATUS_DONE)}
+        # Chunks of aggregated files are verified at their byte range
+        members = {file_name: (target, offset, length)
+                   for file_name, target, offset, length in manifest.members()}
+
+        problems = {}
+        for file_name in sorted(set(chunks) | set(entries)):
+            path = os.path.join(storage_path, file_name)
+            entry = entries.get(file_name, {})
+            offset, length = 0, None
+            if file_name in members:
+                target, offset, length = members[file_name]
+                path = os.path.join(storage_path, target)
+            if not entry and not os.path.exists(path):
+                continue
+            file_problems = verify_file(path, chunks.get(file_name), size=entry.get("size"),
+                                        checksum=entry.get("checksum") if checksum else None,
+                                        offset=offset, length=length)
+            if file_problems:
+                logging.warning('Verification of {} failed: {}'.format(file_name, ", ".join(file_problems)))
+                problems[file_name] = file_problems
+                if entry:
+                    manifest.set_status(file_name, STATUS_FAILED)
+                else:
+                    manifest.record(file_name, self.cds_product, chunks[file_name], self.split_keys,
+                                    status=STATUS_FAILED)
+
+        logging.info('Verified {} files, {} corrupt'.format(len(set(chunks) | set(entries)), len(problems)))
+        return problems
 
 
     def _get_org_keys(self):
@@ -398,50 +827,349 @@ class Downloader(object):
 
 
     def _expand_by_keys(self, dct, lst_keys):
-        tmp_dct = copy.deepcopy(dct)
-        for value in itertools.product(*[dct.get(key) for key in lst_keys if isinstance(dct.get(key),list)]):
-            tmp_dct.update(dict(zip(lst_keys, value)))
-            yield tmp_dct
+        # Compact plan of all combinations, scalar values of split keys are kept
+        return ChunkPlan(dct, lst_keys)
+
+
+    def _retrieve_chunk(self, cds_product, cds_filter, file_name, dry_run=False):
+        # Chunks leased by another host are skipped, their result is None
+        if self.lease_table is None or dry_run:
+            return self._retrieve_retries(cds_product, cds_filter, file_name, dry_run)
+        lease = os.path.basename(file_name)
+        if not self.lease_table.claim(lease):
+            logging.info('Chunk {} is claimed by another host'.format(file_name))
+            return None
+        done = False
+        try:
+            self._retrieve_retries(cds_product, cds_filter, file_name, dry_run)
+            done = True
+        except LeaseLost as e:
+            # The new owner requests and records the chunk
+            logging.warning('Chunk {} is left to another host: {}'.format(file_name, repr(e)))
+            return None
+        finally:
+            self.lease_table.release(lease, done=done)
+        return file_name
+
+
+    def _retrieve_retries(self, cds_product, cds_filter, file_name, dry_run=False):
+        # Failed attempts are retried with backoff, the error of the last attempt is raised
+        attempt = 0
+        while True:
+            try:
+                return self._retrieve_file(cds_product, cds_filter, file_name, dry_run)
+            except LeaseLost:
+                raise
+            except Exception as e:
+                if dry_run or attempt >= self.retries:
+                    raise
+                delay = backoff_delay(attempt, self.retry_backoff)
+                logging.warning('Attempt {} of {} failed, retry in {:.0f} seconds: {}'.format(
+                    attempt + 1, file_name, delay, repr(e)))
+                self._emit(EVENT_RETRY, file_name, cds_product, error=repr(e))
+                time.sleep(delay)
+                attempt += 1
 
 
     def _retrieve_file(self, cds_product, cds_filter, file_name, dry_run=False):
         if not dry_run:
             logging.info('Start download process ' + file_name)
-            self.cdsapi_client.retrieve(
-                cds_product,
-                cds_filter,
-                file_name
-            )
+            checksum = Checksum()
+            on_retry = partial(self.metrics.retry, file_name)
+            # Continue the transfer of a crashed run instead of a new request
+            if resume_result(self.cdsapi_client, file_name, segments=self.download_segments,
+                             checksum=checksum, on_retry=on_retry) is None:
+                on_state = partial(self._on_state, file_name, cds_product)
+                # Requests of a resumed run are reattached by their request id
+                reply = self._reattach(file_name)
+                if reply is not None:
+                    logging.info('Reattach to request {} for file {}'.format(reply.get('request_id'), file_name))
+                    self._emit(EVENT_SUBMITTED, file_name, cds_product, request_id=reply.get('request_id'))
+                    reply = check_reply(wait_request(self.cdsapi_client, reply, on_state=on_state))
+                else:
+                    if self.request_queue is not None:
+                        reply = self.request_queue.claim(cds_product, cds_filter)
+                    if reply is not None:
+                        logging.info('Attach to request {} for file {}'.format(reply.get('request_id'), file_name))
+                        self._emit(EVENT_SUBMITTED, file_name, cds_product, request_id=reply.get('request_id'))
+                        reply = self.request_queue.wait(reply, on_state=on_state)
+                    else:
+                        reply = submit_request(self.cdsapi_client, cds_product, cds_filter)
+                        self._emit(EVENT_SUBMITTED, file_name, cds_product, request_id=reply.get('request_id'))
+                        reply = check_reply(wait_request(self.cdsapi_client, reply, on_state=on_state))
+                self._check_lease(file_name)
+                self._emit(EVENT_DOWNLOADING, file_name, cds_product)
+                download_result(self.cdsapi_client, reply, file_name,
+                                segments=self.download_segments, checksum=checksum, on_retry=on_retry)
+            self._check_lease(file_name)
+            if self.verify:
+                verify_download(file_name, cds_filter)
+            if self.index:
+                index_download(file_name, cds_filter)
+            self._split_batch(file_name, cds_filter)
+            self.checksums[file_name] = checksum.hexdigest()
             logging.info('Finish download process ' + file_name)
         else:
             logging.info('Dry run, therefore no download process started for file ' + file_name)
-
-
-    def _retrieve_files(self, storage_path, split_filter, overwrite=False, dry_run=False):
-        all_processes = []
+        return file_name
+
+
+    def _check_lease(self, file_name):
+        # A worker, whose lease expired, neither downloads nor records the chunk
+        if self.lease_table is not None:
+            self.lease_table.check(os.path.basename(file_name))
+
+
+    def _split_batch(self, file_name, cds_filter):
+        # Results of combined daily requests are split into their files by the worker
+        if self.run_batcher is not None and self.run_batcher.is_batch(cds_filter):
+            self.run_batcher.split(file_name, cds_filter, self._file_name)
+
+
+    def _on_state(self, file_name, cds_product, reply):
+        if reply.get('state') in ('queued', 'running'):
+            self._emit(reply['state'], file_name, cds_product, request_id=reply.get('request_id'))
+
+
+    def _emit(self, event, file_name, cds_product, **fields):
+        # Events of a chunk go to the metrics and to the journal of the run
+        self.metrics.emit(event, file_name, cds_product, **fields)
+        if self.run_journal is not None:
+            self.run_journal.record(event, file_name, request_id=fields.get('request_id'),
+                                    error=fields.get('error'))
+
+
+    def _reattach(self, file_name):
+        if self.run_journal is None:
+            return None
+        request_id = self.run_journal.request_id(file_name)
+        if request_id is None:
+            return None
+        return reattach_request(self.cdsapi_client, request_id)
+
+
+    def _retrieve_files(self, storage_path, split_filter, overwrite=False, dry_run=False,
+                        max_workers=None, worker_type="thread", engine="pool", download_workers=None,
+                        manifest=None, journal=None, priority=None, batcher=None):
+        if engine not in ("pool", "async"):
+            raise ValueError("The parameter engine has to be 'pool' or 'async'")
+        if engine == "async" and self.leases and not dry_run:
+            raise ValueError("Leases are only supported by the 'pool' engine")
+        if engine == "pool" and worker_type == "process" and self.concurrency is not None:
+            raise ValueError("An adaptive limit requires 'thread' workers")
+        self.metrics.start_run()
+        tasks, run = self._open_run(storage_path, split_filter, overwrite, dry_run, manifest, journal, priority,
+                                    batcher)
+
+        limit = self.concurrency
+        if limit is not None:
+            # The limit follows the events of the chunks
+            if limit not in self.metrics.sinks:
+                self.metrics.add_sink(limit)
+            limit.metrics = self.metrics
+            max_workers = max_workers or limit.max_limit
+
+        if engine == "pool":
+            scheduler = Scheduler(max_workers=max_workers, worker_type=worker_type, limit=limit)
+            futures = scheduler.run(self._retrieve_chunk, tasks)
+        else:
+            async_engine = AsyncEngine(self.cdsapi_client, max_requests=max_workers, limit=limit,
+                                       download_workers=download_workers,
+                                       download_segments=self.download_segments,
+                                       request_queue=self.request_queue,
+                                       verify=self.verify, index=self.index, metrics=self.metrics,
+                                       journal=self.run_journal, retries=self.retries,
+                                       retry_backoff=self.retry_backoff, postprocess=self._split_batch)
+            futures = async_engine.run(tasks)
+            self.checksums.update(async_engine.checksums)
+
+        all_futures = []
+        for future in futures:
+            self._finish_task(run, future)
+            all_futures.append(future)
+
+        self._close_run(run)
+        if not dry_run:
+            self.metrics.finish_run(self.cds_product)
+        return all_futures
+
+
+    def _open_run(self, storage_path, split_filter, overwrite=False, dry_run=False, manifest=None,
+                  journal=None, priority=None, batcher=None):
+        # Lazy download tasks and the state shared by their completions
+        if manifest is None:
+            manifest = Manifest(storage_path)
+        journaling = not dry_run and (journal is not None or self.journal)
+        tasks = ()
+        if split_filter is not None:
+            plan = None
+            if isinstance(split_filter, ChunkPlan) and (priority is None or isinstance(priority, str)):
+                plan = split_filter
+            split_filter = prioritize(split_filter, priority)
+            if not journaling:
+                tasks = self._iter_tasks(storage_path, split_filter, manifest, overwrite, dry_run)
+            elif journal is None:
+                journal = Journal(storage_path)
+                journal.open_run(self.cds_product, self.split_keys, plan=plan,
+                                 priority=None if priority == "plan" else priority)
+
+        self.run_journal = None
+        if journaling:
+            if split_filter is None:
+                # A resumed run continues the chunks, which are not done, and the rest of its plan
+                # without the files, which exist by now
+                split_filter = journal.unplanned()
+                if split_filter is None:
+                    logging.warning('Run {} was interrupted while planning, chunks which were not planned are '
+                                    'requested by the next run of the mode'.format(journal.run_id))
+                    split_filter = ()
+                tasks = itertools.chain(self._journal_tasks(storage_path, journal),
+                                        self._plan_pages(storage_path, split_filter, manifest, False, journal))
+            else:
+                tasks = self._plan_pages(storage_path, split_filter, manifest, overwrite, journal)
+            self.run_journal = journal
+
+        # Chunks finished by other hosts since the (first) planning of the run are skipped
+        self.lease_table = None
+        if self.leases and not dry_run:
+            self.lease_table = LeaseTable(storage_path, ttl=self.lease_ttl,
+                                          since=journal.started if journal is not None else None)
+
+        self.run_batcher = batcher
+
+        self.request_queue = None
+        if self.reuse_requests and not dry_run:
+            self.request_queue = RequestQueue(self.cdsapi_client, delete_failed=self.delete_failed)
+            self.request_queue.refresh(self.cds_product)
+
+        aggregator = None
+        if self.aggregate is not None and not dry_run:
+            aggregator = Aggregator(storage_path, self.cds_product, self.split_keys, period=self.aggregate,
+                                    file_format=self.cds_filter.get("format", "grib"), manifest=manifest)
+        return tasks, {"manifest": manifest, "aggregator": aggregator, "journal": journal}
+
+
+    def _finish_task(self, run, future):
+        cds_product, cds_filter, file_name, dry_run = future.task
+        if dry_run:
+            return
+        if future.exception() is None and future.result() is None:
+            # Chunks of other hosts are recorded by them, the journal of this run only learns they are done
+            if self.run_journal is not None and \
+                    self.lease_table.finished_elsewhere(os.path.basename(file_name)):
+                self.run_journal.record(CHUNK_DONE, file_name)
+            return
+        if future.exception() is None:
+            self._emit(EVENT_DONE, file_name, cds_product, bytes=os.path.getsize(file_name))
+        else:
+            self._emit(EVENT_FAILED, file_name, cds_product, error=repr(future.exception()))
+
+        if self.run_batcher is None or not self.run_batcher.is_batch(cds_filter):
+            self._record_file(run, cds_product, cds_filter, file_name, future.exception() is None,
+                              checksum=self.checksums.pop(file_name, None))
+            return
+        # The files of a combined request were split off by the worker, the result is dropped
+        self.checksums.pop(file_name, None)
+        for member in self.run_batcher.members(cds_filter):
+            self._record_file(run, cds_product, member,
+                              os.path.join(os.path.dirname(file_name), self._file_name(member)),
+                              future.exception() is None)
+        for path in (file_name, index_path(file_name)):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+    def _record_file(self, run, cds_product, cds_filter, file_name, done, checksum=None):
+        # Checksums of process workers are not shared, the manifest computes them
+        run["manifest"].record(os.path.basename(file_name), cds_product, cds_filter, self.split_keys,
+                               status=STATUS_DONE if done else STATUS_FAILED,
+                               file_path=file_name, checksum=checksum)
+        if self.result_cache is not None and done:
+            self.result_cache.put(cds_product, cds_filter, file_name)
+        # Chunks are merged into their period file as soon as they are finished
+        if run["aggregator"] is not None and done:
+            run["aggregator"].add(file_name, [value_label(cds_filter.get(k)) for k in self.split_keys])
+
+
+    def _close_run(self, run):
+        if run["aggregator"] is not None:
+            # Chunks linked from the result cache
+            run["aggregator"].add_pending()
+        if run["journal"] is not None:
+            run["journal"].finish_run()
+            run["journal"].close()
+            self.run_journal = None
+        if self.lease_table is not None:
+            self.lease_table.close()
+            self.lease_table = None
+        self.run_batcher = None
+        log_session_stats(self.session)
+
+
+    def _file_name(self, cds_filter):
+        return '_'.join([value_label(cds_filter.get(k)) for k in self.split_keys] or ["all"]) + \
+            "_" + self.cds_product + \
+            "." + cds_filter.get("format", "grib")
+
+
+    def _iter_tasks(self, storage_path, split_filter, manifest, overwrite=False, dry_run=False):
         for cds_filter in split_filter:
-            file_path = '_'.join([cds_filter.get(k) for k in self.split_keys] or ["all"]) + \
-                        "_" + self.cds_product + \
-                        "." + cds_filter.get("format", "grib")
-
-            if not os.path.exists(os.path.join(storage_path, file_path)) or overwrite:
-                p = Process(
-                    target=self._retrieve_file,
-                    args=(self.cds_product,
-                          cds_filter,
-                          os.path.join(storage_path, file_path),
-                          dry_run
-                    )
-                )
-                p.start()
-                all_processes.append(p)
+            # Chunks of a plan are materialised when they are handed to a worker
+            cds_filter = dict(cds_filter)
+            file_path = self._file_name(cds_filter)
+
+            exists = self._exists(storage_path, file_path, manifest)
+
+            # Results of other storage paths or layouts are linked from the cache
+            if not exists and not overwrite and not dry_run and self.result_cache is not None:
+                if self.result_cache.get(self.cds_product, cds_filter, os.path.join(storage_path, file_path),
+                                         params=self.grib_params):
+                    if self.index:
+                        index_download(os.path.join(storage_path, file_path), cds_filter)
+                    manifest.record(file_path, self.cds_product, cds_filter, self.split_keys,
+                                    file_path=os.path.join(storage_path, file_path))
+                    continue
+
+            if not exists or overwrite:
+                if not dry_run:
+                    self.metrics.emit(EVENT_PLANNED, file_path, self.cds_product)
+                yield (self.cds_product,
+                       cds_filter,
+                       os.path.join(storage_path, file_path),
+                       dry_run)
             else:
                 logging.info('File already exists and is not going to be requested from cds ' + file_path)
 
-        for p in all_processes:
-            p.join()
 
-        return all_processes
+    def _exists(self, storage_path, file_path, manifest):
+        # Files unknown to the manifest stem from collections without index
+        status = manifest.status(file_path)
+        if status is None:
+            return os.path.exists(os.path.join(storage_path, file_path))
+        return status == STATUS_DONE
+
+
+    def _plan_pages(self, storage_path, split_filter, manifest, overwrite, journal, page_size=1000):
+        # Chunks are journaled page by page before they are handed to the workers,
+        # the position in the plan continues an interrupted run
+        chunks = iter(split_filter)
+        while True:
+            page = list(itertools.islice(chunks, page_size))
+            tasks = list(self._iter_tasks(storage_path, page, manifest, overwrite))
+            journal.plan(((file_name, cds_filter) for _, cds_filter, file_name, _ in tasks),
+                         consumed=len(page), complete=len(page) < page_size)
+            for task in tasks:
+                yield task
+            if len(page) < page_size:
+                return
+
+
+    def _journal_tasks(self, storage_path, journal):
+        for chunk in journal.iter_chunks(pending=True):
+            yield (self.cds_product,
+                   chunk["cds_filter"],
+                   os.path.join(storage_path, chunk["file_name"]),
+                   False)
 
 
     def _full_time_filter_from_webapi(self, filter_names=["year", "month", "day", "time"]):
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+"""
+cds_queue.py:
+Reuse of pending and completed requests in the cds queue of the account
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import time
+import threading
+import logging
+
+import requests
+
+from .manifest import filter_hash
+
+
+# States of reusable requests in order of preference
+REUSABLE_STATES = ["completed", "running", "queued"]
+
+
+class RequestQueue(object):
+    """The :class:`RequestQueue` class lists the requests of the account at
+    the cds and matches them with new requests by product and canonical
+    filter (see :func:`cds_downloader.manifest.canonical_filter`).
+
+    A repeated run attaches to an already queued, running or completed
+    request instead of submitting the same request again. Every listed
+    request is handed out once. Failed requests are removed from the queue
+    if `delete_failed` is set.
+
+    The task list of the cds api is expected to contain the request_id, the
+    state, the product as 'resource' and the filter as 'request' of every
+    task. Tasks without product or filter are ignored.
+
+    """
+
+    def __init__(self, client, delete_failed=False):
+        """
+        Parameters
+        ----------
+        client : cdsapi.Client
+            authenticated cdsapi client
+        delete_failed : boolean, optional
+            delete failed requests of the product from the cds queue
+        """
+        self.client = client
+        self.delete_failed = delete_failed
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return sum(len(replies) for replies in self._jobs.values())
+
+
+    def tasks(self):
+        """List all tasks of the account, an empty list if the cds does not
+        provide the task list"""
+        client = self.client
+        try:
+            response = client.robust(client.session.get)(
+                '{}/tasks/'.format(client.url),
+                verify=client.verify,
+                timeout=client.timeout)
+            response.raise_for_status()
+            tasks = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.warning('Listing of the cds request queue failed: ' + repr(e))
+            return []
+        return tasks if isinstance(tasks, list) else []
+
+
+    def refresh(self, cds_product=None):
+        """Load the reusable requests from the cds queue
+
+        Parameters
+        ----------
+        cds_product : string, optional
+            only consider requests of this product
+
+        Returns
+        -------
+        self : RequestQueue
+        """
+        jobs = {}
+        for task in self.tasks():
+            product, cds_filter = task.get("resource"), task.get("request")
+            if product is None or not isinstance(cds_filter, dict):
+                continue
+            if cds_product is not None and product != cds_product:
+                continue
+
+            state = task.get("state")
+            if state == "failed" and self.delete_failed:
+                self.delete(task["request_id"])
+            elif state in REUSABLE_STATES:
+                jobs.setdefault(filter_hash(product, cds_filter), []).append(task)
+
+        for replies in jobs.values():
+            replies.sort(key=lambda reply: REUSABLE_STATES.index(reply["state"]))
+
+        with self._lock:
+            self._jobs = jobs
+        logging.info('Found {} reusable requests in the cds queue'.format(len(self)))
+        return self
+
+
+    def claim(self, cds_product, cds_filter):
+        """Take a matching request from the queue
+
+        Returns
+        -------
+        reply : dict or None
+            last known reply of the request, None if there is no match
+        """
+        with self._lock:
+            replies = self._jobs.get(filter_hash(cds_product, cds_filter))
+            if replies:
+                return replies.pop(0)
+        return None
+
+
+    def status(self, request_id):
+        """Current reply of a request"""
+        return request_status(self.client, request_id)
+
+
+    def delete(self, request_id):
+        """Delete a request from the cds queue"""
+        client = self.client
+        logging.info('Delete failed request {} from the cds queue'.format(request_id))
+        try:
+            response = client.robust(client.session.delete)(
+                '{}/tasks/{}'.format(client.url, request_id),
+                verify=client.verify,
+                timeout=client.timeout)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logging.warning('Deletion of request {} failed: {}'.format(request_id, repr(e)))
+
+
+    def wait(self, reply, sleep=1., on_state=None):
+        """Poll a claimed request until it is completed
+
+        The status is fetched at least once, hence the location of a completed
+        request is current.
+
+        Parameters
+        ----------
+        reply : dict
+            last known reply of the request
+        sleep : float, optional
+            initial interval in seconds between two status polls
+        on_state : callable, optional
+            called with the reply whenever the state of the request changes
+
+        Returns
+        -------
+        reply : dict
+            reply of the completed request
+        """
+        reply = wait_request(self.client, reply, sleep=sleep, on_state=on_state, refresh=True)
+        if reply.get("state") == "failed" and self.delete_failed:
+            self.delete(reply["request_id"])
+        return check_reply(reply)
+
+
+def submit_request(client, cds_product, cds_filter):
+    """Submit a request to the cds queue without waiting for it
+
+    Returns
+    -------
+    reply : dict
+        reply of the cds with request_id and state
+    """
+    response = client.robust(client.session.post)(
+        '{}/resources/{}'.format(client.url, cds_product),
+        json=cds_filter,
+        verify=client.verify,
+        timeout=client.timeout)
+    try:
+        reply = response.json()
+    except ValueError:
+        reply = {"message": response.text}
+    if response.status_code >= 400:
+        raise Exception(reply.get("message", response.reason))
+    return reply
+
+
+def request_status(client, request_id):
+    """Current reply of a request"""
+    response = client.robust(client.session.get)(
+        '{}/tasks/{}'.format(client.url, request_id),
+        verify=client.verify,
+        timeout=client.timeout)
+    response.raise_for_status()
+    return response.json()
+
+
+def wait_request(client, reply, sleep=1., on_state=None, refresh=False):
+    """Poll a request until it is neither queued nor running
+
+    Parameters
+    ----------
+    client : cdsapi.Client
+        authenticated cdsapi client
+    reply : dict
+        last known reply of the request
+    sleep : float, optional
+        initial interval in seconds between two status polls, it grows up to
+        client.sleep_max
+    on_state : callable, optional
+        called with the reply whenever the state of the request changes
+    refresh : boolean, optional
+        fetch the status at least once
+
+    Returns
+    -------
+    reply : dict
+        last reply of the request, see :func:`check_reply`
+    """
+    state = None
+    if refresh:
+        reply = request_status(client, reply["request_id"])
+    while True:
+        if reply.get("state") != state:
+            state = reply.get("state")
+            if on_state is not None:
+                on_state(reply)
+        if state not in ("queued", "running"):
+            return reply
+        time.sleep(sleep)
+        sleep = min(sleep * 1.5, client.sleep_max)
+        reply = request_status(client, reply["request_id"])
+
+
+def check_reply(reply):
+    """Return the reply of a completed request, raise for failed requests
+    and unknown states"""
+    if reply.get("state") == "completed":
+        return reply
+    if reply.get("state") == "failed":
+        error = reply.get("error", {})
+        raise Exception("{}. {}.".format(error.get("message"), error.get("reason")))
+    raise Exception("Unknown API state [{}]".format(reply.get("state")))
+
+
+def reattach_request(client, request_id):
+    """Current reply of a request submitted by an earlier run
+
+    Returns
+    -------
+    reply : dict or None
+        reply of a queued, running or completed request, None if the request
+        failed or is unknown to the cds, e.g. because it expired
+    """
+    try:
+        reply = request_status(client, request_id)
+    except requests.exceptions.HTTPError as e:
+        logging.warning('Request {} can not be reattached: {}'.format(request_id, repr(e)))
+        return None
+    if reply.get("state") not in REUSABLE_STATES:
+        logging.warning('Request {} can not be reattached, its state is {}'.format(
+            request_id, reply.get("state")))
+        return None
+    return reply
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+"""
+chunk_plan.py:
+Compact, lazily indexed plan of the chunks of a cds request
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+from collections.abc import Mapping, Sequence
+
+
+class ChunkPlan(Sequence):
+    """The :class:`ChunkPlan` class represents the chunks of a cds request as
+    the values of its split keys instead of a list of filters.
+
+    Chunk i is the i-th combination of the values of the split keys in
+    mixed-radix order (the last split key changes fastest, like
+    :func:`itertools.product`), hence the plan supports len(), O(1) random
+    access and slicing without materialising a single filter. A chunk is a
+    read-only :class:`Chunk` view of the base filter, ``dict(chunk)`` is its
+    cds filter.
+
+    A plan is small and cheap to pickle. Its chunks can be distributed with
+    :meth:`shard` and consumed with a :class:`PlanCursor`, whose position can
+    be saved and restored.
+
+    Examples
+    --------
+    >>> plan = ChunkPlan({"variable": "t", "year": ["2000", "2001"], "month": ["01", "02"]},
+    ...                  ["year", "month"])
+    >>> len(plan), dict(plan[1])
+    (4, {'variable': 't', 'year': '2000', 'month': '02'})
+    >>> [c["month"] for c in plan[::2]]
+    ['01', '01']
+
+    """
+
+    def __init__(self, cds_filter, split_keys, values=None, indices=None):
+        """
+        Parameters
+        ----------
+        cds_filter : dict
+            base cds filter, the split keys are replaced in every chunk
+        split_keys : list of strings
+            split keys of the plan
+        values : dict, optional
+            list of values of every split key, a value may be a group (list)
+            of filter values, defaults to the values of the filter, scalar
+            values are not split
+        indices : range, optional
+            positions of the plan in the full product of the values, see
+            :meth:`__getitem__`
+        """
+        if values is None:
+            values = {k: cds_filter[k] for k in split_keys if isinstance(cds_filter.get(k), list)}
+        self.cds_filter = cds_filter
+        # Keys with values vary between chunks, the others keep the base filter
+        self.split_keys = [k for k in split_keys if k in values]
+        self.values = {k: list(values[k]) for k in self.split_keys}
+        self.radices = [len(self.values[k]) for k in self.split_keys]
+
+        # Stride and radix of every split key, the last key changes fastest
+        self._digits = {}
+        size = 1
+        for k, radix in zip(self.split_keys[::-1], self.radices[::-1]):
+            self._digits[k] = (size, radix)
+            size *= radix
+        self.indices = range(size) if indices is None else indices
+        self._keys = list(cds_filter) + [k for k in self.split_keys if k not in cds_filter]
+
+
+    def __getstate__(self):
+        return self.to_dict()
+
+
+    def __setstate__(self, state):
+        self.__init__(state["cds_filter"], state["split_keys"], state["values"], range(*state["indices"]))
+
+
+    def __len__(self):
+        return len(self.indices)
+
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return ChunkPlan(self.cds_filter, self.split_keys, self.values, self.indices[item])
+        return Chunk(self, self.indices[item])
+
+
+    def __iter__(self):
+        return PlanCursor(self)
+
+
+    def __repr__(self):
+        return "ChunkPlan({} chunks of {})".format(len(self), self.split_keys)
+
+
+    def value(self, key, index):
+        """Value of a key in the chunk at index of the full product"""
+        digit = self._digits.get(key)
+        if digit is None:
+            return self.cds_filter[key]
+        stride, radix = digit
+        return self.values[key][index // stride % radix]
+
+
+    def shard(self, count, number):
+        """The number-th of count disjoint shards of the plan
+
+        The chunks are dealt round robin, hence every shard covers the whole
+        range of the plan.
+        """
+        if not 0 <= number < count:
+            raise ValueError("The shard number has to be between 0 and {}".format(count - 1))
+        return self[number::count]
+
+
+    def cursor(self, position=0):
+        """Iterator over the chunks of the plan starting at position, see
+        :class:`PlanCursor`"""
+        return PlanCursor(self, position)
+
+
+    def to_dict(self):
+        """json serialisable representation of the plan"""
+        return {"cds_filter": self.cds_filter, "split_keys": self.split_keys, "values": self.values,
+                "indices": [self.indices.start, self.indices.stop, self.indices.step]}
+
+
+    @classmethod
+    def from_dict(cls, dct):
+        """Restore a plan from :meth:`to_dict`"""
+        return cls(dct["cds_filter"], dct["split_keys"], dct["values"], range(*dct["indices"]))
+
+
+class Chunk(Mapping):
+    """Read-only view of the cds filter of a chunk of a :class:`ChunkPlan`"""
+
+    __slots__ = ("plan", "index")
+
+    def __init__(self, plan, index):
+        """
+        Parameters
+        ----------
+        plan : ChunkPlan
+            plan of the chunk
+        index : int
+            position of the chunk in the full product of the values
+        """
+        self.plan = plan
+        self.index = index
+
+
+    def __getitem__(self, key):
+        return self.plan.value(key, self.index)
+
+
+    def __iter__(self):
+        return iter(self.plan._keys)
+
+
+    def __len__(self):
+        return len(self.plan._keys)
+
+
+    def __repr__(self):
+        return "Chunk({!r})".format(dict(self))
+
+
+    def __reduce__(self):
+        # Workers receive the filter, not the whole plan
+        return dict, (dict(self),)
+
+
+class PlanCursor(object):
+    """Iterator over the chunks of a :class:`ChunkPlan` with a position,
+    which can be saved and restored (e.g. to continue a run)"""
+
+    __slots__ = ("plan", "position")
+
+    def __init__(self, plan, position=0):
+        """
+        Parameters
+        ----------
+        plan : ChunkPlan
+            plan of the chunks
+        position : int, optional
+            number of chunks already consumed
+        """
+        self.plan = plan
+        self.position = position
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        if self.position >= len(self.plan):
+            raise StopIteration
+        chunk = self.plan[self.position]
+        self.position += 1
+        return chunk
+
+
+    def remaining(self):
+        """Plan of the chunks, which are not consumed yet"""
+        return self.plan[self.position:]
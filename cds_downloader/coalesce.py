@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+"""
+coalesce.py:
+Union requests of the overlapping chunks of several configurations
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import os
+import json
+import shutil
+import logging
+
+from .manifest import filter_hash
+from .metrics import EVENT_DONE, EVENT_FAILED
+from .daily import GRIB_PARAMS
+from .grib_index import GribIndex, index_download, index_path
+from .integrity import expected_fields, verify_download
+
+
+# Modes of the jobs, whose chunks are coalesced
+COALESCE_MODES = ["download", "update"]
+
+
+def _as_list(value):
+    return value if isinstance(value, (list, tuple)) else [value]
+
+
+def coalesce_key(cds_product, cds_filter):
+    """Chunks with the same key differ at most in their variables, e.g. the
+    same product, product type, format, area, grid, dates and levels"""
+    return cds_product, json.dumps({k: v for k, v in cds_filter.items() if k != "variable"}, sort_keys=True)
+
+
+class UnionRequest(object):
+    """A union request of the chunks of several downloaders.
+
+    The request is a task of the downloader of its first chunk: its lease,
+    the reuse of a live request of the cds queue, its retries and events are
+    those of an ordinary chunk of this downloader. The result is downloaded
+    next to the first file, fanned out into the files of all chunks and
+    removed. The chunks are recorded by their own downloaders, i.e. in the
+    manifest and journal of their storage paths.
+    """
+
+    def __init__(self, cds_product, cds_filter, targets, params):
+        """
+        Parameters
+        ----------
+        cds_product : string
+            cds product of the request
+        cds_filter : dict
+            cds filter of the request, its variables are the union of the
+            variables of the chunks
+        targets : list of tuples
+            (downloader, task) of every chunk, see
+            :meth:`cds_downloader.Downloader._retrieve_chunk` for the task
+        params : dict
+            GRIB parameter of a variable name
+        """
+        self.cds_product = cds_product
+        self.cds_filter = cds_filter
+        self.targets = targets
+        self.params = params
+        self.downloader, (_, _, path, _) = targets[0]
+        self.file_name = os.path.join(os.path.dirname(path), ".coalesced_{}.{}".format(
+            filter_hash(cds_product, cds_filter), cds_filter.get("format", "grib")))
+
+
+    @property
+    def task(self):
+        """Task of the scheduler, the request takes the place of a downloader"""
+        return self, self.cds_product, self.cds_filter, self.file_name, False
+
+
+    def _retrieve_chunk(self, cds_product, cds_filter, file_name, dry_run=False):
+        # Requests leased by another host are skipped, their result is None
+        if self.downloader._retrieve_chunk(cds_product, cds_filter, file_name, dry_run) is None:
+            return None
+        self.downloader.checksums.pop(file_name, None)
+        try:
+            self._fan_out(file_name)
+        finally:
+            for name in (file_name, index_path(file_name)):
+                if os.path.exists(name):
+                    os.remove(name)
+        return file_name
+
+
+    def _fan_out(self, result):
+        union = set(_as_list(self.cds_filter.get("variable")))
+        index = None
+        for downloader, (_, target_filter, path, _) in self.targets:
+            variables = _as_list(target_filter.get("variable"))
+            path_temp = path + ".tmp"
+            if set(variables) == union:
+                shutil.copyfile(result, path_temp)
+            else:
+                index = index or GribIndex(result)
+                index.extract(path_temp, param=[self.params[v] for v in variables])
+            os.replace(path_temp, path)
+            if downloader.verify:
+                verify_download(path, target_filter)
+            if downloader.index:
+                index_download(path, target_filter)
+        logging.info('Fan out {} into {} files'.format(result, len(self.targets)))
+
+
+    def finish(self, runs, future):
+        """Record the chunks of a finished request
+
+        Parameters
+        ----------
+        runs : dict
+            state of the run of each downloader by its id, see
+            :meth:`cds_downloader.Downloader._open_run`
+        future : concurrent.futures.Future
+            finished future of the request
+
+        Returns
+        -------
+        members : list of tuples
+            (downloader, done) of every recorded chunk, chunks of a request
+            leased by another host are recorded by that host
+        """
+        error = future.exception()
+        if error is None and future.result() is None:
+            return []
+        # The request and its chunks are reported to the metrics, the chunks to the journals of their runs
+        if error is None:
+            self.downloader._emit(EVENT_DONE, self.file_name, self.cds_product)
+        else:
+            self.downloader._emit(EVENT_FAILED, self.file_name, self.cds_product, error=repr(error))
+        members = []
+        for downloader, (cds_product, cds_filter, path, _) in self.targets:
+            if error is None:
+                downloader._emit(EVENT_DONE, path, cds_product, bytes=os.path.getsize(path))
+            else:
+                downloader._emit(EVENT_FAILED, path, cds_product, error=repr(error))
+            downloader._record_file(runs[id(downloader)], cds_product, cds_filter, path, error is None)
+            members.append((downloader, error is None))
+        return members
+
+
+class Coalescer(object):
+    """The :class:`Coalescer` class requests the chunks, which several
+    configurations share, only once.
+
+    The missing chunks of all downloaders are grouped by
+    :func:`coalesce_key`. The chunks of a group are packed into union
+    requests, whose variables are the union of the variables of their chunks
+    and which stay below the selection limit of the product. The GRIB
+    messages of a union result are fanned out into the files of the chunks by
+    their parameter (see :data:`cds_downloader.daily.GRIB_PARAMS` and the
+    grib_params of the downloaders). A chunk with a variable of unknown
+    parameter only shares requests with chunks of the same variables, results
+    of other formats than GRIB are only shared by identical chunks.
+
+    The chunks are the tasks of the runs of the downloaders, hence they are
+    journaled and the union requests are run by the same scheduler as the
+    other chunks (see :class:`UnionRequest`). Chunks without a partner are
+    left to their downloaders.
+
+    Examples
+    --------
+    >>> coalescer = Coalescer([downloader_a, downloader_b])
+    >>> requests = coalescer.plan([(downloader_a, task) for task in tasks_a] +
+    ...                           [(downloader_b, task) for task in tasks_b])
+
+    """
+
+    def __init__(self, downloaders):
+        """
+        Parameters
+        ----------
+        downloaders : list of cds_downloader.Downloader
+            downloaders of the chunks, their grib_params extend
+            :data:`cds_downloader.daily.GRIB_PARAMS`
+        """
+        self.params = dict(GRIB_PARAMS)
+        for downloader in downloaders:
+            self.params.update(downloader.grib_params or {})
+
+
+    def _joins(self, variables, targets):
+        # Every file has to be separable from the union result
+        union = set(variables)
+        for downloader, (_, cds_filter, _, _) in targets:
+            own = set(_as_list(cds_filter.get("variable")))
+            if own == union:
+                continue
+            if cds_filter.get("format", "grib") != "grib" or not all(v in self.params for v in own):
+                return False
+        return True
+
+
+    def plan(self, targets):
+        """Union requests of the chunks, which are shared by the downloaders
+
+        Parameters
+        ----------
+        targets : iterable of tuples
+            (downloader, task) of the missing chunks, see
+            :meth:`cds_downloader.Downloader._retrieve_chunk` for the task
+
+        Returns
+        -------
+        requests : list of UnionRequest
+            union requests of the shared chunks, chunks without a partner
+            are left to their downloaders
+        """
+        groups = {}
+        for target in targets:
+            cds_product, cds_filter = target[1][:2]
+            groups.setdefault(coalesce_key(cds_product, cds_filter), []).append(target)
+
+        requests = []
+        for (cds_product, _), targets in groups.items():
+            limit = targets[0][0].cds_webapi["selection_limit"]
+            packed = []
+            for target in targets:
+                cds_filter = target[1][1]
+                for variables, members in packed:
+                    union = variables + [v for v in _as_list(cds_filter.get("variable")) if v not in variables]
+                    fields = expected_fields(dict(cds_filter, variable=union))
+                    if (union == variables or fields is not None and fields <= limit) and \
+                            self._joins(union, members + [target]):
+                        variables[:] = union
+                        members.append(target)
+                        break
+                else:
+                    packed.append((list(_as_list(cds_filter.get("variable"))), [target]))
+            for variables, members in packed:
+                # Chunks without a partner are left to their downloaders
+                if len(members) > 1:
+                    cds_filter = dict(members[0][1][1])
+                    if "variable" in cds_filter:
+                        cds_filter["variable"] = variables if len(variables) > 1 else variables[0]
+                    requests.append(UnionRequest(cds_product, cds_filter, members, self.params))
+        logging.info('{} files of several configurations in {} union requests'.format(
+            sum(len(r.targets) for r in requests), len(requests)))
+        return requests
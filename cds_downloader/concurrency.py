@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+"""
+concurrency.py:
+Adaptive limit of concurrent cds requests (AIMD)
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import re
+import time
+import threading
+import logging
+
+from .metrics import (EVENT_SUBMITTED, EVENT_RUNNING, EVENT_DOWNLOADING, EVENT_DONE, EVENT_FAILED,
+                      EVENT_RETRY, EVENT_CONCURRENCY)
+
+
+DEFAULT_MAX_LIMIT = 16
+DEFAULT_TARGET_WAIT = 300.
+
+# Errors of requests, which the cds rejected due to per user or queue limits
+REJECTION = re.compile(r"429|too many|temporarily limited|rejected", re.IGNORECASE)
+
+
+class AdaptiveLimit(object):
+    """The :class:`AdaptiveLimit` class adjusts the number of concurrent cds
+    requests with additive increase and multiplicative decrease (AIMD).
+
+    It is a sink of :class:`cds_downloader.metrics.Metrics` and observes the
+    events of every chunk:
+
+    - a queue wait (submitted until running) below `target_wait` seconds
+      increases the limit by `increase` per round of `limit` requests
+    - a queue wait above `target_wait`, a rejected request (e.g. HTTP 429)
+      or a drop of the transfer throughput below `throughput_drop` of the
+      best observed throughput multiplies the limit by `decrease`
+
+    Decreases within `cooldown` seconds of the last decrease are ignored,
+    because the requests in flight still stem from the previous limit. Every
+    change is reported as 'concurrency' event to the metrics.
+
+    """
+
+    def __init__(self, max_limit=DEFAULT_MAX_LIMIT, min_limit=1, initial=None,
+                 target_wait=DEFAULT_TARGET_WAIT, increase=1., decrease=0.5,
+                 throughput_drop=0.5, cooldown=60., metrics=None):
+        """
+        Parameters
+        ----------
+        max_limit : int, optional
+            upper bound of concurrent requests
+        min_limit : int, optional
+            lower bound of concurrent requests
+        initial : int, optional
+            initial limit, defaults to the mean of min_limit and max_limit
+        target_wait : float, optional
+            acceptable wait of a request in the cds queue in seconds
+        increase : float, optional
+            additive increase per round of requests
+        decrease : float, optional
+            multiplicative decrease factor between 0 and 1
+        throughput_drop : float, optional
+            fraction of the best transfer throughput, which counts as
+            congestion, None ignores the throughput
+        cooldown : float, optional
+            minimum seconds between two decreases
+        metrics : cds_downloader.metrics.Metrics, optional
+            receiver of the 'concurrency' events
+        """
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError("The limits have to satisfy 1 <= min_limit <= max_limit")
+        if not 0 < decrease < 1:
+            raise ValueError("The parameter decrease has to be between 0 and 1")
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.target_wait = target_wait
+        self.increase = increase
+        self.decrease = decrease
+        self.throughput_drop = throughput_drop
+        self.cooldown = cooldown
+        self.metrics = metrics
+
+        self._limit = float(initial or (min_limit + max_limit) // 2)
+        self._limit = min(max(self._limit, min_limit), max_limit)
+        self._submitted = {}
+        self._throughput = None
+        self._best_throughput = None
+        self._last_decrease = None
+        self._lock = threading.Lock()
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["metrics"] = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    @property
+    def value(self):
+        """Current number of allowed concurrent requests"""
+        return int(self._limit)
+
+
+    def __call__(self, record):
+        event = record.get("event")
+        file_name = record.get("file_name")
+        if event == EVENT_SUBMITTED:
+            with self._lock:
+                self._submitted[file_name] = record["time"]
+        elif event in (EVENT_RUNNING, EVENT_DOWNLOADING):
+            with self._lock:
+                submitted = self._submitted.pop(file_name, None)
+            if submitted is not None:
+                self.observe_wait(record["time"] - submitted)
+        elif event == EVENT_DONE:
+            if record.get("throughput"):
+                self.observe_throughput(record["throughput"])
+        elif event in (EVENT_FAILED, EVENT_RETRY):
+            with self._lock:
+                self._submitted.pop(file_name, None)
+            if REJECTION.search(str(record.get("error", ""))):
+                self.observe_rejection()
+
+
+    def observe_wait(self, seconds):
+        """A request left the cds queue after seconds"""
+        if seconds > self.target_wait:
+            self._decrease("queue wait {:.0f}s".format(seconds))
+        else:
+            self._increase("queue wait {:.0f}s".format(seconds))
+
+
+    def observe_rejection(self):
+        """The cds rejected a request"""
+        self._decrease("rejected request")
+
+
+    def observe_throughput(self, throughput):
+        """A transfer finished with throughput in bytes per second"""
+        if self.throughput_drop is None:
+            return
+        with self._lock:
+            # Exponentially weighted mean of the transfer throughput
+            self._throughput = throughput if self._throughput is None else \
+                0.7 * self._throughput + 0.3 * throughput
+            self._best_throughput = max(self._best_throughput or 0., self._throughput)
+            congested = self._throughput < self.throughput_drop * self._best_throughput
+        if congested:
+            self._decrease("throughput {:.0f} B/s".format(self._throughput))
+
+
+    def _increase(self, reason):
+        with self._lock:
+            old = self.value
+            self._limit = min(self._limit + self.increase / self._limit, self.max_limit)
+            changed = self.value != old
+        if changed:
+            self._report(reason)
+
+
+    def _decrease(self, reason):
+        now = time.time()
+        with self._lock:
+            if self._last_decrease is not None and now - self._last_decrease < self.cooldown:
+                return
+            old = self.value
+            self._limit = max(self._limit * self.decrease, self.min_limit)
+            self._last_decrease = now
+            # The throughput at the lower limit is measured again
+            self._best_throughput = self._throughput
+            changed = self.value != old
+        if changed:
+            self._report(reason)
+
+
+    def _report(self, reason):
+        logging.info('Concurrency limit {} ({})'.format(self.value, reason))
+        if self.metrics is not None:
+            self.metrics.report(EVENT_CONCURRENCY, limit=self.value, min_limit=self.min_limit,
+                                max_limit=self.max_limit, reason=reason)
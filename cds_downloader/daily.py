@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""
+daily.py:
+Batched requests of the daily mode and their split into per-variable, per-day files
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import os
+import logging
+
+from .planner import Planner
+from .grib_index import GribIndex
+from .integrity import expected_fields, verify_download
+
+
+DAILY_SPLIT_KEYS = ["variable", "year", "month", "day"]
+
+# GRIB1 parameters ('number.table') of the cds variable names of ERA5 and ERA5-Land
+GRIB_PARAMS = {
+    "geopotential": "129.128",
+    "temperature": "130.128",
+    "u_component_of_wind": "131.128",
+    "v_component_of_wind": "132.128",
+    "specific_humidity": "133.128",
+    "surface_pressure": "134.128",
+    "vertical_velocity": "135.128",
+    "snowfall": "144.128",
+    "mean_sea_level_pressure": "151.128",
+    "relative_humidity": "157.128",
+    "total_cloud_cover": "164.128",
+    "10m_u_component_of_wind": "165.128",
+    "10m_v_component_of_wind": "166.128",
+    "2m_temperature": "167.128",
+    "2m_dewpoint_temperature": "168.128",
+    "surface_solar_radiation_downwards": "169.128",
+    "surface_net_solar_radiation": "176.128",
+    "surface_net_thermal_radiation": "177.128",
+    "evaporation": "182.128",
+    "runoff": "205.128",
+    "total_precipitation": "228.128",
+    "skin_temperature": "235.128",
+    "potential_evaporation": "251.228",
+}
+
+
+def _as_list(value):
+    return value if isinstance(value, (list, tuple)) else [value]
+
+
+def _consecutive(date, other):
+    return (other - date).days == 1 and other.month == date.month
+
+
+class DailyBatcher(object):
+    """The :class:`DailyBatcher` class combines the missing days and
+    variables of the daily mode into few requests below the selection limit
+    and splits their results back into one file per variable and day.
+
+    A request of the cds is the product of its value lists, hence only runs
+    of consecutive days of the same month with the same missing variables are
+    combined. The GRIB messages of a result are assigned to the variables by
+    their parameter (see :data:`GRIB_PARAMS`) and to the days by their valid
+    time, read from the sidecar index of the result. Variables with an
+    unknown parameter are requested one by one, results of other formats
+    than GRIB are never combined.
+
+    Examples
+    --------
+    >>> batcher = DailyBatcher(120000)
+    >>> batches = batcher.plan(cds_filter, [("2m_temperature", date), ("total_precipitation", date)])
+    >>> batcher.split("2m_temperature-total_precipitation_2020_1_1-7_reanalysis-era5-single-levels.grib",
+    ...               batches[0], file_name)
+
+    """
+
+    def __init__(self, selection_limit, params=None):
+        """
+        Parameters
+        ----------
+        selection_limit : int
+            maximum number of fields of a single request
+        params : dict, optional
+            GRIB parameter of a variable name, extends :data:`GRIB_PARAMS`
+        """
+        self.selection_limit = selection_limit
+        self.params = dict(GRIB_PARAMS, **(params or {}))
+
+
+    def plan(self, cds_filter, missing):
+        """Combine missing variables and days into requests
+
+        Parameters
+        ----------
+        cds_filter : dict
+            cds filter of a day, its variable, year, month and day are
+            replaced in the requests
+        missing : list of tuples
+            (variable, datetime.date) of every missing file in order of the
+            dates
+
+        Returns
+        -------
+        batches : list of dicts
+            cds filters of the requests, variable and day are lists if a
+            request covers more than one file
+        """
+        by_date = {}
+        for variable, date in missing:
+            by_date.setdefault(date, []).append(variable)
+
+        runs = []
+        for date in sorted(by_date):
+            if runs and _consecutive(runs[-1][0][-1], date) and runs[-1][1] == by_date[date]:
+                runs[-1][0].append(date)
+            else:
+                runs.append(([date], by_date[date]))
+
+        batches = []
+        for dates, variables in runs:
+            run_filter = dict(cds_filter, year=str(dates[0].year), month=str(dates[0].month),
+                              day=[str(d.day) for d in dates])
+            if cds_filter.get("format", "grib") != "grib":
+                batches.extend(dict(run_filter, variable=v, day=str(d.day)) for d in dates for v in variables)
+                continue
+            known = [v for v in variables if v in self.params]
+            groups = ([known] if known else []) + [[v] for v in variables if v not in self.params]
+            for group in groups:
+                batches.extend(self._limit(dict(run_filter, variable=group)))
+        logging.info('{} missing files of the daily mode in {} requests'.format(len(missing), len(batches)))
+        return batches
+
+
+    def _limit(self, batch):
+        # Split variables and days of a batch below the selection limit, a file is never split
+        per_file = expected_fields(dict(batch, variable=batch["variable"][0], day=batch["day"][0])) or 1
+        planner = Planner(max(1, self.selection_limit // per_file),
+                          exclude_keys=[k for k in batch if k not in ("variable", "day")])
+        split_keys, groups = planner.plan(batch)
+        for chunk in planner.expand(batch, split_keys, groups):
+            chunk = dict(chunk)
+            yield {k: (v[0] if k in ("variable", "day") and isinstance(v, list) and len(v) == 1 else v)
+                   for k, v in chunk.items()}
+
+
+    @staticmethod
+    def is_batch(cds_filter):
+        """True if a request covers more than one file"""
+        return any(isinstance(cds_filter.get(k), list) for k in DAILY_SPLIT_KEYS)
+
+
+    @staticmethod
+    def members(cds_filter):
+        """cds filters of the files of a request, one per variable and day"""
+        for variable in _as_list(cds_filter["variable"]):
+            for day in _as_list(cds_filter["day"]):
+                yield dict(cds_filter, variable=variable, day=day)
+
+
+    def split(self, path, cds_filter, file_name):
+        """Split the result of a combined request into its files
+
+        Parameters
+        ----------
+        path : string
+            path of the GRIB result
+        cds_filter : dict
+            cds filter of the request
+        file_name : callable
+            file name of the cds filter of a file
+
+        Returns
+        -------
+        members : list of tuples
+            (path, cds filter) of every file, written next to the result
+
+        Raises
+        ------
+        cds_downloader.integrity.IntegrityError
+            if the messages of a file do not match its filter
+        """
+        index = GribIndex(path)
+        single = len(_as_list(cds_filter["variable"])) == 1
+        members = []
+        for member in self.members(cds_filter):
+            day = "{:04d}-{:02d}-{:02d}".format(int(member["year"]), int(member["month"]), int(member["day"]))
+            criteria = {} if single else {"param": self.params[member["variable"]]}
+            criteria["valid_time"] = sorted({m["valid_time"] for m in index.select(**criteria)
+                                             if (m["valid_time"] or "").startswith(day)})
+            target = os.path.join(os.path.dirname(path), file_name(member))
+            index.extract(target, **criteria)
+            verify_download(target, member)
+            members.append((target, member))
+        logging.info('Split {} into {} files'.format(path, len(members)))
+        return members
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+"""
+engine.py:
+Asynchronous submit/poll/download engine for cds requests
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .transfer import download_result, resume_result
+from .integrity import Checksum, verify_download
+from .grib_index import index_download
+from .cds_queue import submit_request, request_status, check_reply, reattach_request
+from .metrics import EVENT_SUBMITTED, EVENT_DOWNLOADING, EVENT_RETRY
+from .scheduler import backoff_delay
+
+
+DEFAULT_MAX_REQUESTS = 32
+DEFAULT_DOWNLOAD_WORKERS = 2
+
+
+class AsyncEngine(object):
+    """The :class:`AsyncEngine` class decouples the cds request queue from the
+    data transfer.
+
+    All requests are submitted up front (bounded by `max_requests`) and their
+    states are polled from a single event loop. As soon as a request is
+    completed, its result is handed over to a separate, smaller pool of
+    `download_workers`, hence local resources are only spent on the transfer
+    and queue latencies of different requests overlap.
+
+    """
+
+    def __init__(self, client, max_requests=None, download_workers=None,
+                 poll_interval=1., poll_interval_max=None, download_segments=1,
+                 request_queue=None, verify=True, index=True, metrics=None, limit=None,
+                 journal=None, retries=0, retry_backoff=60., postprocess=None):
+        """
+        Parameters
+        ----------
+        client : cdsapi.Client
+            authenticated cdsapi client, its session is used for all calls
+        max_requests : int, optional
+            maximum number of requests submitted to cds at the same time
+        download_workers : int, optional
+            number of concurrent downloads of finished requests
+        poll_interval : float, optional
+            initial interval in seconds between two status polls of a request
+        poll_interval_max : float, optional
+            upper bound of the growing poll interval, defaults to
+            client.sleep_max
+        download_segments : int, optional
+            maximum number of parallel connections of a single download
+        request_queue : cds_downloader.cds_queue.RequestQueue, optional
+            requests of the cds queue, matching requests are reused instead
+            of submitting them again
+        verify : boolean, optional
+            verify the structure of every download, see
+            :func:`cds_downloader.integrity.verify_download`
+        index : boolean, optional
+            write the message index of every GRIB download, see
+            :class:`cds_downloader.grib_index.GribIndex`
+        metrics : cds_downloader.metrics.Metrics, optional
+            receiver of the events of every chunk
+        limit : cds_downloader.concurrency.AdaptiveLimit, optional
+            adaptive number of submitted requests, bounded by max_requests
+        journal : cds_downloader.journal.Journal, optional
+            journal of the run, receives the events of every chunk and
+            requests of a resumed run are reattached by their request id
+        retries : int, optional
+            number of retries of a failed chunk
+        retry_backoff : float, optional
+            base delay of the retries in seconds, see
+            :func:`cds_downloader.scheduler.backoff_delay`
+        postprocess : callable, optional
+            called with file name and cds filter of every verified download,
+            e.g. to split the result of a combined request
+        """
+        self.client = client
+        self.max_requests = max_requests or DEFAULT_MAX_REQUESTS
+        self.download_workers = download_workers or DEFAULT_DOWNLOAD_WORKERS
+        self.poll_interval = poll_interval
+        self.poll_interval_max = poll_interval_max or client.sleep_max
+        self.download_segments = download_segments
+        self.request_queue = request_queue
+        self.verify = verify
+        self.index = index
+        self.metrics = metrics
+        self.limit = limit
+        self.journal = journal
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.postprocess = postprocess
+        # Streamed checksums of the downloaded files
+        self.checksums = {}
+
+        if self.max_requests < 1 or self.download_workers < 1:
+            raise ValueError("max_requests and download_workers have to be positive integers")
+
+
+    def run(self, tasks):
+        """Submit, poll and download all tasks.
+
+        Parameters
+        ----------
+        tasks : iterable of tuples
+            (cds_product, cds_filter, file_name, dry_run) for each request, the
+            iterable is consumed lazily
+
+        Returns
+        -------
+        futures : list of asyncio.Future
+            Finished tasks in order of completion, the result of each future
+            is the downloaded file name and its arguments are available as
+            future.task
+        """
+        return asyncio.run(self._run(tasks))
+
+
+    def in_flight_limit(self):
+        """Current maximum number of submitted requests"""
+        if self.limit is None:
+            return self.max_requests
+        return max(min(self.limit.value, self.max_requests), 1)
+
+
+    async def _run(self, tasks):
+        finished = []
+        in_flight = [0]
+        slot_freed = asyncio.Event()
+        # Short blocking http calls (submit, poll) and long transfers use separate pools
+        http_executor = ThreadPoolExecutor(max_workers=self.max_requests)
+        download_executor = ThreadPoolExecutor(max_workers=self.download_workers)
+
+        def _done(future):
+            in_flight[0] -= 1
+            slot_freed.set()
+            if future.exception() is not None:
+                logging.error('Download task failed: ' + repr(future.exception()))
+            finished.append(future)
+
+        try:
+            running = []
+            for args in tasks:
+                while in_flight[0] >= self.in_flight_limit():
+                    slot_freed.clear()
+                    await slot_freed.wait()
+                in_flight[0] += 1
+                future = asyncio.ensure_future(
+                    self._process_chunk(http_executor, download_executor, *args))
+                future.task = args
+                future.add_done_callback(_done)
+                running.append(future)
+
+            if running:
+                await asyncio.wait(running)
+            # Let pending done callbacks run
+            await asyncio.sleep(0)
+        finally:
+            http_executor.shutdown(wait=True)
+            download_executor.shutdown(wait=True)
+
+        return finished
+
+
+    async def _call(self, executor, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, partial(fn, *args, **kwargs))
+
+
+    async def _process_chunk(self, http_executor, download_executor, cds_product, cds_filter,
+                             file_name, dry_run=False):
+        # Failed attempts are retried with backoff, the slot of the chunk is kept meanwhile
+        attempt = 0
+        while True:
+            try:
+                return await self._process(http_executor, download_executor, cds_product, cds_filter,
+                                           file_name, dry_run)
+            except Exception as e:
+                if dry_run or attempt >= self.retries:
+                    raise
+                delay = backoff_delay(attempt, self.retry_backoff)
+                logging.warning('Attempt {} of {} failed, retry in {:.0f} seconds: {}'.format(
+                    attempt + 1, file_name, delay, repr(e)))
+                self._emit(EVENT_RETRY, file_name, cds_product, error=repr(e))
+                await asyncio.sleep(delay)
+                attempt += 1
+
+
+    async def _process(self, http_executor, download_executor, cds_product, cds_filter,
+                       file_name, dry_run=False):
+        if dry_run:
+            logging.info('Dry run, therefore no download process started for file ' + file_name)
+            return file_name
+
+        checksum = Checksum()
+        on_retry = None
+        if self.metrics is not None:
+            on_retry = partial(self.metrics.retry, file_name)
+        # Continue the transfer of a crashed run instead of a new request
+        if await self._call(download_executor, resume_result, self.client, file_name,
+                            segments=self.download_segments, checksum=checksum, on_retry=on_retry):
+            logging.info('Resumed download process ' + file_name)
+        else:
+            reply = None
+            # Requests of a resumed run are reattached by their request id
+            request_id = self.journal.request_id(file_name) if self.journal is not None else None
+            if request_id is not None:
+                reply = await self._call(http_executor, reattach_request, self.client, request_id)
+                if reply is not None:
+                    logging.info('Reattach to request {} for file {}'.format(request_id, file_name))
+            if reply is None and self.request_queue is not None:
+                reply = self.request_queue.claim(cds_product, cds_filter)
+                if reply is not None:
+                    logging.info('Attach to request {} for file {}'.format(reply.get('request_id'), file_name))
+            if reply is None:
+                reply = await self._call(http_executor, self._submit, cds_product, cds_filter)
+                logging.info('Submitted request {} for file {}'.format(reply.get('request_id'), file_name))
+            self._emit(EVENT_SUBMITTED, file_name, cds_product, request_id=reply.get('request_id'))
+
+            reply = await self._poll(http_executor, reply,
+                                     partial(self._on_state, file_name, cds_product))
+
+            logging.info('Start download process ' + file_name)
+            self._emit(EVENT_DOWNLOADING, file_name, cds_product)
+            await self._call(download_executor, self._download, reply, file_name, checksum, on_retry)
+            logging.info('Finish download process ' + file_name)
+
+        if self.verify:
+            await self._call(download_executor, verify_download, file_name, cds_filter)
+        if self.index:
+            await self._call(download_executor, index_download, file_name, cds_filter)
+        if self.postprocess is not None:
+            await self._call(download_executor, self.postprocess, file_name, cds_filter)
+        self.checksums[file_name] = checksum.hexdigest()
+        return file_name
+
+
+    def _emit(self, event, file_name, cds_product, **fields):
+        if self.metrics is not None:
+            self.metrics.emit(event, file_name, cds_product, **fields)
+        if self.journal is not None:
+            self.journal.record(event, file_name, request_id=fields.get('request_id'),
+                                error=fields.get('error'))
+
+
+    def _on_state(self, file_name, cds_product, reply):
+        if reply.get('state') in ('queued', 'running'):
+            self._emit(reply['state'], file_name, cds_product, request_id=reply.get('request_id'))
+
+
+    def _submit(self, cds_product, cds_filter):
+        return submit_request(self.client, cds_product, cds_filter)
+
+
+    def _status(self, request_id):
+        return request_status(self.client, request_id)
+
+
+    async def _poll(self, http_executor, reply, on_state=None):
+        sleep = self.poll_interval
+        state = None
+        while True:
+            if reply.get('state') != state:
+                state = reply.get('state')
+                if on_state is not None:
+                    on_state(reply)
+
+            if state in ('queued', 'running'):
+                await asyncio.sleep(sleep)
+                sleep = min(sleep * 1.5, self.poll_interval_max)
+                reply = await self._call(http_executor, self._status, reply['request_id'])
+                continue
+
+            return check_reply(reply)
+
+
+    def _download(self, reply, file_name, checksum=None, on_retry=None):
+        return download_result(self.client, reply, file_name, segments=self.download_segments,
+                               checksum=checksum, on_retry=on_retry)
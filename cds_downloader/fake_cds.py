@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+"""
+fake_cds.py:
+Minimal local stand-in for the cds web api used in tests and benchmarks
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import calendar
+import datetime
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .integrity import expected_fields
+
+
+WEBAPI = {
+    "selection_limit": 120000,
+    "form": [
+        {"name": "year", "details": {"values": [str(y) for y in range(1979, 2031)]}},
+        {"name": "month", "details": {"values": [str(m).zfill(2) for m in range(1, 13)]}},
+        {"name": "day", "details": {"values": [str(d).zfill(2) for d in range(1, 32)]}},
+        {"name": "time", "details": {"values": ["{:02d}:00".format(h) for h in range(24)]}},
+    ]
+}
+
+
+class FakeCDS(object):
+    """Threaded http server with the cds endpoints for resources metadata,
+    request submission, task status and result download.
+
+    Every request stays `queued_polls` status polls and at least
+    `queue_delay` seconds in state 'queued' and afterwards `running_polls`
+    polls in state 'running' before it is completed. The result of each
+    request is a GRIB skeleton with one message per field of the request and
+    at least `result_size` bytes long. The parameter number of a field is the
+    position of its variable in the request unless `params` maps the variable
+    to a number. Every transfer is throttled to
+    `bandwidth` bytes per second. Results support Range requests if
+    `range_support` is set, the first `interruptions` downloads are aborted
+    after half of the bytes.
+    """
+
+    def __init__(self, queued_polls=1, running_polls=1, result_size=1024, webapi=None,
+                 range_support=True, interruptions=0, queue_delay=0., bandwidth=None):
+        self.queue_delay = queue_delay
+        self.bandwidth = bandwidth
+        self.queued_polls = queued_polls
+        self.running_polls = running_polls
+        self.result_size = result_size
+        self.webapi = webapi or WEBAPI
+        self.range_support = range_support
+        self.interruptions = interruptions
+        self.params = {}
+        self.downloads = []
+        self.bytes_sent = 0
+
+        self.tasks = {}
+        self.submitted = []
+        self.metadata_requests = []
+        self.connections = 0
+        self.deleted = []
+        self.lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(self))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    @property
+    def api_url(self):
+        return self.url + "/api/v2"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def submit(self, product, request):
+        request_id = uuid.uuid4().hex
+        with self.lock:
+            self.tasks[request_id] = {"product": product, "request": request, "polls": 0,
+                                      "state": "queued", "submitted": time.time()}
+            self.submitted.append((product, request))
+        return self.reply(request_id)
+
+    def poll(self, request_id):
+        with self.lock:
+            task = self.tasks[request_id]
+            task["polls"] += 1
+            if time.time() - task.get("submitted", 0) < self.queue_delay:
+                task["polls"] = min(task["polls"], self.queued_polls)
+            elif task["polls"] > self.queued_polls + self.running_polls:
+                task["state"] = "completed"
+            elif task["polls"] > self.queued_polls:
+                task["state"] = "running"
+        return self.reply(request_id)
+
+    def reply(self, request_id):
+        task = self.tasks[request_id]
+        reply = {"request_id": request_id, "state": task["state"]}
+        if task["state"] == "completed":
+            reply.update({"location": "/download/{}.grib".format(request_id),
+                          "content_length": self.content_length(request_id),
+                          "content_type": "application/x-grib"})
+        elif task["state"] == "failed":
+            reply["error"] = {"message": "the request you have submitted is not valid",
+                              "reason": "fake failure"}
+        return reply
+
+    def list_tasks(self):
+        with self.lock:
+            return [dict(self.reply(request_id), resource=task["product"], request=task["request"])
+                    for request_id, task in self.tasks.items()]
+
+    def fields(self, request_id):
+        """(param number, level, valid time) of every field of a request"""
+        request = self.tasks[request_id]["request"]
+        variables = _values(request, "variable", [None])
+        levels = [int(level) for level in _values(request, "pressure_level", [0])]
+        dates = [datetime.date(int(y), int(m), int(d))
+                 for y in _values(request, "year", ["2000"])
+                 for m in _values(request, "month", ["01"])
+                 for d in _values(request, "day", ["01"])
+                 if int(d) <= calendar.monthrange(int(y), int(m))[1]]
+        times = [int(t.split(":")[0]) for t in _values(request, "time", ["00:00"])]
+        fields = [(self.params.get(variable, i), level, datetime.datetime(date.year, date.month, date.day, hour))
+                  for date in dates for hour in times
+                  for i, variable in enumerate(variables) for level in levels]
+        count = expected_fields(request) or 1
+        return list(itertools.islice(itertools.cycle(fields), count))
+
+    def content_length(self, request_id):
+        # Results grow if result_size is too small for all fields
+        return max(self.result_size, GRIB_HEADER_SIZE * len(self.fields(request_id)))
+
+    def content(self, request_id):
+        return grib_messages(self.fields(request_id), self.content_length(request_id))
+
+
+def _values(request, key, default):
+    value = request.get(key, default)
+    return value if isinstance(value, list) else [value]
+
+
+_PATTERN = bytes(bytearray(range(256)))
+
+# Indicator, identification, product definition and data section headers and end marker
+GRIB_HEADER_SIZE = 16 + 21 + 34 + 5 + 4
+
+
+def grib_messages(fields, size):
+    """GRIB edition 2 messages of the given (param number, level, valid time)
+    fields with a total of `size` bytes, the data sections are filled up"""
+    data = bytearray()
+    for i, (param, level, valid_time) in enumerate(fields):
+        length = size * (i + 1) // len(fields) - size * i // len(fields)
+        data += b"GRIB\x00\x00\x00\x02" + length.to_bytes(8, "big")
+        data += (21).to_bytes(4, "big") + b"\x01" + (98).to_bytes(2, "big") + b"\x00\x00\x02\x00\x01"
+        data += valid_time.year.to_bytes(2, "big") + bytes(bytearray(
+            [valid_time.month, valid_time.day, valid_time.hour, 0, 0, 0, 0]))
+        data += (34).to_bytes(4, "big") + b"\x04" + b"\x00\x00" + b"\x00\x00"
+        data += bytes(bytearray([0, param, 2, 0, 0, 0, 0, 0, 1])) + (0).to_bytes(4, "big")
+        data += bytes(bytearray([100 if level else 1, 0])) + (level * 100).to_bytes(4, "big")
+        data += b"\xff\x00" + (0).to_bytes(4, "big")
+        payload = length - GRIB_HEADER_SIZE
+        data += (payload + 5).to_bytes(4, "big") + b"\x07"
+        start = len(data) % 256
+        data += (_PATTERN * (payload // 256 + 2))[start:start + payload]
+        data += b"7777"
+    return bytes(data)
+
+
+def _make_handler(fake):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        # Keep-alive connections
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            with fake.lock:
+                fake.connections += 1
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, obj, status=200):
+            body = json.dumps(obj).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            match = re.match(r"^/api/v2\.ui/resources/([^/]+)$", self.path)
+            if match:
+                etag = '"{}"'.format(hash(json.dumps(fake.webapi, sort_keys=True)))
+                fake.metadata_requests.append(match.group(1))
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                body = json.dumps(fake.webapi).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            if self.path == "/api/v2/status.json":
+                return self._send_json({})
+
+            if self.path == "/api/v2/tasks/":
+                return self._send_json(fake.list_tasks())
+
+            match = re.match(r"^/api/v2/tasks/([0-9a-f]+)$", self.path)
+            if match and match.group(1) in fake.tasks:
+                return self._send_json(fake.poll(match.group(1)))
+
+            match = re.match(r"^/download/([0-9a-f]+)\.grib$", self.path)
+            if match and match.group(1) in fake.tasks:
+                return self._send_content(fake.content(match.group(1)))
+
+            self._send_json({"message": "not found"}, status=404)
+
+        def _send_content(self, body):
+            total = len(body)
+            start, end = 0, total - 1
+            match = re.match(r"^bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+            if match and fake.range_support:
+                start = int(match.group(1))
+                end = min(int(match.group(2)), total - 1) if match.group(2) else total - 1
+                if start >= total:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */{}".format(total))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, total))
+            else:
+                self.send_response(200)
+            if fake.range_support:
+                self.send_header("Accept-Ranges", "bytes")
+            fake.downloads.append((self.path, start))
+
+            body = body[start:end + 1]
+            self.send_header("Content-Type", "application/x-grib")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+
+            with fake.lock:
+                interrupt = fake.interruptions > 0
+                fake.interruptions -= 1 if interrupt else 0
+            if interrupt:
+                self._write(body[:len(body) // 2])
+                self.wfile.flush()
+                self.close_connection = True
+                return
+            self._write(body)
+
+        def _write(self, body, block_size=1 << 16):
+            for start in range(0, len(body), block_size):
+                block = body[start:start + block_size]
+                self.wfile.write(block)
+                with fake.lock:
+                    fake.bytes_sent += len(block)
+                if fake.bandwidth:
+                    time.sleep(len(block) / float(fake.bandwidth))
+
+        def do_DELETE(self):
+            match = re.match(r"^/api/v2/tasks/([0-9a-f]+)$", self.path)
+            if match and fake.tasks.pop(match.group(1), None) is not None:
+                fake.deleted.append(match.group(1))
+                return self._send_json({})
+            self._send_json({"message": "not found"}, status=404)
+
+        def do_POST(self):
+            match = re.match(r"^/api/v2/resources/([^/]+)$", self.path)
+            if not match:
+                return self._send_json({"message": "not found"}, status=404)
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            self._send_json(fake.submit(match.group(1), request), status=202)
+
+    return Handler
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+"""
+gaps.py:
+Detection of missing chunks in a data collection
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import datetime
+import itertools
+import operator
+
+from collections import namedtuple
+
+
+TEMPORAL_KEYS = ["year", "month", "day", "time"]
+
+
+MissingRange = namedtuple("MissingRange", ["fixed", "start", "end", "count"])
+MissingRange.__doc__ = """Consecutive missing chunks with the same non temporal split key values
+
+fixed : dict
+    values of the non temporal split keys
+start, end : dict
+    first and last missing values of the temporal split keys (inclusive)
+count : int
+    number of missing chunks in the range
+"""
+
+
+class GapDetector(object):
+    """The :class:`GapDetector` class finds missing chunks of a data collection
+    split by temporal and non temporal keys.
+
+    Temporal split keys have to form a chain of ["year", "month", "day",
+    "time"] (e.g. year and month, but not year and day). Every chunk is mapped
+    to an integer position on the time axis of the finest temporal split key
+    (year, month, day ordinal or hour), thus missing chunks are the gaps in the
+    sorted set of existing positions. Impossible dates such as Feb 30 do not
+    have a position and are never requested.
+
+    """
+
+    def __init__(self, split_keys, candidates):
+        """
+        Parameters
+        ----------
+        split_keys : list of strings
+            split keys of the data collection
+        candidates : dict
+            possible values of each split key (e.g. cds_filter combined with
+            the temporal filter of the webapi)
+        """
+        self.split_keys = list(split_keys)
+        self.temporal_keys = [k for k in TEMPORAL_KEYS if k in self.split_keys]
+        self.fixed_keys = [k for k in self.split_keys if k not in TEMPORAL_KEYS]
+
+        if self.temporal_keys != TEMPORAL_KEYS[:len(self.temporal_keys)]:
+            raise ValueError("Temporal split keys have to be a chain of {}, got {}".format(
+                TEMPORAL_KEYS, self.temporal_keys))
+
+        def _as_list(value):
+            return value if isinstance(value, (list, tuple)) else [value]
+
+        self.fixed_values = [[str(v) for v in _as_list(candidates[k])] for k in self.fixed_keys]
+
+        # Map integer value to the candidate string, e.g. 1 -> "01"
+        self._values = {}
+        for k in self.temporal_keys:
+            self._values[k] = {self._parse(k, v): str(v) for v in _as_list(candidates[k])}
+
+        self._memo = {}
+        self._hours = {}
+
+
+    @staticmethod
+    def _parse(key, value):
+        if key == "time":
+            return int(str(value).split(":")[0])
+        return int(value)
+
+
+    def members(self, temporal):
+        """Temporal split key values of the chunks covered by a chunk, whose
+        values may be group labels (e.g. month '01-06', see
+        :func:`cds_downloader.planner.value_label`)
+
+        Returns
+        -------
+        members : list of tuples
+            temporal split key values of single chunks, empty if a label
+            does not match the candidates
+        """
+        if not any("-" in str(v) for v in temporal):
+            return [tuple(temporal)]
+        values = []
+        for key, value in zip(self.temporal_keys, temporal):
+            value = str(value)
+            if "-" not in value:
+                values.append([value])
+                continue
+            try:
+                first, last = [self._parse(key, v) for v in value.split("-", 1)]
+            except ValueError:
+                return []
+            values.append([self._values[key][v] for v in sorted(self._values[key]) if first <= v <= last])
+        return list(itertools.product(*values))
+
+
+    def _full(self):
+        # True if every position on the time axis between first and last year is a candidate
+        full = {"month": 12, "day": 31, "time": 24}
+        years = sorted(self._values.get("year", {}))
+        if years and years[-1] - years[0] + 1 != len(years):
+            return False
+        return all(len(self._values[k]) == full[k] for k in self.temporal_keys[1:])
+
+
+    def position(self, temporal):
+        """Integer position of a tuple of temporal split key values, None for
+        invalid dates"""
+        if not self.temporal_keys:
+            return 0
+        # Collections repeat the same dates many times, parse each date only once
+        date = tuple(temporal[:3])
+        try:
+            position = self._memo[date]
+        except KeyError:
+            try:
+                parts = [self._parse(k, v) for k, v in zip(self.temporal_keys, date)]
+                position = self._position(parts)
+            except ValueError:
+                position = None
+            self._memo[date] = position
+
+        if len(self.temporal_keys) < 4 or position is None:
+            return position
+        hour = self._hours.get(temporal[3])
+        if hour is None:
+            try:
+                hour = self._parse("time", temporal[3])
+            except ValueError:
+                return None
+            if not 0 <= hour < 24:
+                return None
+            self._hours[temporal[3]] = hour
+        return position * 24 + hour
+
+
+    def _position(self, parts):
+        if len(parts) == 1:
+            return parts[0]
+        if len(parts) == 2:
+            return parts[0] * 12 + parts[1] - 1 if 1 <= parts[1] <= 12 else None
+        try:
+            ordinal = datetime.date(*parts[:3]).toordinal()
+        except ValueError:
+            return None
+        if len(parts) == 3:
+            return ordinal
+        return ordinal * 24 + parts[3] if 0 <= parts[3] < 24 else None
+
+
+    def values(self, position):
+        """Temporal split key values of an integer position, None if one of
+        the values is not a candidate"""
+        if not self.temporal_keys:
+            return {}
+        n = len(self.temporal_keys)
+        if n == 1:
+            parts = [position]
+        elif n == 2:
+            parts = [position // 12, position % 12 + 1]
+        else:
+            date = datetime.date.fromordinal(position // 24 if n == 4 else position)
+            parts = [date.year, date.month, date.day] + ([position % 24] if n == 4 else [])
+
+        values = {}
+        for k, part in zip(self.temporal_keys, parts):
+            value = self._values[k].get(part)
+            if value is None:
+                return None
+            values[k] = value
+        return values
+
+
+    def position_of_date(self, date):
+        """Integer position of a datetime.datetime object"""
+        parts = [date.year, date.month, date.day, date.hour]
+        return self._position(parts[:len(self.temporal_keys)])
+
+
+    def first_position(self):
+        """Position of the first hour of the first candidate year"""
+        if not self.temporal_keys:
+            return 0
+        return self._position([min(self._values["year"]), 1, 1, 0][:len(self.temporal_keys)])
+
+
+    def last_position(self):
+        """Position of the last hour of the last candidate year"""
+        if not self.temporal_keys:
+            return 0
+        return self._position([max(self._values["year"]), 12, 31, 23][:len(self.temporal_keys)])
+
+
+    def missing(self, existing, until=None, start=None, keep_last=True):
+        """Find missing chunks
+
+        Parameters
+        ----------
+        existing : iterable of tuples
+            split key values of existing chunks, in order of split_keys
+        until : datetime.datetime, optional
+            last date of the data collection, defaults to the last candidate
+        start : datetime.datetime or 'existing', optional
+            first date of the data collection, defaults to the first
+            candidate. With 'existing' the first existing chunk is used.
+        keep_last : boolean, optional
+            treat the last existing chunk of each non temporal combination as
+            missing, in order to redownload possibly incomplete data
+
+        Returns
+        -------
+        ranges : list of MissingRange
+            compact description of all missing chunks
+        """
+        get_fixed = _getter([self.split_keys.index(k) for k in self.fixed_keys])
+        get_temporal = _getter([self.split_keys.index(k) for k in self.temporal_keys])
+
+        # Existing positions by non temporal values, a chunk of grouped values covers several positions
+        positions = {}
+        chunks = {}
+        for keys in existing:
+            chunk = tuple(p for p in map(self.position, self.members(get_temporal(keys))) if p is not None)
+            fixed = get_fixed(keys)
+            positions.setdefault(fixed, set()).update(chunk)
+            for pos in chunk:
+                chunks.setdefault(fixed, {})[pos] = chunk
+
+        if not self.temporal_keys:
+            first, last = 0, 0
+        else:
+            last = self.last_position()
+            if until is not None:
+                last = min(last, self.position_of_date(until))
+            if start == "existing":
+                all_positions = [min(p) for p in positions.values() if p]
+                first = min(all_positions) if all_positions else self.first_position()
+            elif start is not None:
+                first = max(self.position_of_date(start), self.first_position())
+            else:
+                first = self.first_position()
+
+        full = self._full()
+        ranges = []
+        for fixed in itertools.product(*self.fixed_values):
+            present = sorted(p for p in positions.get(fixed, ()) if first <= p <= last)
+            if keep_last and present and self.temporal_keys:
+                last_chunk = set(chunks[fixed][present[-1]])
+                present = [p for p in present if p not in last_chunk]
+
+            # Gaps are the jumps between consecutive positions, framed by first and last
+            bounds = [first - 1] + present + [last + 1]
+            gaps = [(a + 1, b - 1) for a, b in zip(bounds, bounds[1:]) if b - a > 1]
+
+            for gap in gaps:
+                for run in ([gap] if full else self._allowed_runs(*gap)):
+                    ranges.append(MissingRange(
+                        dict(zip(self.fixed_keys, fixed)),
+                        self.values(run[0]), self.values(run[1]), run[1] - run[0] + 1))
+        return ranges
+
+
+    def _allowed_runs(self, start, end):
+        runs = []
+        run_start = None
+        for pos in range(start, end + 1):
+            if self.values(pos) is not None:
+                if run_start is None:
+                    run_start = pos
+            elif run_start is not None:
+                runs.append((run_start, pos - 1))
+                run_start = None
+        if run_start is not None:
+            runs.append((run_start, end))
+        return runs
+
+
+    def expand(self, ranges):
+        """Expand missing ranges into split key values
+
+        Parameters
+        ----------
+        ranges : iterable of MissingRange
+
+        Yields
+        ------
+        values : dict
+            values of all split keys of one missing chunk
+        """
+        for missing_range in ranges:
+            if not self.temporal_keys:
+                yield dict(missing_range.fixed)
+                continue
+            start = self.position([missing_range.start[k] for k in self.temporal_keys])
+            for pos in range(start, start + missing_range.count):
+                values = self.values(pos)
+                if values is not None:
+                    yield dict(missing_range.fixed, **values)
+
+
+def _getter(indices):
+    # itemgetter, which always returns a tuple
+    if len(indices) == 1:
+        i = indices[0]
+        return lambda keys: (keys[i],)
+    if not indices:
+        return lambda keys: ()
+    return operator.itemgetter(*indices)
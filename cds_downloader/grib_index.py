@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+"""
+grib_index.py:
+Byte offset index of the messages of GRIB files
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import os
+import json
+import mmap
+import datetime
+import logging
+
+from .integrity import scan_buffer
+
+
+INDEX_SUFFIX = ".index.json"
+INDEX_VERSION = 1
+
+# Units of time ranges of GRIB1 (code table 4) and GRIB2 (code table 4.4)
+TIME_UNITS = {0: 60, 1: 3600, 2: 86400, 10: 3 * 3600, 11: 6 * 3600, 12: 12 * 3600, 13: 900, 254: 1}
+
+# Product definition templates of GRIB2 with the end of the overall time interval
+INTERVAL_END_OCTET = {8: 35, 11: 38}
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def _int(buffer, start, length):
+    return int.from_bytes(buffer[start:start + length], "big")
+
+
+def _signed(buffer, start, length):
+    # GRIB uses sign and magnitude instead of two's complement
+    value = _int(buffer, start, length)
+    sign_bit = 1 << (8 * length - 1)
+    return -(value & (sign_bit - 1)) if value & sign_bit else value
+
+
+def _valid_time(reference, unit, step):
+    if reference is None or unit not in TIME_UNITS:
+        return None
+    return (reference + datetime.timedelta(seconds=TIME_UNITS[unit] * step)).isoformat()
+
+
+def _parse_grib1(buffer, offset):
+    pds = offset + 8
+    table, parameter, level_type = buffer[pds + 3], buffer[pds + 8], buffer[pds + 9]
+    level = _int(buffer, pds + 10, 2)
+    try:
+        reference = datetime.datetime((buffer[pds + 24] - 1) * 100 + buffer[pds + 12], buffer[pds + 13],
+                                      buffer[pds + 14], buffer[pds + 15], buffer[pds + 16])
+    except ValueError:
+        reference = None
+    unit, p1, p2, time_range = buffer[pds + 17], buffer[pds + 18], buffer[pds + 19], buffer[pds + 20]
+    if time_range == 10:
+        step = _int(buffer, pds + 18, 2)
+    elif time_range in (2, 3, 4, 5):
+        step = p2
+    elif time_range == 1:
+        step = 0
+    else:
+        step = p1
+    return {"param": "{}.{}".format(parameter, table), "level_type": level_type, "level": level,
+            "valid_time": _valid_time(reference, unit, step)}
+
+
+def _parse_grib2(buffer, offset, length):
+    entry = {"param": None, "level_type": None, "level": None, "valid_time": None}
+    discipline = buffer[offset + 6]
+    reference = None
+    position, end = offset + 16, offset + length - 4
+    while position + 5 <= end:
+        section_length, number = _int(buffer, position, 4), buffer[position + 4]
+        if section_length < 5:
+            break
+        if number == 1:
+            try:
+                reference = datetime.datetime(_int(buffer, position + 12, 2), *[
+                    buffer[position + i] for i in range(14, 19)])
+            except ValueError:
+                reference = None
+        elif number == 4:
+            template = _int(buffer, position + 7, 2)
+            entry["param"] = "{}.{}.{}".format(discipline, buffer[position + 9], buffer[position + 10])
+            entry["level_type"] = buffer[position + 22]
+            scale = _signed(buffer, position + 23, 1)
+            value = _signed(buffer, position + 24, 4)
+            level = value / 10. ** scale
+            entry["level"] = int(level) if level.is_integer() else level
+            if template in INTERVAL_END_OCTET:
+                start = position + INTERVAL_END_OCTET[template] - 1
+                try:
+                    entry["valid_time"] = datetime.datetime(_int(buffer, start, 2), *[
+                        buffer[start + i] for i in range(2, 7)]).isoformat()
+                except ValueError:
+                    pass
+            else:
+                entry["valid_time"] = _valid_time(reference, buffer[position + 17],
+                                                  _signed(buffer, position + 18, 4))
+            # Only the first field of a message is indexed
+            break
+        position += section_length
+    return entry
+
+
+def parse_messages(buffer, name="buffer"):
+    """Index the messages of GRIB data in a buffer by parsing their headers,
+    data sections are never decoded
+
+    Returns
+    -------
+    messages : list of dict
+        offset, length, edition, param, level_type, level and valid_time of
+        each message. Parameters are 'number.table' in GRIB1 and
+        'discipline.category.number' in GRIB2, valid times are iso strings.
+    """
+    messages = []
+    for offset, length, edition in scan_buffer(buffer, name):
+        entry = {"offset": offset, "length": length, "edition": edition}
+        try:
+            if edition == 1:
+                entry.update(_parse_grib1(buffer, offset))
+            else:
+                entry.update(_parse_grib2(buffer, offset, length))
+        except IndexError:
+            logging.warning('Header of GRIB message at byte {} of {} is incomplete'.format(offset, name))
+            entry.update({"param": None, "level_type": None, "level": None, "valid_time": None})
+        messages.append(entry)
+    return messages
+
+
+def build_index(path):
+    """Index the messages of a GRIB file via mmap"""
+    if os.path.getsize(path) == 0:
+        return []
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return parse_messages(buffer, path)
+
+
+def _save_index(path, messages):
+    stat = os.stat(path)
+    index = {"version": INDEX_VERSION, "size": stat.st_size, "mtime": stat.st_mtime,
+             "messages": messages}
+    path_temp = index_path(path) + ".tmp"
+    with open(path_temp, 'w') as f:
+        json.dump(index, f)
+    os.replace(path_temp, index_path(path))
+    return index_path(path)
+
+
+def write_index(path):
+    """Write the sidecar index of a GRIB file next to it
+
+    Returns
+    -------
+    index_path : string
+        path of the sidecar index
+    """
+    messages = build_index(path)
+    logging.info('Indexed {} GRIB messages of {}'.format(len(messages), path))
+    return _save_index(path, messages)
+
+
+def append_index(path, source, offset):
+    """Extend the sidecar index of path by the messages of source, which
+    were appended to path at offset. Only the headers of source are parsed,
+    a missing or outdated index of path is rebuilt.
+
+    Returns
+    -------
+    index_path : string
+        path of the sidecar index
+    """
+    try:
+        with open(index_path(path), 'r') as f:
+            index = json.load(f)
+        if index.get("version") != INDEX_VERSION or index.get("size") != offset:
+            raise ValueError("outdated index")
+    except (OSError, ValueError):
+        return write_index(path)
+
+    messages = index["messages"]
+    for entry in build_index(source):
+        messages.append(dict(entry, offset=entry["offset"] + offset))
+    return _save_index(path, messages)
+
+
+def index_download(path, cds_filter):
+    """Write the sidecar index of a downloaded chunk, if it is a GRIB file"""
+    if (cds_filter or {}).get("format", "grib") != "grib":
+        return None
+    return write_index(path)
+
+
+def _matches(value, criterion):
+    if isinstance(criterion, datetime.datetime):
+        criterion = criterion.isoformat()
+    if isinstance(criterion, (list, tuple, set, frozenset)):
+        return any(_matches(value, c) for c in criterion)
+    return value == criterion
+
+
+class GribIndex(object):
+    """The :class:`GribIndex` class gives direct access to the messages of a
+    GRIB file by its sidecar index, hence a single variable, level or time
+    step is read with a seek instead of a scan of the whole file.
+
+    The sidecar is written by the downloader for every completed file. A
+    missing or outdated sidecar (size or mtime of the file changed) is
+    rebuilt from the message headers.
+
+    Examples
+    --------
+    >>> index = GribIndex("2000_reanalysis-era5-single-levels.grib")
+    >>> index.select(param="167.128", valid_time="2000-01-01T12:00:00")
+    >>> index.extract("t2m_noon.grib", param="167.128", valid_time="2000-01-01T12:00:00")
+
+    """
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : string
+            path of the GRIB file
+        """
+        self.path = str(path)
+        self.messages = self._load()
+
+
+    def _load(self):
+        stat = os.stat(self.path)
+        try:
+            with open(index_path(self.path), 'r') as f:
+                index = json.load(f)
+            if (index.get("version") == INDEX_VERSION and index.get("size") == stat.st_size
+                    and index.get("mtime") == stat.st_mtime):
+                return index["messages"]
+        except (OSError, ValueError):
+            pass
+        write_index(self.path)
+        with open(index_path(self.path), 'r') as f:
+            return json.load(f)["messages"]
+
+
+    def __len__(self):
+        return len(self.messages)
+
+
+    def select(self, **criteria):
+        """Index entries of the messages matching all criteria
+
+        Parameters
+        ----------
+        criteria : optional
+            values of param, level_type, level, valid_time or edition, a list
+            matches any of its values
+
+        Returns
+        -------
+        messages : list of dict
+        """
+        return [m for m in self.messages
+                if all(_matches(m.get(k), v) for k, v in criteria.items())]
+
+
+    def read(self, **criteria):
+        """Yield (entry, memoryview) of the matching messages without copying
+        them, a view is only valid until the next iteration"""
+        selected = self.select(**criteria)
+        if not selected:
+            return
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                view = memoryview(buffer)
+                try:
+                    for entry in selected:
+                        message = view[entry["offset"]:entry["offset"] + entry["length"]]
+                        try:
+                            yield entry, message
+                        finally:
+                            message.release()
+                finally:
+                    view.release()
+
+
+    def extract(self, target, **criteria):
+        """Write the matching messages into a new GRIB file
+
+        Returns
+        -------
+        count : int
+            number of extracted messages
+        """
+        count = 0
+        path_temp = target + ".tmp"
+        with open(path_temp, 'wb') as f:
+            for entry, message in self.read(**criteria):
+                f.write(message)
+                count += 1
+        os.replace(path_temp, target)
+        return count
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+"""
+integrity.py:
+Streaming checksums and structural verification of downloaded chunks
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import os
+import mmap
+import calendar
+import hashlib
+import logging
+
+
+# Keys of a cds filter, which multiply the number of fields of a request
+FIELD_KEYS = ["variable", "product_type", "pressure_level", "model_level", "time", "leadtime_hour"]
+DATE_KEYS = ["year", "month", "day"]
+# Keys of a cds filter, whose values do not add fields, e.g. the bounds of the area
+SHAPE_KEYS = ["format", "area", "grid"]
+
+GRIB_START = b"GRIB"
+GRIB_END = b"7777"
+
+# File signatures of other formats
+NETCDF_MAGIC = (b"CDF\x01", b"CDF\x02", b"\x89HDF")
+
+
+class IntegrityError(Exception):
+    """Raised if a downloaded file is truncated or corrupt"""
+    pass
+
+
+class Checksum(object):
+    """The :class:`Checksum` class computes the BLAKE2b checksum of a file
+    while its bytes are streamed in, the same checksum as
+    :func:`cds_downloader.manifest.file_checksum`.
+
+    """
+
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        """Start again, e.g. if a download restarts from the first byte"""
+        self._hash = hashlib.blake2b()
+
+
+    def update(self, data):
+        self._hash.update(data)
+
+
+    def update_file(self, path, length=None, offset=0, block_size=1 << 20):
+        """Add length bytes of a file from offset, e.g. the part of a resumed
+        download, which was written by a previous run"""
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            remaining = os.path.getsize(path) - offset if length is None else length
+            while remaining > 0:
+                block = f.read(min(block_size, remaining))
+                if not block:
+                    break
+                self._hash.update(block)
+                remaining -= len(block)
+
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def _grib_length(buffer, offset, size):
+    edition = buffer[offset + 7]
+    if edition == 2:
+        return int.from_bytes(buffer[offset + 8:offset + 16], "big"), edition
+    if edition == 1:
+        length = int.from_bytes(buffer[offset + 4:offset + 7], "big")
+        if length & 0x800000:
+            # Large GRIB1 messages encode the length in a different unit, use the next end marker
+            end = buffer.find(GRIB_END + GRIB_START, offset)
+            length = (end + 4 if end >= 0 else size) - offset
+        return length, edition
+    raise IntegrityError("Unknown GRIB edition {} at byte {}".format(edition, offset))
+
+
+def scan_grib(path, offset=0, length=None):
+    """Walk the messages of a GRIB file via mmap without reading the data
+
+    Every message has to start with 'GRIB', its length is taken from the
+    indicator section and it has to end with '7777' exactly there.
+
+    Parameters
+    ----------
+    path : string
+        path of a GRIB file
+    offset, length : int, optional
+        byte range of the messages, e.g. of a chunk in an aggregated file
+
+    Returns
+    -------
+    messages : list of tuples
+        (offset, length, edition) of each message
+
+    Raises
+    ------
+    IntegrityError
+        if the file is empty, truncated or contains garbage between messages
+    """
+    size = os.path.getsize(path)
+    end = size if length is None else offset + length
+    if size == 0 or end <= offset:
+        raise IntegrityError("Empty file " + path)
+    if end > size:
+        raise IntegrityError("Truncated file {}, {} of {} bytes".format(path, size, end))
+
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return scan_buffer(buffer, path, offset, end)
+
+
+def scan_buffer(buffer, name="buffer", start=0, end=None):
+    """Walk the messages of GRIB data in a buffer between start and end,
+    see :func:`scan_grib`"""
+    size = len(buffer) if end is None else end
+    messages = []
+    offset = start
+    while offset < size:
+        if size - offset < 16 or buffer[offset:offset + 4] != GRIB_START:
+            raise IntegrityError("No GRIB message at byte {} of {}".format(offset, name))
+        length, edition = _grib_length(buffer, offset, size)
+        if length < 16 or offset + length > size:
+            raise IntegrityError("Truncated GRIB message at byte {} of {}".format(offset, name))
+        if buffer[offset + length - 4:offset + length] != GRIB_END:
+            raise IntegrityError("GRIB message at byte {} of {} has no end marker".format(offset, name))
+        messages.append((offset, length, edition))
+        offset += length
+    return messages
+
+
+def count_messages(path, offset=0, length=None):
+    """Number of GRIB messages of a file or a byte range of it"""
+    return len(scan_grib(path, offset, length))
+
+
+def _values(cds_filter, key):
+    value = cds_filter.get(key)
+    if value is None:
+        return None
+    return value if isinstance(value, (list, tuple)) else [value]
+
+
+def expected_fields(cds_filter):
+    """Number of fields (GRIB messages) implied by a cds filter
+
+    The count is the product of variables, product types, levels and times
+    and the number of valid dates of years, months and days (e.g. 30
+    February is not counted).
+
+    Returns
+    -------
+    count : int or None
+        expected number of fields, None if it can not be derived from the
+        filter (e.g. date ranges, ensemble members or several values of
+        other keys like leadtime_month)
+    """
+    if "date" in cds_filter or "ensemble_members" in (_values(cds_filter, "product_type") or []):
+        return None
+    for key, value in cds_filter.items():
+        if key not in FIELD_KEYS + DATE_KEYS + SHAPE_KEYS and isinstance(value, (list, tuple)) and len(value) > 1:
+            return None
+
+    count = 1
+    for key in FIELD_KEYS:
+        values = _values(cds_filter, key)
+        if values is not None:
+            count *= len(values)
+
+    years, months, days = [_values(cds_filter, k) for k in DATE_KEYS]
+    if years is not None and months is not None and days is not None:
+        count *= sum(1 for y in years for m in months for d in days
+                     if int(d) <= calendar.monthrange(int(y), int(m))[1])
+    else:
+        for values in (years, months, days):
+            if values is not None:
+                count *= len(values)
+    return count
+
+
+def verify_file(path, cds_filter=None, size=None, checksum=None, offset=0, length=None):
+    """Verify a downloaded chunk, optionally a chunk merged into an
+    aggregated file at offset
+
+    Parameters
+    ----------
+    path : string
+        path of the file
+    cds_filter : dict, optional
+        cds filter of the chunk, GRIB files are checked against the number of
+        fields of the filter and netcdf files against their signature
+    size : int, optional
+        expected size in bytes
+    checksum : string, optional
+        expected BLAKE2b checksum, requires a full read of the file
+    offset, length : int, optional
+        byte range of the chunk in the file
+
+    Returns
+    -------
+    problems : list of strings
+        empty if the file is valid
+    """
+    if not os.path.exists(path):
+        return ["missing file"]
+    problems = []
+    actual_size = os.path.getsize(path) - offset if length is None else length
+    if size is not None and actual_size != size:
+        problems.append("size {} instead of {}".format(actual_size, size))
+
+    file_format = (cds_filter or {}).get("format", "grib")
+    if file_format == "grib":
+        try:
+            count = count_messages(path, offset, length)
+            expected = expected_fields(cds_filter) if cds_filter is not None else None
+            if expected is not None and count != expected:
+                problems.append("{} GRIB messages instead of {}".format(count, expected))
+        except IntegrityError as e:
+            problems.append(str(e))
+    elif file_format == "netcdf":
+        with open(path, 'rb') as f:
+            if not f.read(4).startswith(NETCDF_MAGIC):
+                problems.append("no netcdf signature")
+
+    if checksum is not None and not problems:
+        digest = Checksum()
+        digest.update_file(path, length, offset)
+        if digest.hexdigest() != checksum:
+            problems.append("checksum mismatch")
+    return problems
+
+
+def verify_download(path, cds_filter):
+    """Verify a new download, a corrupt file is removed
+
+    Raises
+    ------
+    IntegrityError
+        if the file is not valid
+    """
+    problems = verify_file(path, cds_filter)
+    if problems:
+        os.remove(path)
+        raise IntegrityError("Verification of {} failed: {}".format(path, ", ".join(problems)))
+    logging.info('Verified ' + path)
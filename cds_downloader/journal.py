@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+
+"""
+journal.py:
+Durable journal of the runs in a storage path
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import os
+import json
+import itertools
+import time
+import sqlite3
+import threading
+import logging
+
+from .chunk_plan import ChunkPlan
+from .priority import prioritize
+
+
+JOURNAL_NAME = ".cds_journal.sqlite"
+
+RUN_RUNNING = "running"
+RUN_COMPLETE = "complete"
+RUN_INCOMPLETE = "incomplete"
+
+# Every chunk, which is not done, is continued by a resumed run
+CHUNK_DONE = "done"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    product TEXT NOT NULL,
+    split_keys TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL,
+    plan TEXT,
+    position INTEGER NOT NULL DEFAULT 0,
+    planned INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    run_id INTEGER NOT NULL,
+    file_name TEXT NOT NULL,
+    filter TEXT NOT NULL,
+    state TEXT NOT NULL,
+    request_id TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (run_id, file_name)
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    run_id INTEGER NOT NULL,
+    file_name TEXT NOT NULL,
+    state TEXT NOT NULL,
+    request_id TEXT,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transitions_chunk ON transitions (run_id, file_name);
+"""
+
+
+class Journal(object):
+    """The :class:`Journal` class records the runs of a data collection in a
+    SQLite database in the storage path.
+
+    A run records its planned chunks with their cds filters page by page,
+    before they are handed to the workers, then every state transition of a chunk (see
+    :data:`cds_downloader.metrics.CHUNK_EVENTS`) with its cds request id and
+    the number of failed attempts. Every write is a single transaction, hence
+    a killed run can be continued with :meth:`resume_run`: the chunks, which
+    are not done, are taken from the journal and requests, which were already
+    submitted, are reattached by their request id. A run of a
+    :class:`cds_downloader.chunk_plan.ChunkPlan` stores the plan and the
+    position of its planning, a resumed run continues the chunks, which were
+    not planned yet, from this position.
+
+    The journal is shared by thread workers and process workers, each
+    process opens its own connection.
+
+    """
+
+    def __init__(self, storage_path, name=JOURNAL_NAME):
+        """
+        Parameters
+        ----------
+        storage_path : string
+            storage path of the data collection
+        name : string, optional
+            file name of the journal database
+        """
+        self.storage_path = str(storage_path)
+        self.path = os.path.join(self.storage_path, name)
+        self.run_id = None
+        self.started = None
+        self._connection = None
+        self._lock = threading.RLock()
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        del state["_lock"]
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+
+    @property
+    def connection(self):
+        with self._lock:
+            if self._connection is None:
+                os.makedirs(self.storage_path, exist_ok=True)
+                # Workers of the run share the connection, access is serialised by the lock
+                self._connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+                self._connection.executescript(_SCHEMA)
+            return self._connection
+
+
+    def _execute(self, query, args=()):
+        with self._lock:
+            return self.connection.execute(query, args).fetchall()
+
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+    def open_run(self, cds_product, split_keys, plan=None, priority=None):
+        """Start a new run of a product
+
+        Parameters
+        ----------
+        cds_product : string
+            cds product of the run
+        split_keys : list of strings
+            split keys of the run
+        plan : cds_downloader.chunk_plan.ChunkPlan, optional
+            chunks of the run, continued by :meth:`unplanned`
+        priority : string, optional
+            priority policy of the plan, see
+            :func:`cds_downloader.priority.prioritize`
+
+        Returns
+        -------
+        run_id : int
+        """
+        self.started = time.time()
+        stored = None
+        if plan is not None:
+            stored = json.dumps({"chunks": plan.to_dict(), "priority": priority})
+        with self._lock, self.connection as con:
+            cursor = con.execute(
+                "INSERT INTO runs (product, split_keys, status, started, plan) VALUES (?, ?, ?, ?, ?)",
+                (cds_product, json.dumps(list(split_keys)), RUN_RUNNING, self.started, stored))
+        self.run_id = cursor.lastrowid
+        logging.info('Journal run {} of {} opened'.format(self.run_id, cds_product))
+        return self.run_id
+
+
+    def resume_run(self, cds_product, run_id=None):
+        """Continue the last run of a product, which is not complete
+
+        Parameters
+        ----------
+        cds_product : string
+            cds product of the run
+        run_id : int, optional
+            continue this run instead of the last one
+
+        Returns
+        -------
+        run : dict or None
+            the continued run, see :meth:`runs`, None if there is no run to
+            continue
+        """
+        if not os.path.exists(self.path):
+            return None
+        runs = [r for r in self.runs(cds_product)
+                if r["status"] != RUN_COMPLETE and (run_id is None or r["run_id"] == run_id)]
+        if not runs:
+            return None
+        run = runs[-1]
+        with self._lock, self.connection as con:
+            con.execute("UPDATE runs SET status = ?, finished = NULL WHERE run_id = ?",
+                        (RUN_RUNNING, run["run_id"]))
+        self.run_id = run["run_id"]
+        self.started = run["started"]
+        logging.info('Journal run {} of {} resumed'.format(self.run_id, cds_product))
+        return dict(run, status=RUN_RUNNING)
+
+
+    def finish_run(self):
+        """Close the current run, it is complete if all of its chunks are done
+
+        Returns
+        -------
+        status : string
+            RUN_COMPLETE or RUN_INCOMPLETE
+        """
+        pending = self._execute("SELECT COUNT(*) FROM chunks WHERE run_id = ? AND state != ?",
+                                (self.run_id, CHUNK_DONE))[0][0]
+        status = RUN_INCOMPLETE if pending else RUN_COMPLETE
+        with self._lock, self.connection as con:
+            con.execute("UPDATE runs SET status = ?, finished = ? WHERE run_id = ?",
+                        (status, time.time(), self.run_id))
+        logging.info('Journal run {} {}, {} chunks not done'.format(self.run_id, status, pending))
+        return status
+
+
+    def unplanned(self):
+        """Chunks of the current run, which were not planned before the run
+        was interrupted
+
+        Returns
+        -------
+        chunks : iterable of dicts
+            cds filters of the chunks in order of priority, None if the
+            chunks of the run are not known
+        """
+        rows = self._execute("SELECT plan, position, planned FROM runs WHERE run_id = ?", (self.run_id,))
+        if not rows or rows[0][2]:
+            return iter(())
+        stored, position, _ = rows[0]
+        if stored is None:
+            return None
+        stored = json.loads(stored)
+        plan = ChunkPlan.from_dict(stored["chunks"])
+        if stored["priority"] is None:
+            return plan.cursor(position)
+        # The order of priority is reproduced, the planned chunks are skipped
+        return itertools.islice(prioritize(plan, stored["priority"]), position, None)
+
+
+    def plan(self, chunks, consumed=0, complete=False):
+        """Record the planned chunks of the current run in a single
+        transaction, chunks which are already known to the run keep their
+        state and request id
+
+        Parameters
+        ----------
+        chunks : iterable of tuples
+            (file_name, cds_filter) of each chunk
+        consumed : int, optional
+            number of chunks of the plan of the run, which are consumed by
+            this page, including chunks which are not requested
+        complete : boolean, optional
+            the last page of the run, every chunk is planned
+
+        Returns
+        -------
+        count : int
+            number of newly planned chunks
+        """
+        count = 0
+        now = time.time()
+        with self._lock, self.connection as con:
+            for file_name, cds_filter in chunks:
+                name = os.path.basename(file_name)
+                cursor = con.execute(
+                    "INSERT OR IGNORE INTO chunks (run_id, file_name, filter, state, updated) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (self.run_id, name, json.dumps(dict(cds_filter), sort_keys=True), "planned", now))
+                if cursor.rowcount:
+                    con.execute("INSERT INTO transitions (run_id, file_name, state, time) VALUES (?, ?, ?, ?)",
+                                (self.run_id, name, "planned", now))
+                    count += 1
+            if consumed or complete:
+                con.execute("UPDATE runs SET position = position + ?, planned = ? WHERE run_id = ?",
+                            (consumed, 1 if complete else 0, self.run_id))
+        logging.info('Journal run {}: {} chunks planned'.format(self.run_id, count))
+        return count
+
+
+    def record(self, state, file_name, request_id=None, error=None):
+        """Record a state transition of a chunk of the current run
+
+        Parameters
+        ----------
+        state : string
+            new state of the chunk, e.g. 'submitted' or 'done'
+        file_name : string
+            file name of the chunk
+        request_id : string, optional
+            cds request id of the chunk, a known request id is kept otherwise
+        error : string, optional
+            error of a failed attempt, counts the failed attempts of the
+            chunk
+        """
+        now = time.time()
+        name = os.path.basename(file_name)
+        failed = 1 if error is not None else 0
+        with self._lock, self.connection as con:
+            con.execute(
+                "UPDATE chunks SET state = ?, request_id = COALESCE(?, request_id), "
+                "attempts = attempts + ?, error = COALESCE(?, error), updated = ? "
+                "WHERE run_id = ? AND file_name = ?",
+                (state, request_id, failed, error, now, self.run_id, name))
+            con.execute(
+                "INSERT INTO transitions (run_id, file_name, state, request_id, time) VALUES (?, ?, ?, ?, ?)",
+                (self.run_id, name, state, request_id, now))
+
+
+    def request_id(self, file_name):
+        """Last cds request id of a chunk of the current run or None"""
+        if self.run_id is None or not os.path.exists(self.path):
+            return None
+        rows = self._execute("SELECT request_id FROM chunks WHERE run_id = ? AND file_name = ?",
+                             (self.run_id, os.path.basename(file_name)))
+        return rows[0][0] if rows else None
+
+
+    def runs(self, cds_product=None):
+        """Runs of the journal in order of their start
+
+        Returns
+        -------
+        runs : list of dicts
+            run_id, product, split_keys, status, started and finished time
+        """
+        if not os.path.exists(self.path):
+            return []
+        query = "SELECT run_id, product, split_keys, status, started, finished FROM runs"
+        args = ()
+        if cds_product is not None:
+            query += " WHERE product = ?"
+            args = (cds_product,)
+        rows = self._execute(query + " ORDER BY run_id", args)
+        return [{"run_id": r[0], "product": r[1], "split_keys": json.loads(r[2]), "status": r[3],
+                 "started": r[4], "finished": r[5]} for r in rows]
+
+
+    def chunks(self, run_id=None, pending=False):
+        """Chunks of a run, defaults to the current run
+
+        Parameters
+        ----------
+        run_id : int, optional
+            run of the chunks
+        pending : boolean, optional
+            only chunks, which are not done
+
+        Returns
+        -------
+        chunks : list of dicts
+            file_name, cds filter, state, request_id, number of failed
+            attempts and last error of each chunk in order of planning
+        """
+        return list(self.iter_chunks(run_id, pending))
+
+
+    def iter_chunks(self, run_id=None, pending=False, page_size=1000):
+        """Iterate over the chunks of a run in pages, see :meth:`chunks`
+
+        The chunks are read lazily, hence the states of the chunks may change
+        while iterating, e.g. by the workers of the run.
+        """
+        run_id = self.run_id if run_id is None else run_id
+        query = "SELECT rowid, file_name, filter, state, request_id, attempts, error FROM chunks " \
+                "WHERE run_id = ? AND rowid > ?"
+        if pending:
+            query += " AND state != '{}'".format(CHUNK_DONE)
+        last = 0
+        while True:
+            rows = self._execute(query + " ORDER BY rowid LIMIT ?", (run_id, last, page_size))
+            for r in rows:
+                yield {"file_name": r[1], "cds_filter": json.loads(r[2]), "state": r[3],
+                       "request_id": r[4], "attempts": r[5], "error": r[6]}
+            if len(rows) < page_size:
+                return
+            last = rows[-1][0]
+
+
+    def transitions(self, file_name, run_id=None):
+        """State transitions of a chunk as (state, request_id, time) tuples"""
+        run_id = self.run_id if run_id is None else run_id
+        return self._execute(
+            "SELECT state, request_id, time FROM transitions WHERE run_id = ? AND file_name = ? "
+            "ORDER BY rowid", (run_id, os.path.basename(file_name)))
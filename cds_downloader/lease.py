@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+"""
+lease.py:
+Lease table of the chunks of a storage path shared by several hosts
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import threading
+
+
+LEASES_NAME = ".cds_leases.sqlite"
+DEFAULT_TTL = 300.
+
+LEASE_HELD = "leased"
+LEASE_DONE = "done"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    file_name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    state TEXT NOT NULL,
+    expires REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+
+class LeaseLost(Exception):
+    """Raised if the lease of a chunk expired and another host claimed it"""
+    pass
+
+
+def default_owner():
+    """Unique owner name of the leases of a run, host name, process id and a
+    random suffix"""
+    return "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class LeaseTable(object):
+    """The :class:`LeaseTable` class coordinates several hosts, which download
+    the same data collection into a shared storage path (e.g. on NFS).
+
+    A host claims a chunk before it requests it from the cds. The claim is a
+    single atomic upsert in a SQLite database in the storage path, hence only
+    one host gets the lease of a chunk. The lease expires after `ttl` seconds
+    unless its owner renews it, a background thread renews all held leases
+    while their chunks are downloaded. Expired leases of dead hosts are
+    claimed again by the others.
+
+    A finished chunk keeps its row as done. Chunks finished after `since`,
+    i.e. while this host already had them planned, are not claimed again,
+    chunks finished before were planned despite that (deleted files or
+    overwrite) and are requested again.
+
+    The expiry compares the clocks of the hosts, they have to be synchronised
+    well below the ttl. SQLite relies on the file locks of the shared file
+    system, NFS mounts need working locks (e.g. NFSv4 or lockd).
+
+    A host, which lost a lease (e.g. its renewals failed for longer than the
+    ttl), stops working on the chunk at the next :meth:`check`.
+
+    Examples
+    --------
+    >>> leases = LeaseTable("/data/era5", ttl=600)
+    >>> if leases.claim("t_2000_reanalysis-era5-single-levels.grib"):
+    ...     download()
+    ...     leases.release("t_2000_reanalysis-era5-single-levels.grib", done=True)
+
+    """
+
+    def __init__(self, storage_path, owner=None, ttl=DEFAULT_TTL, since=None, name=LEASES_NAME):
+        """
+        Parameters
+        ----------
+        storage_path : string
+            shared storage path of the data collection
+        owner : string, optional
+            unique name of this host and run, see :func:`default_owner`
+        ttl : float, optional
+            seconds until a lease, which is not renewed, expires
+        since : float, optional
+            unix time of the planning of the chunks, defaults to now
+        name : string, optional
+            file name of the lease database
+        """
+        self.storage_path = str(storage_path)
+        self.path = os.path.join(self.storage_path, name)
+        self.owner = owner or default_owner()
+        self.ttl = ttl
+        self.since = time.time() if since is None else since
+        self._connection = None
+        self._lock = threading.RLock()
+        self._held = set()
+        self._renewer = None
+
+
+    def __getstate__(self):
+        # Process workers renew the leases they claim with their own thread
+        state = self.__dict__.copy()
+        state.update(_connection=None, _held=set(), _renewer=None)
+        del state["_lock"]
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+
+    @property
+    def connection(self):
+        with self._lock:
+            if self._connection is None:
+                os.makedirs(self.storage_path, exist_ok=True)
+                self._connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+                self._connection.executescript(_SCHEMA)
+            return self._connection
+
+
+    def close(self):
+        with self._lock:
+            self._held.clear()
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+    def claim(self, file_name):
+        """Claim the lease of a chunk
+
+        The lease is granted if the chunk is not leased, its lease expired,
+        this owner holds it already or the chunk was finished before
+        `since`.
+
+        Parameters
+        ----------
+        file_name : string
+            file name of the chunk in the storage path
+
+        Returns
+        -------
+        claimed : boolean
+        """
+        now = time.time()
+        with self._lock, self.connection as con:
+            cursor = con.execute(
+                "INSERT INTO leases (file_name, owner, state, expires, updated) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (file_name) DO UPDATE SET owner = excluded.owner, state = excluded.state, "
+                "expires = excluded.expires, updated = excluded.updated "
+                "WHERE leases.owner = excluded.owner OR (leases.state = ? AND leases.expires < ?) "
+                "OR (leases.state = ? AND leases.updated < ?)",
+                (file_name, self.owner, LEASE_HELD, now + self.ttl, now, LEASE_HELD, now, LEASE_DONE, self.since))
+            claimed = cursor.rowcount == 1
+            if claimed:
+                self._held.add(file_name)
+                self._start_renewer()
+        if claimed:
+            logging.debug('Lease of {} claimed by {}'.format(file_name, self.owner))
+        return claimed
+
+
+    def renew(self):
+        """Extend the leases held by this owner by the ttl
+
+        Returns
+        -------
+        lost : list of strings
+            chunks, whose lease expired and was claimed by another host,
+            their workers stop at the next :meth:`check`
+        """
+        lost = []
+        with self._lock:
+            expires = time.time() + self.ttl
+            with self.connection as con:
+                for file_name in list(self._held):
+                    cursor = con.execute(
+                        "UPDATE leases SET expires = ?, updated = ? WHERE file_name = ? AND owner = ? AND state = ?",
+                        (expires, time.time(), file_name, self.owner, LEASE_HELD))
+                    if cursor.rowcount != 1:
+                        self._held.discard(file_name)
+                        lost.append(file_name)
+        for file_name in lost:
+            logging.warning('Lease of {} was lost to another host'.format(file_name))
+        return lost
+
+
+    def holds(self, file_name):
+        """True if this owner still holds the lease of a chunk"""
+        lease = self.holder(file_name)
+        held = lease is not None and lease["owner"] == self.owner and lease["state"] == LEASE_HELD
+        if not held:
+            with self._lock:
+                self._held.discard(file_name)
+        return held
+
+
+    def check(self, file_name):
+        """Raise :class:`LeaseLost` if another host took over the chunk"""
+        if not self.holds(file_name):
+            raise LeaseLost("Lease of {} was lost to {}".format(
+                file_name, (self.holder(file_name) or {}).get("owner")))
+
+
+    def release(self, file_name, done=False):
+        """Give up the lease of a chunk
+
+        Parameters
+        ----------
+        file_name : string
+            file name of the chunk in the storage path
+        done : boolean, optional
+            keep the chunk as finished, otherwise (e.g. after a failure)
+            other hosts may claim it immediately
+        """
+        with self._lock, self.connection as con:
+            self._held.discard(file_name)
+            if done:
+                con.execute("UPDATE leases SET state = ?, updated = ? WHERE file_name = ? AND owner = ?",
+                            (LEASE_DONE, time.time(), file_name, self.owner))
+            else:
+                con.execute("DELETE FROM leases WHERE file_name = ? AND owner = ? AND state = ?",
+                            (file_name, self.owner, LEASE_HELD))
+
+
+    def holder(self, file_name):
+        """Lease of a chunk as dict with owner, state, expires and updated,
+        None if it was never leased"""
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT owner, state, expires, updated FROM leases WHERE file_name = ?", (file_name,)).fetchall()
+        if not rows:
+            return None
+        return dict(zip(["owner", "state", "expires", "updated"], rows[0]))
+
+
+    def finished_elsewhere(self, file_name):
+        """True if another host finished the chunk since it was planned"""
+        lease = self.holder(file_name)
+        return lease is not None and lease["state"] == LEASE_DONE and lease["updated"] >= self.since
+
+
+    def _start_renewer(self):
+        if self._renewer is None or not self._renewer.is_alive():
+            self._renewer = threading.Thread(target=self._renew_loop, name="lease-renewer", daemon=True)
+            self._renewer.start()
+
+
+    def _renew_loop(self):
+        # Renew three times per ttl, the thread ends with the last held lease
+        while True:
+            time.sleep(self.ttl / 3.)
+            with self._lock:
+                if not self._held:
+                    self._renewer = None
+                    return
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                logging.warning('Leases could not be renewed: {}'.format(repr(e)))
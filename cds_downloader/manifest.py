@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+
+"""
+manifest.py:
+SQLite manifest of downloaded chunks in a storage path
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+
+from .planner import value_label
+
+MANIFEST_NAME = ".cds_manifest.sqlite"
+
+STATUS_PENDING = "pending"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    file_name TEXT PRIMARY KEY,
+    product TEXT NOT NULL,
+    filter_hash TEXT,
+    split_keys TEXT NOT NULL,
+    split_values TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    checksum TEXT,
+    status TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_split ON chunks (product, split_keys, status);
+CREATE TABLE IF NOT EXISTS members (
+    file_name TEXT PRIMARY KEY,
+    target TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS members_target ON members (target, offset);
+"""
+
+
+def canonical_filter(cds_product, cds_filter):
+    """Canonical json representation of a cds request
+
+    Single values and one element lists are equivalent for the cds, lists are
+    sorted, hence the same request always results in the same string.
+    """
+    dct = {}
+    for k, v in cds_filter.items():
+        if isinstance(v, (list, tuple)):
+            v = [str(i) for i in v]
+            # Keep order of area and grid, they are coordinates
+            if k not in ("area", "grid"):
+                v = sorted(v)
+            if len(v) == 1 and k not in ("area", "grid"):
+                v = v[0]
+        else:
+            v = str(v)
+        dct[k] = v
+    return json.dumps({"product": cds_product, "filter": dct}, sort_keys=True)
+
+
+def filter_hash(cds_product, cds_filter):
+    """Hash of the canonical cds request"""
+    return hashlib.sha256(canonical_filter(cds_product, cds_filter).encode()).hexdigest()
+
+
+def file_checksum(file_name, block_size=1 << 20):
+    """BLAKE2b checksum of a file"""
+    h = hashlib.blake2b()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Manifest(object):
+    """The :class:`Manifest` class keeps an index of all chunks of a data
+    collection in a SQLite database in the storage path.
+
+    Each row records the product, the hash of the full cds filter, the values
+    of the split keys, size, mtime, checksum and the download status of one
+    file. Every update is a single transaction, therefore the manifest is
+    consistent even if a run is killed.
+
+    """
+
+    def __init__(self, storage_path, name=MANIFEST_NAME):
+        """
+        Parameters
+        ----------
+        storage_path : string
+            storage path of the data collection
+        name : string, optional
+            file name of the manifest database
+        """
+        self.storage_path = str(storage_path)
+        self.path = os.path.join(self.storage_path, name)
+        self._connection = None
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        return state
+
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            os.makedirs(self.storage_path, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.executescript(_SCHEMA)
+        return self._connection
+
+
+    def _readable(self):
+        # Reading must not create a database, e.g. for dry runs
+        return self._connection is not None or os.path.exists(self.path)
+
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+    def record(self, file_name, cds_product, cds_filter, split_keys, status=STATUS_DONE,
+               file_path=None, checksum=None):
+        """Insert or replace the entry of a chunk
+
+        Parameters
+        ----------
+        file_name : string
+            file name relative to the storage path
+        cds_product : string
+            the cds product string
+        cds_filter : dict
+            the cds filter of the chunk
+        split_keys : list of strings
+            split keys of the data collection
+        status : string, optional
+            one of 'pending', 'done' or 'failed'
+        file_path : string, optional
+            current location of the file, defaults to file_name in the storage
+            path. Size and mtime are taken from this file if it exists.
+        checksum : string, optional
+            checksum of the file, computed if status is 'done' and no
+            checksum is given
+        """
+        file_path = file_path or os.path.join(self.storage_path, file_name)
+        size, mtime = None, None
+        if os.path.exists(file_path):
+            stat = os.stat(file_path)
+            size, mtime = stat.st_size, stat.st_mtime
+            if status == STATUS_DONE and checksum is None:
+                checksum = file_checksum(file_path)
+
+        split_values = [value_label(cds_filter.get(k)) for k in split_keys]
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (file_name, cds_product, filter_hash(cds_product, cds_filter),
+                 json.dumps(list(split_keys)), json.dumps(split_values),
+                 size, mtime, checksum, status, time.time()))
+
+
+    def get(self, file_name):
+        """Get the entry of a chunk as dict or None"""
+        if not self._readable():
+            return None
+        cursor = self.connection.execute("SELECT * FROM chunks WHERE file_name = ?", (file_name,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return self._entry(cursor, row)
+
+
+    def entries(self, status=None):
+        """List the entries of all chunks, optionally with the given status"""
+        if not self._readable():
+            return []
+        if status is None:
+            cursor = self.connection.execute("SELECT * FROM chunks ORDER BY file_name")
+        else:
+            cursor = self.connection.execute(
+                "SELECT * FROM chunks WHERE status = ? ORDER BY file_name", (status,))
+        return [self._entry(cursor, row) for row in cursor.fetchall()]
+
+
+    def set_status(self, file_name, status):
+        """Change the status of a chunk, e.g. mark a corrupt file as failed"""
+        with self.connection:
+            self.connection.execute("UPDATE chunks SET status = ?, updated = ? WHERE file_name = ?",
+                                    (status, time.time(), file_name))
+
+
+    def members(self, target=None):
+        """Chunks merged into aggregated files as list of (file_name, target,
+        offset, length), optionally of a single target file"""
+        if not self._readable():
+            return []
+        if target is None:
+            return self.connection.execute(
+                "SELECT file_name, target, offset, length FROM members ORDER BY target, offset").fetchall()
+        return self.connection.execute(
+            "SELECT file_name, target, offset, length FROM members WHERE target = ? ORDER BY offset",
+            (target,)).fetchall()
+
+
+    def set_members(self, target, members):
+        """Replace the chunks of an aggregated file in one transaction
+
+        Parameters
+        ----------
+        target : string
+            file name of the aggregated file relative to the storage path
+        members : list of tuples
+            (file_name, offset, length) of each chunk in the aggregated file
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM members WHERE target = ?", (target,))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?)",
+                [(file_name, target, offset, length) for file_name, offset, length in members])
+
+
+    @staticmethod
+    def _entry(cursor, row):
+        entry = dict(zip([c[0] for c in cursor.description], row))
+        entry["split_keys"] = json.loads(entry["split_keys"])
+        entry["split_values"] = json.loads(entry["split_values"])
+        return entry
+
+
+    def status(self, file_name):
+        """Download status of a chunk or None if it is unknown"""
+        if not self._readable():
+            return None
+        row = self.connection.execute(
+            "SELECT status FROM chunks WHERE file_name = ?", (file_name,)).fetchone()
+        return row[0] if row else None
+
+
+    def split_values(self, cds_product, split_keys, status=STATUS_DONE):
+        """Set of split key value tuples of all chunks with the given status
+
+        Parameters
+        ----------
+        cds_product : string
+            the cds product string
+        split_keys : list of strings
+            split keys of the data collection
+        status : string, optional
+            download status of the chunks
+        """
+        if not self._readable():
+            return set()
+        rows = self.connection.execute(
+            "SELECT split_values FROM chunks WHERE product = ? AND split_keys = ? AND status = ?",
+            (cds_product, json.dumps(list(split_keys)), status))
+        return {tuple(json.loads(row[0])) for row in rows}
+
+
+    def __len__(self):
+        if not self._readable():
+            return 0
+        return self.connection.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+
+    def rebuild(self, cds_product, split_keys, candidates, file_format="grib", checksum=False):
+        """Rebuild the manifest from the files of an existing data collection
+
+        File names are parsed against the candidate values of each split key,
+        hence values containing underscores are recognized correctly.
+
+        Parameters
+        ----------
+        cds_product : string
+            the cds product string
+        split_keys : list of strings
+            split keys of the data collection
+        candidates : dict
+            list of possible values for each split key
+        file_format : string, optional
+            file extension of the data collection
+        checksum : boolean, optional
+            compute the checksum of every file (requires reading all data)
+
+        Returns
+        -------
+        count : int
+            number of recorded files
+        """
+        suffix = "_{}.{}".format(cds_product, file_format)
+        count = 0
+        with self.connection:
+            for entry in os.scandir(self.storage_path):
+                if not entry.is_file() or not entry.name.endswith(suffix):
+                    continue
+                values = parse_split_values(entry.name[:-len(suffix)], split_keys, candidates)
+                if values is None:
+                    logging.warning('File name does not match split keys: ' + entry.name)
+                    continue
+                stat = entry.stat()
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (entry.name, cds_product, None,
+                     json.dumps(list(split_keys)), json.dumps(list(values)),
+                     stat.st_size, stat.st_mtime,
+                     file_checksum(entry.path) if checksum else None,
+                     STATUS_DONE, time.time()))
+                count += 1
+        logging.info('Manifest rebuilt with {} files: {}'.format(count, self.path))
+        return count
+
+
+def parse_split_values(prefix, split_keys, candidates):
+    """Split a file name prefix into the values of the split keys
+
+    Returns a tuple of values or None if the prefix does not match.
+    """
+    if not split_keys:
+        return () if prefix == "all" else None
+
+    key, rest_keys = split_keys[0], split_keys[1:]
+    values = candidates.get(key)
+    if values is None:
+        # Without candidates assume values without underscores
+        values = [prefix.split("_", 1)[0]]
+
+    # Prefer long values, e.g. '2m_temperature' over '2m'
+    for value in sorted((str(v) for v in values), key=len, reverse=True):
+        if rest_keys:
+            if not prefix.startswith(value + "_"):
+                continue
+            rest = parse_split_values(prefix[len(value) + 1:], rest_keys, candidates)
+            if rest is not None:
+                return (value,) + rest
+        elif prefix == value:
+            return (value,)
+    return None
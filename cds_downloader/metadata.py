@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""
+metadata.py:
+On-disk cache for cds product metadata from the webapi
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import os
+import json
+import time
+import tempfile
+import threading
+import logging
+
+import requests
+
+
+WEBAPI_URL = 'https://cds.climate.copernicus.eu/api/v2.ui/resources/{}'
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "cds_downloader", "metadata")
+
+
+class MetadataCache(object):
+    """The :class:`MetadataCache` class keeps the cds webapi metadata of each
+    product in a json file on disk.
+
+    Entries younger than `ttl` seconds are used without any request. Older
+    entries are revalidated with ETag/If-Modified-Since headers, therefore an
+    unchanged product costs a single 304 response. Within another
+    `stale_while_revalidate` seconds the stale entry is returned immediately
+    and revalidated in a background thread. If the webapi is slow or
+    unreachable, any stale entry is used as fallback.
+
+    """
+
+    def __init__(self, cache_dir=None, ttl=3600, stale_while_revalidate=0,
+                 timeout=10, url=WEBAPI_URL, session=None):
+        """
+        Parameters
+        ----------
+        cache_dir : string, optional
+            directory of the cache files, defaults to DEFAULT_CACHE_DIR
+        ttl : int or float, optional
+            time to live of a cache entry in seconds
+        stale_while_revalidate : int or float, optional
+            period after ttl in seconds, where stale entries are returned
+            immediately and revalidated in the background
+        timeout : int or float, optional
+            timeout of webapi requests in seconds
+        url : string, optional
+            webapi url template with a placeholder for the product name
+        session : requests.Session, optional
+            http session used for webapi requests
+        """
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.timeout = timeout
+        self.url = url
+        self.session = session
+
+
+    def get(self, cds_product, max_age=None):
+        """Get metadata of a cds product from cache or webapi
+
+        Parameters
+        ----------
+        cds_product : string
+            the cds product string
+        max_age : int or float, optional
+            maximum age of the entry in seconds instead of ttl, e.g. 0
+            revalidates the entry
+
+        Returns
+        -------
+        metadata : dict
+            webapi metadata of the product
+        """
+        entry = self._load(cds_product)
+        if entry is None:
+            return self._fetch(cds_product)["data"]
+
+        ttl = self.ttl if max_age is None else max_age
+        age = time.time() - entry["fetched"]
+        if age <= ttl:
+            return entry["data"]
+
+        if max_age is None and age <= ttl + self.stale_while_revalidate:
+            threading.Thread(target=self._revalidate, args=(cds_product, entry), daemon=True).start()
+            return entry["data"]
+
+        return self._revalidate(cds_product, entry)["data"]
+
+
+    def invalidate(self, cds_product):
+        """Remove a product from the cache"""
+        try:
+            os.remove(self._path(cds_product))
+        except OSError:
+            pass
+
+
+    def _path(self, cds_product):
+        return os.path.join(self.cache_dir, "{}.json".format(cds_product))
+
+
+    def _load(self, cds_product):
+        try:
+            with open(self._path(cds_product), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+    def _save(self, cds_product, entry):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, path_temp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(path_temp, self._path(cds_product))
+        except Exception:
+            os.remove(path_temp)
+            raise
+
+
+    def _get(self, url, headers):
+        getter = self.session.get if self.session is not None else requests.get
+        return getter(url, headers=headers, timeout=self.timeout)
+
+
+    def _fetch(self, cds_product, entry=None):
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = self._get(self.url.format(cds_product), headers)
+
+        if response.status_code == 304 and entry is not None:
+            logging.info('Metadata of {} not modified'.format(cds_product))
+            entry["fetched"] = time.time()
+        else:
+            response.raise_for_status()
+            entry = {"fetched": time.time(),
+                     "etag": response.headers.get("ETag"),
+                     "last_modified": response.headers.get("Last-Modified"),
+                     "data": response.json()}
+            logging.info('Metadata of {} fetched from webapi'.format(cds_product))
+
+        try:
+            self._save(cds_product, entry)
+        except OSError as e:
+            logging.warning('Metadata cache not writable: ' + repr(e))
+        return entry
+
+
+    def _revalidate(self, cds_product, entry):
+        try:
+            return self._fetch(cds_product, entry)
+        except requests.exceptions.RequestException as e:
+            logging.warning('Metadata of {} could not be revalidated, use stale cache entry: {}'.format(
+                cds_product, repr(e)))
+            return entry
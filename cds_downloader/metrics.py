@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+
+"""
+metrics.py:
+Per-chunk timing events and their export as json lines and prometheus metrics
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import os
+import sys
+import json
+import time
+import threading
+import logging
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+EVENT_PLANNED = "planned"
+EVENT_SUBMITTED = "submitted"
+EVENT_QUEUED = "queued"
+EVENT_RUNNING = "running"
+EVENT_DOWNLOADING = "downloading"
+EVENT_DONE = "done"
+EVENT_FAILED = "failed"
+EVENT_RETRY = "retry"
+EVENT_RUN = "run"
+EVENT_CONCURRENCY = "concurrency"
+
+CHUNK_EVENTS = [EVENT_PLANNED, EVENT_SUBMITTED, EVENT_QUEUED, EVENT_RUNNING,
+                EVENT_DOWNLOADING, EVENT_DONE, EVENT_FAILED, EVENT_RETRY]
+
+# Phases of a chunk as (name, start events, end events), the first recorded event counts
+PHASES = [
+    ("queue", [EVENT_QUEUED, EVENT_SUBMITTED], [EVENT_RUNNING, EVENT_DOWNLOADING]),
+    ("running", [EVENT_RUNNING], [EVENT_DOWNLOADING]),
+    ("download", [EVENT_DOWNLOADING], [EVENT_DONE, EVENT_FAILED]),
+    ("total", [EVENT_PLANNED, EVENT_SUBMITTED], [EVENT_DONE, EVENT_FAILED]),
+]
+
+
+def _first(times, events):
+    for event in events:
+        if event in times:
+            return times[event]
+    return None
+
+
+def phase_seconds(times):
+    """Duration of each phase of a chunk from the timestamps of its events
+
+    Parameters
+    ----------
+    times : dict
+        timestamp of each recorded event of the chunk
+
+    Returns
+    -------
+    seconds : dict
+        seconds of each phase with start and end event
+    """
+    seconds = {}
+    for phase, start_events, end_events in PHASES:
+        start, end = _first(times, start_events), _first(times, end_events)
+        if start is not None and end is not None:
+            seconds[phase] = max(end - start, 0.)
+    return seconds
+
+
+class Metrics(object):
+    """The :class:`Metrics` class records the events of every chunk of a run
+    (planned, submitted, queued, running, downloading, done and failed) and
+    hands each of them to its sinks.
+
+    An event is a dict with the event type, the file name, the product and a
+    unix timestamp. Terminal events (done, failed) additionally carry the
+    seconds of each phase (queue, running, download, total), the bytes, the
+    throughput in bytes per second and the number of transfer retries. The
+    end of a run is reported as a 'run' event with its aggregates, see
+    :meth:`summary`.
+
+    A sink is any callable taking the event dict, e.g. :class:`JsonLinesSink`
+    or :class:`PrometheusTextfileSink`. Sinks with a `close` method are
+    closed by :meth:`close`. Sinks are not passed to process workers, events
+    of process workers are therefore only reported from the main process
+    (planned, done and failed).
+
+    """
+
+    def __init__(self, sinks=None):
+        """
+        Parameters
+        ----------
+        sinks : list of callables, optional
+            receivers of every event
+        """
+        self.sinks = list(sinks or [])
+        self._lock = threading.Lock()
+        self.start_run()
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["sinks"] = []
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    def add_sink(self, sink):
+        """Add a receiver of every event"""
+        self.sinks.append(sink)
+
+
+    def start_run(self):
+        """Forget the chunks of the last run"""
+        with self._lock:
+            self.run_start = time.time()
+            self.chunks = {}
+
+
+    def emit(self, event, file_name, product=None, **fields):
+        """Record an event of a chunk and hand it to the sinks
+
+        Parameters
+        ----------
+        event : string
+            one of CHUNK_EVENTS
+        file_name : string
+            file name of the chunk
+        product : string, optional
+            cds product of the chunk
+        fields : optional
+            further fields of the event, e.g. request_id, bytes or error
+
+        Returns
+        -------
+        event : dict
+        """
+        now = time.time()
+        name = os.path.basename(file_name)
+        with self._lock:
+            chunk = self.chunks.setdefault(name, {"times": {}, "retries": 0, "bytes": 0, "product": product})
+            if event == EVENT_RETRY:
+                # The phases of a failed attempt are measured again
+                chunk["times"] = {k: v for k, v in chunk["times"].items() if k == EVENT_PLANNED}
+                chunk["retries"] += 1
+            chunk["times"].setdefault(event, now)
+            chunk["product"] = product or chunk["product"]
+            chunk["bytes"] = fields.get("bytes", chunk["bytes"])
+            record = {"event": event, "file_name": name, "product": chunk["product"], "time": now}
+            if event in (EVENT_DONE, EVENT_FAILED):
+                seconds = phase_seconds(chunk["times"])
+                record.update({"{}_seconds".format(k): v for k, v in seconds.items()})
+                record["bytes"] = chunk["bytes"]
+                record["retries"] = chunk["retries"]
+                if seconds.get("download"):
+                    record["throughput"] = chunk["bytes"] / seconds["download"]
+            record.update(fields)
+        self._send(record)
+        return record
+
+
+    def retry(self, file_name):
+        """Count a retry of the transfer of a chunk"""
+        with self._lock:
+            chunk = self.chunks.setdefault(os.path.basename(file_name),
+                                           {"times": {}, "retries": 0, "bytes": 0, "product": None})
+            chunk["retries"] += 1
+
+
+    def summary(self):
+        """Aggregates of the current run
+
+        Returns
+        -------
+        summary : dict
+            number of planned, done and failed chunks, bytes, retries, wall
+            seconds and throughput of the run, mean and max seconds of each
+            phase
+        """
+        with self._lock:
+            chunks = list(self.chunks.values())
+            wall_seconds = time.time() - self.run_start
+
+        summary = {
+            "chunks": len(chunks),
+            "done": sum(1 for c in chunks if EVENT_DONE in c["times"]),
+            "failed": sum(1 for c in chunks if EVENT_FAILED in c["times"]),
+            "bytes": sum(c["bytes"] for c in chunks if EVENT_DONE in c["times"]),
+            "retries": sum(c["retries"] for c in chunks),
+            "wall_seconds": wall_seconds,
+        }
+        summary["throughput"] = summary["bytes"] / wall_seconds if wall_seconds > 0 else None
+        for phase, start_events, end_events in PHASES:
+            values = [phase_seconds(c["times"]).get(phase) for c in chunks]
+            values = [v for v in values if v is not None]
+            if values:
+                summary["{}_seconds_mean".format(phase)] = sum(values) / len(values)
+                summary["{}_seconds_max".format(phase)] = max(values)
+        return summary
+
+
+    def finish_run(self, product=None):
+        """Report the aggregates of the current run as 'run' event"""
+        record = dict(self.summary(), event=EVENT_RUN, product=product, time=time.time())
+        logging.info('Run finished: {done} of {chunks} chunks done, {failed} failed, '
+                     '{bytes} bytes in {wall_seconds:.1f} seconds'.format(**record))
+        self._send(record)
+        return record
+
+
+    def report(self, event, **fields):
+        """Hand an event, which does not belong to a chunk, to the sinks,
+        e.g. a change of the concurrency limit"""
+        record = dict(fields, event=event, time=time.time())
+        self._send(record)
+        return record
+
+
+    def close(self):
+        """Close all sinks with a close method"""
+        for sink in self.sinks:
+            if hasattr(sink, "close"):
+                sink.close()
+
+
+    def _send(self, record):
+        for sink in self.sinks:
+            try:
+                sink(record)
+            except Exception as e:
+                # A broken sink must not fail the downloads
+                logging.warning('Metrics sink {} failed: {}'.format(sink, repr(e)))
+
+
+class JsonLinesSink(object):
+    """Append every event as a line of json to a file"""
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : string
+            path of the json lines file, '-' writes to stdout
+        """
+        self.path = str(path)
+        self._lock = threading.Lock()
+        if self.path == "-":
+            self._file = sys.stdout
+        else:
+            self._file = open(self.path, 'a')
+
+
+    def __call__(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+
+    def close(self):
+        if self._file is not None and self.path != "-":
+            self._file.close()
+        self._file = None
+
+
+def _labels(**labels):
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in sorted(labels.items()) if v is not None) + "}"
+
+
+class PrometheusSink(object):
+    """Aggregate events into counters and gauges in the prometheus text
+    exposition format, see :meth:`render`"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.events = {}
+        self.bytes = {}
+        self.retries = {}
+        self.phases = {}
+        self.last_run = {}
+        self.concurrency = None
+
+
+    def __call__(self, record):
+        product = record.get("product")
+        with self._lock:
+            if record["event"] == EVENT_RUN:
+                self.last_run[product] = record
+                return
+            if record["event"] == EVENT_CONCURRENCY:
+                self.concurrency = record
+                return
+            key = (product, record["event"])
+            self.events[key] = self.events.get(key, 0) + 1
+            if record["event"] in (EVENT_DONE, EVENT_FAILED):
+                if record["event"] == EVENT_DONE:
+                    self.bytes[product] = self.bytes.get(product, 0) + record.get("bytes", 0)
+                self.retries[product] = self.retries.get(product, 0) + record.get("retries", 0)
+                for phase, start_events, end_events in PHASES:
+                    seconds = record.get("{}_seconds".format(phase))
+                    if seconds is not None:
+                        total, count = self.phases.get((product, phase), (0., 0))
+                        self.phases[(product, phase)] = (total + seconds, count + 1)
+
+
+    def render(self):
+        """Current metrics in the prometheus text exposition format"""
+        with self._lock:
+            lines = [
+                "# HELP cds_downloader_chunk_events_total Events of chunks by type",
+                "# TYPE cds_downloader_chunk_events_total counter",
+            ]
+            lines += ["cds_downloader_chunk_events_total{} {}".format(_labels(product=p, event=e), v)
+                      for (p, e), v in sorted(self.events.items(), key=str)]
+            lines += [
+                "# HELP cds_downloader_bytes_total Bytes of finished chunks",
+                "# TYPE cds_downloader_bytes_total counter",
+            ]
+            lines += ["cds_downloader_bytes_total{} {}".format(_labels(product=p), v)
+                      for p, v in sorted(self.bytes.items(), key=str)]
+            lines += [
+                "# HELP cds_downloader_retries_total Retries of chunk transfers",
+                "# TYPE cds_downloader_retries_total counter",
+            ]
+            lines += ["cds_downloader_retries_total{} {}".format(_labels(product=p), v)
+                      for p, v in sorted(self.retries.items(), key=str)]
+            lines += [
+                "# HELP cds_downloader_phase_seconds Seconds of chunks in the cds queue, cds processing, "
+                "transfer and in total",
+                "# TYPE cds_downloader_phase_seconds summary",
+            ]
+            for (p, phase), (total, count) in sorted(self.phases.items(), key=str):
+                lines.append("cds_downloader_phase_seconds_sum{} {}".format(_labels(product=p, phase=phase), total))
+                lines.append("cds_downloader_phase_seconds_count{} {}".format(_labels(product=p, phase=phase), count))
+            for name, key, help_text in [
+                    ("last_run_timestamp_seconds", "time", "End of the last run"),
+                    ("last_run_seconds", "wall_seconds", "Wall time of the last run"),
+                    ("last_run_chunks", "chunks", "Chunks of the last run"),
+                    ("last_run_failed", "failed", "Failed chunks of the last run")]:
+                lines.append("# HELP cds_downloader_{} {}".format(name, help_text))
+                lines.append("# TYPE cds_downloader_{} gauge".format(name))
+                lines += ["cds_downloader_{}{} {}".format(name, _labels(product=p), r[key])
+                          for p, r in sorted(self.last_run.items(), key=str)]
+            if self.concurrency is not None:
+                for name, key, help_text in [
+                        ("concurrency_limit", "limit", "Current limit of concurrent cds requests"),
+                        ("concurrency_min", "min_limit", "Lower bound of concurrent cds requests"),
+                        ("concurrency_max", "max_limit", "Upper bound of concurrent cds requests")]:
+                    lines.append("# HELP cds_downloader_{} {}".format(name, help_text))
+                    lines.append("# TYPE cds_downloader_{} gauge".format(name))
+                    lines.append("cds_downloader_{} {}".format(name, self.concurrency[key]))
+        return "\n".join(lines) + "\n"
+
+
+class PrometheusTextfileSink(PrometheusSink):
+    """Write the prometheus metrics into a file for the textfile collector
+    of the node exporter, the file is replaced atomically after every
+    finished chunk, run and change of the concurrency limit"""
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : string
+            path of the .prom file
+        """
+        super(PrometheusTextfileSink, self).__init__()
+        self.path = str(path)
+
+
+    def __call__(self, record):
+        super(PrometheusTextfileSink, self).__call__(record)
+        if record["event"] in (EVENT_DONE, EVENT_FAILED, EVENT_RUN, EVENT_CONCURRENCY):
+            self.write()
+
+
+    def write(self):
+        path_temp = self.path + ".tmp"
+        with open(path_temp, 'w') as f:
+            f.write(self.render())
+        os.replace(path_temp, self.path)
+
+
+    def close(self):
+        self.write()
+
+
+class PrometheusHTTPSink(PrometheusSink):
+    """Serve the prometheus metrics at /metrics of a local http server"""
+
+    def __init__(self, port, address=""):
+        """
+        Parameters
+        ----------
+        port : int
+            port of the http server, 0 picks a free port
+        address : string, optional
+            address to bind, all interfaces by default
+        """
+        super(PrometheusHTTPSink, self).__init__()
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = sink.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        logging.info('Serve prometheus metrics on port {}'.format(self.port))
+
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""
+planner.py:
+Chunk planner for cds requests exceeding the selection limit
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import operator
+
+from functools import reduce
+
+from .chunk_plan import ChunkPlan
+
+
+EXCLUDE_KEYS = ["area", "grid"]
+
+
+def value_label(value):
+    """Label of a split key value in file names, groups of values are
+    labelled with their first and last value (e.g. '01-06')"""
+    if isinstance(value, (list, tuple)):
+        if len(value) == 1:
+            return str(value[0])
+        return "{}-{}".format(value[0], value[-1])
+    return str(value)
+
+
+def group_values(values, n_groups):
+    """Partition values into n_groups consecutive groups of balanced size"""
+    n_groups = min(n_groups, len(values))
+    size, rest = divmod(len(values), n_groups)
+    groups, start = [], 0
+    for i in range(n_groups):
+        end = start + size + (1 if i < rest else 0)
+        groups.append(list(values[start:end]))
+        start = end
+    return groups
+
+
+def _product(values):
+    return reduce(operator.mul, values, 1)
+
+
+class Planner(object):
+    """The :class:`Planner` class partitions the value lists of a cds filter
+    into groups, such that the number of requests is minimal and every
+    request stays below the selection limit of the cds.
+
+    In contrast to splitting whole keys down to single values, a key can be
+    split into groups (e.g. two half years instead of twelve months). Among
+    plans with the same number of requests, plans with fewer split keys and
+    splits of keys earlier in the filter are preferred, hence the plan and
+    the resulting file names are deterministic.
+
+    """
+
+    def __init__(self, selection_limit, exclude_keys=None):
+        """
+        Parameters
+        ----------
+        selection_limit : int
+            maximum number of fields of a single request
+        exclude_keys : list of strings, optional
+            list-like keys, which are never split (default: area and grid)
+        """
+        self.selection_limit = selection_limit
+        self.exclude_keys = EXCLUDE_KEYS if exclude_keys is None else exclude_keys
+
+
+    def _org_keys(self, cds_filter):
+        return [k for k, v in cds_filter.items() if isinstance(v, list) and k not in self.exclude_keys]
+
+
+    def partition(self, cds_filter):
+        """Find the number of groups for every list-like key
+
+        Parameters
+        ----------
+        cds_filter : dict
+            the cds filter dictionary
+
+        Returns
+        -------
+        n_groups : dict
+            number of groups for each list-like key of the filter
+        """
+        keys = self._org_keys(cds_filter)
+        lengths = [len(cds_filter[k]) for k in keys]
+        limit = self.selection_limit
+
+        # Distinct group counts of a key are determined by the largest group size
+        candidates = [sorted({-(-n // size) for size in range(1, n + 1)}) for n in lengths]
+        rest_lengths = [_product(lengths[i:]) for i in range(len(lengths))] + [1]
+
+        best = {"score": None, "groups": None}
+
+        def score(groups):
+            return (_product(groups), sum(g > 1 for g in groups), [-g for g in groups])
+
+        def search(i, groups, size):
+            if size > limit:
+                return
+            count = _product(groups)
+            if best["score"] is not None:
+                # Lower bound of requests: total fields / limit
+                if count * max(1., size * rest_lengths[i] / float(limit)) > best["score"][0]:
+                    return
+            if i == len(keys):
+                current = score(groups)
+                if best["score"] is None or current < best["score"]:
+                    best.update(score=current, groups=list(groups))
+                return
+            for g in candidates[i]:
+                search(i + 1, groups + [g], size * -(-lengths[i] // g))
+
+        search(0, [], 1)
+        if best["groups"] is None:
+            raise ValueError("Request can not be split below the selection limit of {}".format(limit))
+        return dict(zip(keys, best["groups"]))
+
+
+    def plan(self, cds_filter):
+        """Plan the chunks of a cds request
+
+        Parameters
+        ----------
+        cds_filter : dict
+            the cds filter dictionary
+
+        Returns
+        -------
+        split_keys : list of strings
+            keys split into more than one group, in order of the filter
+        groups : dict
+            list of value groups for each split key
+        """
+        n_groups = self.partition(cds_filter)
+        split_keys = [k for k, g in n_groups.items() if g > 1]
+        groups = {k: group_values(cds_filter[k], n_groups[k]) for k in split_keys}
+        return split_keys, groups
+
+
+    @staticmethod
+    def expand(cds_filter, split_keys, groups):
+        """Plan of one cds filter for every combination of groups, single
+        values are unpacked from their group, see
+        :class:`cds_downloader.chunk_plan.ChunkPlan`"""
+        return ChunkPlan(cds_filter, split_keys, {k: [group[0] if len(group) == 1 else group
+                                                      for group in groups[k]] for k in split_keys})
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""
+priority.py:
+Priority policies for the order in which chunks are requested
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+from collections.abc import Sequence
+
+from .gaps import TEMPORAL_KEYS
+
+
+PRIORITIES = ["plan", "newest", "oldest", "round-robin", "cheapest"]
+
+
+def _as_list(value):
+    return value if isinstance(value, (list, tuple)) else [value]
+
+
+def _temporal_part(key, value):
+    # Integer of a temporal filter value, e.g. '06:00' -> 6
+    try:
+        return int(str(value).split(":")[0])
+    except ValueError:
+        return 0
+
+
+def chunk_period(cds_filter, last=True):
+    """Last (or first) date of a chunk as tuple of year, month, day and hour
+
+    Missing temporal keys cover the whole range and do not change the order
+    of chunks.
+    """
+    period = []
+    for key in TEMPORAL_KEYS:
+        if key not in cds_filter:
+            period.append(0)
+            continue
+        parts = [_temporal_part(key, v) for v in _as_list(cds_filter[key])]
+        period.append(max(parts) if last else min(parts))
+    return tuple(period)
+
+
+def chunk_size(cds_filter):
+    """Number of value combinations of a chunk, a measure of its cost"""
+    size = 1
+    for key, value in cds_filter.items():
+        if isinstance(value, list) and key not in ("area", "grid"):
+            size *= len(value)
+    return size
+
+
+def newest_first(cds_filter):
+    """Priority key of the newest chunks first"""
+    return tuple(-p for p in chunk_period(cds_filter, last=True))
+
+
+def oldest_first(cds_filter):
+    """Priority key of the oldest chunks first"""
+    return chunk_period(cds_filter, last=False)
+
+
+class RoundRobin(object):
+    """Priority key, which alternates between the values of a key (e.g. one
+    chunk of every variable in turn)
+
+    The key numbers the chunks of every value in order of evaluation, hence
+    it has to be evaluated in plan order, like :func:`sorted` does.
+
+    """
+
+    def __init__(self, key="variable"):
+        """
+        Parameters
+        ----------
+        key : string, optional
+            filter key, whose values take turns
+        """
+        self.key = key
+        self._counts = {}
+        self._order = {}
+
+
+    def __call__(self, cds_filter):
+        value = str(cds_filter.get(self.key))
+        count = self._counts.get(value, 0)
+        self._counts[value] = count + 1
+        return count, self._order.setdefault(value, len(self._order))
+
+
+def priority_key(priority):
+    """Key function of a priority policy
+
+    Parameters
+    ----------
+    priority : string or callable
+        one of :data:`PRIORITIES` or a function of the cds filter of a chunk,
+        chunks with smaller keys are requested first
+
+    Returns
+    -------
+    key : callable or None
+        None keeps the order of the plan
+    """
+    if priority is None or priority == "plan":
+        return None
+    if callable(priority):
+        return priority
+    if priority == "newest":
+        return newest_first
+    if priority == "oldest":
+        return oldest_first
+    if priority == "round-robin":
+        return RoundRobin()
+    if priority == "cheapest":
+        return chunk_size
+    raise ValueError("The parameter priority has to be a callable or one of {}".format(PRIORITIES))
+
+
+def prioritize(chunks, priority):
+    """Order chunks by a priority policy
+
+    The sort is stable, chunks with the same key keep the order of the plan.
+    Plans with random access (see :class:`cds_downloader.chunk_plan.ChunkPlan`)
+    are sorted by position, their filters are only created when they are
+    consumed.
+
+    Parameters
+    ----------
+    chunks : iterable of dicts
+        cds filters of the chunks in plan order
+    priority : string or callable
+        see :func:`priority_key`
+
+    Returns
+    -------
+    chunks : iterable of dicts
+        cds filters of the chunks in order of priority
+    """
+    key = priority_key(priority)
+    if key is None:
+        return chunks
+    if isinstance(chunks, Sequence):
+        order = sorted(range(len(chunks)), key=lambda i: key(chunks[i]))
+        return (chunks[i] for i in order)
+    return iter(sorted(chunks, key=key))
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+
+"""
+result_cache.py:
+Content-addressed local cache of cds results
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import os
+import json
+import time
+import shutil
+import sqlite3
+import logging
+import datetime
+import itertools
+
+from .manifest import filter_hash, canonical_filter
+from .daily import GRIB_PARAMS
+from .grib_index import GribIndex, index_path
+from .integrity import IntegrityError, DATE_KEYS, expected_fields, verify_download
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "cds_downloader", "results")
+
+INDEX_NAME = "index.sqlite"
+
+# ioctl request of linux to clone a file (reflink)
+FICLONE = 0x40049409
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    product TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    filter TEXT
+);
+CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed);
+"""
+
+
+_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(size):
+    """Parse a size in bytes with an optional binary unit, e.g. '500M' or '2G'"""
+    if size is None:
+        return None
+    size = str(size).strip().upper().rstrip("B")
+    unit = size[-1:] if size[-1:] in _UNITS else ""
+    return int(float(size[:len(size) - len(unit)]) * _UNITS[unit])
+
+
+def _as_list(value):
+    return value if isinstance(value, (list, tuple)) else [value]
+
+
+def _number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def subset_criteria(cached, requested, params=None):
+    """Criteria of the GRIB messages of a cached result, which make up the
+    result of another request
+
+    The requests have to share their keys. Variables, dates, times and
+    pressure levels of the requested filter may be subsets of the cached
+    ones, every other key has to be equal.
+
+    Parameters
+    ----------
+    cached : dict
+        cds filter of the cached result
+    requested : dict
+        cds filter of the request
+    params : dict, optional
+        GRIB parameter of a variable name, extends
+        :data:`cds_downloader.daily.GRIB_PARAMS`
+
+    Returns
+    -------
+    criteria : dict or None
+        criteria of :meth:`cds_downloader.grib_index.GribIndex.select`, None
+        if the request is not a subset of the cached result
+    """
+    if set(cached) != set(requested) or requested.get("format", "grib") != "grib":
+        return None
+    params = dict(GRIB_PARAMS, **(params or {}))
+    criteria = {}
+    dates = False
+    for key, value in requested.items():
+        if key in ("area", "grid"):
+            # Coordinates, their order matters
+            if [str(v) for v in _as_list(value)] != [str(v) for v in _as_list(cached[key])]:
+                return None
+            continue
+        numeric = key in DATE_KEYS or key == "pressure_level"
+        wanted = {_number(v) if numeric else str(v) for v in _as_list(value)}
+        offered = {_number(v) if numeric else str(v) for v in _as_list(cached[key])}
+        if wanted == offered:
+            continue
+        if not wanted <= offered:
+            return None
+        if key == "variable":
+            if not all(v in params for v in wanted):
+                return None
+            criteria["param"] = sorted(params[v] for v in wanted)
+        elif key == "pressure_level":
+            criteria["level"] = sorted(wanted)
+        elif key in DATE_KEYS or key == "time":
+            dates = True
+        else:
+            return None
+
+    if dates:
+        # Messages are selected by their valid time, a day without times can not be told apart
+        if "time" not in requested or not all(k in requested for k in DATE_KEYS):
+            return None
+        valid_times = []
+        for year, month, day, time_of_day in itertools.product(
+                *[_as_list(requested[k]) for k in DATE_KEYS + ["time"]]):
+            try:
+                hour, minute = [int(t) for t in str(time_of_day).split(":")[:2]]
+                valid_times.append(datetime.datetime(int(year), int(month), int(day), hour, minute).isoformat())
+            except ValueError:
+                continue
+        criteria["valid_time"] = valid_times
+    return criteria
+
+
+def _reflink(source, target):
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def link_file(source, target):
+    """Make source available as target without copying the data if possible
+
+    A hard link is tried first, then a reflink (copy on write clone) and a
+    plain copy as last resort. The target is replaced atomically.
+
+    Returns
+    -------
+    method : string
+        'hardlink', 'reflink' or 'copy'
+    """
+    path_temp = target + ".link"
+    if os.path.exists(path_temp):
+        os.remove(path_temp)
+    try:
+        os.link(source, path_temp)
+        method = "hardlink"
+    except OSError:
+        try:
+            if fcntl is None:
+                raise OSError("reflinks are not supported")
+            _reflink(source, path_temp)
+            method = "reflink"
+        except OSError:
+            shutil.copyfile(source, path_temp)
+            method = "copy"
+    os.replace(path_temp, target)
+    return method
+
+
+class ResultCache(object):
+    """The :class:`ResultCache` class stores every cds result once, addressed
+    by the hash of its canonical product and filter (see
+    :func:`cds_downloader.manifest.filter_hash`).
+
+    Results are linked into every storage path and file layout that requests
+    them, hence the same data requested by another configuration or storage
+    path is not fetched from the cds again. A request of another split
+    layout, which is part of a cached GRIB result (e.g. a month of a yearly
+    chunk), is extracted from it by its variables, valid times and pressure
+    levels (see :func:`subset_criteria`) and verified against the number of
+    fields of the request. An index in SQLite keeps size, filter and last
+    access of each entry, the least recently used entries are evicted as soon
+    as the cache exceeds `max_size` bytes.
+
+    """
+
+    def __init__(self, cache_dir=None, max_size=None):
+        """
+        Parameters
+        ----------
+        cache_dir : string, optional
+            directory of the cache, defaults to DEFAULT_CACHE_DIR
+        max_size : int, optional
+            maximum size of the cache in bytes, unbounded if None
+        """
+        self.cache_dir = str(cache_dir or DEFAULT_CACHE_DIR)
+        self.max_size = max_size
+
+
+    def _connect(self):
+        # One short lived connection per operation, the cache is shared by threads and processes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        connection = sqlite3.connect(os.path.join(self.cache_dir, INDEX_NAME), timeout=60)
+        connection.executescript(_SCHEMA)
+        # Entries of caches created before the filters were kept only serve identical requests
+        if "filter" not in [row[1] for row in connection.execute("PRAGMA table_info(results)")]:
+            with connection:
+                connection.execute("ALTER TABLE results ADD COLUMN filter TEXT")
+        return connection
+
+
+    def path(self, key):
+        """File path of a cache entry"""
+        return os.path.join(self.cache_dir, key[:2], key)
+
+
+    def get(self, cds_product, cds_filter, target, params=None):
+        """Link a cached result into target, or extract it from a cached
+        result of a larger request
+
+        Parameters
+        ----------
+        cds_product : string
+            cds product of the request
+        cds_filter : dict
+            cds filter of the request
+        target : string
+            path of the result
+        params : dict, optional
+            GRIB parameter of a variable name, see :func:`subset_criteria`
+
+        Returns
+        -------
+        target : string or None
+            target, None if the result is not cached
+        """
+        key = filter_hash(cds_product, cds_filter)
+        path = self.path(key)
+        if os.path.exists(path):
+            method = link_file(path, target)
+        else:
+            key = self._extract(cds_product, cds_filter, target, params)
+            if key is None:
+                return None
+            method = "subset of {}".format(key)
+
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("UPDATE results SET accessed = ?, hits = hits + 1 WHERE key = ?",
+                                   (time.time(), key))
+        finally:
+            connection.close()
+        logging.info('Result cache hit for {} ({})'.format(target, method))
+        return target
+
+
+    def _extract(self, cds_product, cds_filter, target, params=None):
+        # Smallest cached result, which contains the request, only verifiable requests are extracted
+        if cds_filter.get("format", "grib") != "grib" or expected_fields(cds_filter) is None:
+            return None
+        connection = self._connect()
+        try:
+            rows = connection.execute("SELECT key, filter FROM results WHERE product = ? AND filter IS NOT NULL "
+                                      "ORDER BY size", (cds_product,)).fetchall()
+        finally:
+            connection.close()
+        for key, cached in rows:
+            criteria = subset_criteria(json.loads(cached)["filter"], cds_filter, params)
+            if criteria is None or not os.path.exists(self.path(key)):
+                continue
+            try:
+                if GribIndex(self.path(key)).extract(target, **criteria):
+                    verify_download(target, cds_filter)
+                    return key
+            except (OSError, IntegrityError) as e:
+                logging.warning('Result cache entry {} does not contain {}: {}'.format(key, target, repr(e)))
+            if os.path.exists(target):
+                os.remove(target)
+        return None
+
+
+    def put(self, cds_product, cds_filter, source):
+        """Add a downloaded result to the cache and evict least recently used
+        entries beyond max_size
+
+        Returns
+        -------
+        key : string
+            key of the cache entry
+        """
+        key = filter_hash(cds_product, cds_filter)
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        link_file(source, path)
+
+        now = time.time()
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO results (key, product, size, created, accessed, hits, filter) "
+                    "VALUES (?, ?, ?, ?, ?, 0, ?)",
+                    (key, cds_product, os.path.getsize(path), now, now, canonical_filter(cds_product, cds_filter)))
+        finally:
+            connection.close()
+
+        if self.max_size is not None:
+            self.prune(self.max_size)
+        return key
+
+
+    def stats(self):
+        """Number of entries, total size in bytes and hits of the cache"""
+        connection = self._connect()
+        try:
+            entries, size, hits = connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0) FROM results").fetchone()
+            products = dict(connection.execute(
+                "SELECT product, COUNT(*) FROM results GROUP BY product").fetchall())
+        finally:
+            connection.close()
+        return {"entries": entries, "size": size, "hits": hits,
+                "max_size": self.max_size, "products": products}
+
+
+    def prune(self, max_size=None):
+        """Evict least recently used entries until the cache is not larger
+        than max_size bytes, entries whose file is gone are dropped
+
+        Parameters
+        ----------
+        max_size : int, optional
+            size limit in bytes, defaults to the max_size of the cache, 0
+            empties the cache
+
+        Returns
+        -------
+        evicted : list of strings
+            keys of the evicted entries
+        """
+        if max_size is None:
+            max_size = self.max_size
+        evicted = []
+        connection = self._connect()
+        try:
+            with connection:
+                rows = connection.execute(
+                    "SELECT key, size FROM results ORDER BY accessed DESC").fetchall()
+                size = 0
+                for key, entry_size in rows:
+                    if not os.path.exists(self.path(key)):
+                        evicted.append(key)
+                        continue
+                    if max_size is not None and size + entry_size > max_size:
+                        evicted.append(key)
+                        os.remove(self.path(key))
+                        if os.path.exists(index_path(self.path(key))):
+                            os.remove(index_path(self.path(key)))
+                    else:
+                        size += entry_size
+                connection.executemany("DELETE FROM results WHERE key = ?", [(key,) for key in evicted])
+        finally:
+            connection.close()
+        if evicted:
+            logging.info('Evicted {} entries from the result cache'.format(len(evicted)))
+        return evicted
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""
+scheduler.py:
+Bounded worker pool for concurrent cds requests
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import random
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import wait, FIRST_COMPLETED
+
+
+DEFAULT_MAX_WORKERS = 8
+
+WORKER_TYPES = {
+    "thread": ThreadPoolExecutor,
+    "process": ProcessPoolExecutor,
+}
+
+
+def backoff_delay(attempt, backoff=60., backoff_max=3600.):
+    """Delay before a retry with exponential backoff and full jitter
+
+    The delay is drawn uniformly between zero and backoff * 2 ** attempt,
+    capped by backoff_max. The jitter spreads the retries of many chunks,
+    which failed at the same time, e.g. during an outage of the cds.
+
+    Parameters
+    ----------
+    attempt : int
+        number of failed attempts before this one, starting at 0
+    backoff : float, optional
+        base delay in seconds
+    backoff_max : float, optional
+        maximum delay in seconds
+    """
+    return random.uniform(0, min(backoff * 2 ** attempt, backoff_max))
+
+
+class Scheduler(object):
+    """The :class:`Scheduler` class runs download tasks with a bounded number
+    of concurrent workers.
+
+    Tasks are pulled lazily from an iterable, therefore a large chunk
+    generator (e.g. from :meth:`cds_downloader.Downloader._expand_by_keys`) is
+    never materialised. At most `max_workers` tasks are in flight, the
+    remaining tasks wait in the backlog of the iterable. With an adaptive
+    `limit` (see :class:`cds_downloader.concurrency.AdaptiveLimit`) the number
+    of tasks in flight follows its current value, bounded by `max_workers`.
+
+    """
+
+    def __init__(self, max_workers=None, worker_type="thread", limit=None):
+        """
+        Parameters
+        ----------
+        max_workers : int, optional
+            maximum number of concurrently running tasks, defaults to
+            DEFAULT_MAX_WORKERS
+        worker_type : string, optional
+            either 'thread' or 'process'
+        limit : cds_downloader.concurrency.AdaptiveLimit, optional
+            adaptive number of tasks in flight, only with 'thread' workers
+            (the events of process workers do not reach the limit)
+        """
+        if max_workers is None:
+            max_workers = DEFAULT_MAX_WORKERS
+        if max_workers < 1:
+            raise ValueError("max_workers has to be a positive integer")
+        if worker_type not in WORKER_TYPES:
+            raise ValueError("worker_type has to be one of {}".format(sorted(WORKER_TYPES)))
+        if limit is not None and worker_type == "process":
+            raise ValueError("An adaptive limit requires 'thread' workers")
+
+        self.max_workers = max_workers
+        self.worker_type = worker_type
+        self.limit = limit
+
+
+    def in_flight_limit(self):
+        """Current maximum number of tasks in flight"""
+        if self.limit is None:
+            return self.max_workers
+        return max(min(self.limit.value, self.max_workers), 1)
+
+
+    def run(self, fn, tasks):
+        """Run fn for every argument tuple in tasks and yield futures as soon
+        as they are finished.
+
+        Parameters
+        ----------
+        fn : callable
+            function executed by the workers
+        tasks : iterable of tuples
+            positional arguments for each call of fn
+
+        Yields
+        ------
+        future : concurrent.futures.Future
+            finished future, in order of completion, the arguments of the
+            task are available as future.task
+        """
+        tasks = iter(tasks)
+        pending = set()
+
+        with WORKER_TYPES[self.worker_type](max_workers=self.max_workers) as executor:
+            while True:
+                # Fill free slots from the backlog
+                while len(pending) < self.in_flight_limit():
+                    args = next(tasks, None)
+                    if args is None:
+                        break
+                    future = executor.submit(fn, *args)
+                    future.task = args
+                    pending.add(future)
+
+                if not pending:
+                    break
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is not None:
+                        logging.error('Download task failed: ' + repr(future.exception()))
+                    yield future
+
+
+    def run_fair(self, fn, groups, max_per_group=None, priorities=None):
+        """Run fn for the tasks of several groups (e.g. products) and share the
+        workers fairly between the groups.
+
+        A free worker is given to the group with the highest priority, among
+        groups of the same priority to the group with the fewest running
+        tasks, ties are broken by the group which waited longest. A group with
+        many tasks therefore can not starve the others of its priority, while
+        urgent groups take every free worker ahead of a long backfill.
+
+        Parameters
+        ----------
+        fn : callable
+            function executed by the workers
+        groups : dict
+            iterable of argument tuples for each group name, the iterables are
+            consumed lazily
+        max_per_group : int, optional
+            maximum number of concurrently running tasks of a group
+        priorities : dict, optional
+            priority of each group name, higher priorities are served first,
+            defaults to 0
+
+        Yields
+        ------
+        future : concurrent.futures.Future
+            finished future, in order of completion, the arguments of the
+            task are available as future.task and its group as future.group
+        """
+        backlog = {name: iter(tasks) for name, tasks in groups.items()}
+        order = list(backlog)
+        running = {name: 0 for name in backlog}
+        priorities = priorities or {}
+        pending = set()
+
+        def _next_task():
+            candidates = [name for name in order
+                          if max_per_group is None or running[name] < max_per_group]
+            for name in sorted(candidates, key=lambda n: (-priorities.get(n, 0), running[n])):
+                args = next(backlog[name], None)
+                if args is None:
+                    # Exhausted group
+                    order.remove(name)
+                    del backlog[name]
+                    continue
+                # The served group queues up behind the others
+                order.remove(name)
+                order.append(name)
+                return name, args
+            return None, None
+
+        with WORKER_TYPES[self.worker_type](max_workers=self.max_workers) as executor:
+            while True:
+                while len(pending) < self.in_flight_limit():
+                    name, args = _next_task()
+                    if args is None:
+                        break
+                    future = executor.submit(fn, *args)
+                    future.task = args
+                    future.group = name
+                    running[name] += 1
+                    pending.add(future)
+
+                if not pending:
+                    break
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running[future.group] -= 1
+                    if future.exception() is not None:
+                        logging.error('Download task failed: ' + repr(future.exception()))
+                    yield future
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+session.py:
+Shared http connection pool for all cds requests
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import logging
+
+import requests
+import cdsapi
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+DEFAULT_POOL_SIZE = 32
+DEFAULT_RETRIES = 3
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES, backoff_factor=1.):
+    """Create a keep-alive http session with a connection pool and retries
+
+    Only idempotent requests (GET, HEAD, DELETE) are retried by the adapter,
+    a request submission (POST) is never sent twice.
+
+    Parameters
+    ----------
+    pool_size : int, optional
+        maximum number of connections kept alive per host
+    retries : int, optional
+        number of retries on connection errors and retriable http status
+    backoff_factor : float, optional
+        backoff factor between retries in seconds
+
+    Returns
+    -------
+    session : requests.Session
+    """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUS,
+                  allowed_methods=frozenset(["GET", "HEAD", "DELETE"]), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def session_stats(session):
+    """Connection reuse statistics of a session
+
+    Returns
+    -------
+    stats : dict
+        number of opened connections, sent requests and requests on reused
+        connections of all pools of the session
+    """
+    connections, sent = 0, 0
+    for adapter in set(session.adapters.values()):
+        poolmanager = getattr(adapter, "poolmanager", None)
+        if poolmanager is None:
+            continue
+        for key in list(poolmanager.pools.keys()):
+            pool = poolmanager.pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                sent += pool.num_requests
+    return {"connections": connections, "requests": sent, "reused": max(0, sent - connections)}
+
+
+def log_session_stats(session):
+    stats = session_stats(session)
+    logging.info('HTTP session: {requests} requests over {connections} connections '
+                 '({reused} on reused connections)'.format(**stats))
+    return stats
+
+
+class Client(cdsapi.Client):
+    """The :class:`Client` class is a cdsapi client, which sends all requests,
+    including the status checks, over a shared session.
+
+    """
+
+    def __init__(self, session=None, **kwargs):
+        """
+        Parameters
+        ----------
+        session : requests.Session, optional
+            shared session, defaults to a new session from
+            :func:`create_session`
+        kwargs : optional
+            keyword arguments of cdsapi.Client
+        """
+        super(Client, self).__init__(**kwargs)
+        if session is None:
+            session = create_session()
+        session.auth = self.session.auth
+        self.session = session
+
+
+    def __getstate__(self):
+        # A process worker opens its own session
+        state = self.__dict__.copy()
+        state["session"] = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.session = create_session()
+        self.session.auth = tuple(self.key.split(':', 2))
+
+
+    def status(self, context=None):
+        r = self.session.get('%s/status.json' % (self.url,), verify=self.verify, timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()
@@ -0,0 +1,53 @@
+import pytest
+import cdsapi
+
+from cds_downloader import Downloader
+from cds_downloader.metadata import MetadataCache
+from cds_downloader.fake_cds import FakeCDS
+
+
+@pytest.fixture
+def fake_cds(tmp_path_factory, monkeypatch):
+    """Local fake cds server, cdsapi clients without explicit credentials are
+    configured to use it."""
+    fake = FakeCDS().start()
+    rc_file = tmp_path_factory.mktemp("cdsapirc") / ".cdsapirc"
+    rc_file.write_text("url: {}\nkey: 1:abcdef\n".format(fake.api_url))
+    monkeypatch.setenv("CDSAPI_RC", str(rc_file))
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def fake_client(fake_cds):
+    return cdsapi.Client(url=fake_cds.api_url, key="1:abcdef", quiet=True,
+                         progress=False, sleep_max=0.1)
+
+
+@pytest.fixture
+def fake_metadata_cache(fake_cds, tmp_path_factory):
+    return MetadataCache(cache_dir=str(tmp_path_factory.mktemp("metadata")),
+                         url=fake_cds.url + "/api/v2.ui/resources/{}")
+
+
+@pytest.fixture
+def product():
+    """cds product of the tests, the fake cds serves any product"""
+    return "reanalysis-era5-single-levels"
+
+
+@pytest.fixture
+def grib_params():
+    """GRIB parameter numbers of the variables of the tests, see
+    FakeCDS.params"""
+    return {"a": 10, "b": 11, "c": 12}
+
+
+@pytest.fixture
+def make_downloader(fake_metadata_cache, product):
+    """Factory of downloaders of a single field per variable"""
+    def make(variables, **kwargs):
+        return Downloader(product, {"format": "grib", "variable": variables, "year": ["2000"], "month": ["01"],
+                                    "day": ["01"], "time": ["00:00"]},
+                          metadata_cache=fake_metadata_cache, **kwargs)
+    return make
@@ -0,0 +1,105 @@
+import os
+import datetime
+import pytest
+
+from cds_downloader import Downloader
+from cds_downloader.aggregate import Aggregator, copy_range
+from cds_downloader.grib_index import GribIndex, index_path
+from cds_downloader.integrity import count_messages
+from cds_downloader.manifest import Manifest
+from cds_downloader.fake_cds import grib_messages
+
+
+PRODUCT = "reanalysis-era5-single-levels"
+SPLIT_KEYS = ["variable", "year", "month", "day"]
+
+
+def _chunk(storage_path, manifest, day, hours=2):
+    file_name = "t_2000_01_{}_{}.grib".format(day, PRODUCT)
+    path = str(storage_path / file_name)
+    with open(path, 'wb') as f:
+        f.write(grib_messages([(0, 0, datetime.datetime(2000, 1, int(day), h)) for h in range(hours)],
+                              100 * hours))
+    manifest.record(file_name, PRODUCT, {"variable": "t", "year": "2000", "month": "01", "day": day},
+                    SPLIT_KEYS)
+    return path, ["t", "2000", "01", day]
+
+
+def test_copy_range(tmp_path):
+    with open(str(tmp_path / "a"), 'wb') as f:
+        f.write(b"0123456789")
+    src = os.open(str(tmp_path / "a"), os.O_RDONLY)
+    dst = os.open(str(tmp_path / "b"), os.O_WRONLY | os.O_CREAT)
+    try:
+        assert copy_range(src, dst, 2, 5, 3) == 5
+    finally:
+        os.close(src)
+        os.close(dst)
+    with open(str(tmp_path / "b"), 'rb') as f:
+        assert f.read() == b"\x00\x00\x0023456"
+
+
+def test_incremental_aggregation(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    aggregator = Aggregator(str(tmp_path), PRODUCT, SPLIT_KEYS, period="month", manifest=manifest)
+    for day in ["02", "01", "03"]:
+        target = aggregator.add(*_chunk(tmp_path, manifest, day))
+
+    assert os.path.basename(target) == "t_2000_01_{}.grib".format(PRODUCT)
+    assert sorted(os.listdir(str(tmp_path))) == sorted([
+        ".cds_manifest.sqlite", os.path.basename(target), os.path.basename(index_path(target))])
+    assert count_messages(target) == 6
+    assert [(f[10:12], o, l) for f, t, o, l in manifest.members()] == [("02", 0, 200), ("01", 200, 200),
+                                                                      ("03", 400, 200)]
+    assert [m["offset"] for m in GribIndex(target).select(valid_time="2000-01-01T01:00:00")] == [300]
+    assert ("t", "2000", "01", "01") in manifest.split_values(PRODUCT, SPLIT_KEYS)
+
+
+def test_replace_and_recover(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    aggregator = Aggregator(str(tmp_path), PRODUCT, SPLIT_KEYS, period="year", manifest=manifest)
+    for day in ["01", "02"]:
+        target = aggregator.add(*_chunk(tmp_path, manifest, day))
+    assert os.path.basename(target) == "t_2000_{}.grib".format(PRODUCT)
+
+    # Uncommitted bytes of a crashed append
+    with open(target, 'ab') as f:
+        f.write(b"GRIB garbage")
+    # A chunk downloaded again replaces its old range
+    aggregator.add(*_chunk(tmp_path, manifest, "01", hours=3))
+    aggregator.add(*_chunk(tmp_path, manifest, "03"))
+
+    assert [(f[10:12], o, l) for f, t, o, l in manifest.members()] == [("02", 0, 200), ("01", 200, 300),
+                                                                      ("03", 500, 200)]
+    assert count_messages(target) == 7
+    assert len(GribIndex(target)) == 7
+
+
+def test_invalid_period():
+    with pytest.raises(ValueError):
+        Aggregator("x", PRODUCT, ["variable", "year"], period="month")
+    with pytest.raises(ValueError):
+        Aggregator("x", PRODUCT, SPLIT_KEYS, period="week")
+
+
+def test_get_and_update_aggregated(fake_cds, fake_metadata_cache, tmp_path):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    downloader = Downloader(PRODUCT, {"format": "grib", "variable": "2m_temperature",
+                                      "year": ["2000"], "month": ["01"], "day": ["01", "02", "03"],
+                                      "time": ["00:00", "12:00"]},
+                            metadata_cache=fake_metadata_cache, aggregate="month")
+    downloader.get_data(str(tmp_path), ["year", "month", "day"])
+
+    target = str(tmp_path / "2000_01_{}.grib".format(PRODUCT))
+    assert [p.name for p in tmp_path.glob("*.grib")] == [os.path.basename(target)]
+    assert count_messages(target) == 6
+    assert downloader.verify_data(str(tmp_path), ["year", "month", "day"]) == {}
+
+    # The manifest knows the aggregated chunks, only the last chunk is requested again
+    downloader.cds_filter.pop("day")
+    downloader.update_data(str(tmp_path), ["year", "month", "day"], date_until=datetime.datetime(2000, 1, 4),
+                           start_from_files=True)
+    assert sorted(r["day"] for p, r in fake_cds.submitted[3:]) == ["03", "04"]
+    # Updates request all times of a day
+    assert count_messages(target) == 2 * 2 + 2 * 24
+    assert len(Manifest(str(tmp_path)).members()) == 4
@@ -0,0 +1,90 @@
+import json
+import time
+import threading
+import pytest
+
+from cds_downloader.batch import Batch, BatchJob, config_paths
+from cds_downloader.scheduler import Scheduler
+
+
+def _config(path, product, variables, **job):
+    config = dict({"cds_product": product,
+                   "cds_filter": {"format": "grib", "variable": variables, "year": ["2000"],
+                                  "month": ["01"], "day": ["01"], "time": ["00:00"]}}, **job)
+    path.write_text(json.dumps(config))
+    return str(path)
+
+
+def test_run_fair():
+    lock = threading.Lock()
+    running = {"a": 0, "b": 0}
+    peak = {"a": 0, "b": 0}
+    started = []
+
+    def work(group, i):
+        with lock:
+            started.append(group)
+            running[group] += 1
+            peak[group] = max(peak[group], running[group])
+        time.sleep(0.01)
+        with lock:
+            running[group] -= 1
+        return group, i
+
+    groups = {"a": [("a", i) for i in range(20)], "b": [("b", i) for i in range(4)]}
+    futures = list(Scheduler(max_workers=4).run_fair(work, groups, max_per_group=3))
+
+    assert sorted(f.result() for f in futures) == sorted(groups["a"] + groups["b"])
+    assert all(f.group == f.task[0] for f in futures)
+    # The small group is not starved by the large one
+    assert started[:4].count("b") == 2
+    assert peak["a"] <= 3 and peak["b"] <= 3
+
+
+def test_config_paths(tmp_path):
+    (tmp_path / "configs").mkdir()
+    b = _config(tmp_path / "configs" / "b.json", "p", ["t"])
+    a = _config(tmp_path / "configs" / "a.json", "p", ["t"])
+    c = _config(tmp_path / "c.json", "p", ["t"])
+    assert config_paths([str(tmp_path / "configs"), c]) == [a, b, c]
+
+
+def test_invalid_mode(offline_job):
+    with pytest.raises(ValueError):
+        BatchJob("x", offline_job.downloader, "/tmp", mode="verify")
+
+
+@pytest.fixture
+def offline_job(tmp_path):
+    batch = Batch.from_paths([_config(tmp_path / "x.json", "p", ["t"])], str(tmp_path))
+    return batch.jobs[0]
+
+
+def test_batch(fake_cds, fake_metadata_cache, tmp_path):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    (tmp_path / "configs").mkdir()
+    _config(tmp_path / "configs" / "era5.json", "reanalysis-era5-single-levels", ["t", "u", "v"])
+    _config(tmp_path / "configs" / "land.json", "reanalysis-era5-land", ["t", "u"],
+            storage_path="land_data", split_keys=["variable", "year"])
+
+    events = []
+    batch = Batch.from_paths([str(tmp_path / "configs")], str(tmp_path / "data"), split_keys=["variable"],
+                             metadata_cache=fake_metadata_cache, max_workers=2, max_per_product=1)
+    batch.metrics.add_sink(events.append)
+    summary = batch.run()
+
+    assert summary["done"] == 5 and summary["failed"] == 0
+    assert summary["jobs"]["era5"]["done"] == 3
+    assert summary["jobs"]["land"]["done"] == 2
+    assert sorted(p.name for p in (tmp_path / "data" / "era5").glob("*.grib")) == \
+        ["{}_reanalysis-era5-single-levels.grib".format(v) for v in ["t", "u", "v"]]
+    assert sorted(p.name for p in (tmp_path / "data" / "land_data").glob("*.grib")) == \
+        ["{}_2000_reanalysis-era5-land.grib".format(v) for v in ["t", "u"]]
+    assert sorted(p for p, r in fake_cds.submitted) == \
+        ["reanalysis-era5-land"] * 2 + ["reanalysis-era5-single-levels"] * 3
+    assert [e["event"] for e in events].count("run") == 1
+
+    # Everything is on disk, a second run requests nothing
+    assert Batch.from_paths([str(tmp_path / "configs")], str(tmp_path / "data"), split_keys=["variable"],
+                            metadata_cache=fake_metadata_cache).run()["chunks"] == 0
+    assert len(fake_cds.submitted) == 5
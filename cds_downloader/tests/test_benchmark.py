@@ -0,0 +1,37 @@
+import pytest
+
+from cds_downloader import benchmark
+from cds_downloader.benchmark import run_benchmark, SCENARIOS
+
+
+@pytest.mark.parametrize("scenario", SCENARIOS)
+def test_run_benchmark(scenario, tmp_path):
+    results = run_benchmark(scenario, chunks=3, max_workers=2, result_size=1 << 12,
+                            work_dir=str(tmp_path))
+    assert results["requests"] == 3
+    assert results["failed"] == 0
+    assert results["bytes"] >= 3 * (1 << 12)
+    assert results["wall_time"] > 0
+    assert results["requests_per_hour"] > 0
+    assert results["peak_rss"] > 0
+    assert results["peak_processes"] >= 1
+
+
+def test_run_benchmark_bandwidth(tmp_path):
+    results = run_benchmark("get_data", chunks=2, max_workers=1, result_size=1 << 16,
+                            bandwidth=1 << 18, work_dir=str(tmp_path))
+    # Two sequential transfers of 64 KiB at 256 KiB/s
+    assert results["wall_time"] >= 0.5
+
+
+def test_invalid_scenario():
+    with pytest.raises(ValueError):
+        run_benchmark("get_everything")
+
+
+def test_sampler_without_proc(monkeypatch):
+    monkeypatch.setattr(benchmark, "resource", None)
+    with benchmark.ProcessSampler() as sampler:
+        data = [bytearray(1 << 16) for _ in range(16)]
+    assert sampler.peak_rss >= 16 * (1 << 16) and len(data) == 16
+    assert sampler.peak_processes == 1
@@ -1,4 +1,3 @@
-import os
 import pytest
 import cdsapi
 import math
@@ -8,7 +7,8 @@ from cds_downloader import Downloader
 from collections import OrderedDict
 
 @pytest.fixture
-def era5_downloader():
+def era5_downloader(fake_metadata_cache):
+    """Downloader with metadata from the local fake cds"""
     return Downloader.from_cds(
             "reanalysis-era5-single-levels",
             {
@@ -20,7 +20,8 @@ def era5_downloader():
                 "day": ["01", "02"],
                 "time": ["00:00", "01:00"],
                 "area": [50.7, 3.6, 42.9, 17.2]
-            }
+            },
+            metadata_cache=fake_metadata_cache
     )
 
 
@@ -62,15 +63,13 @@ def test_split_size(era5_downloader, selection_limit, expected_size):
     assert size_request == expected_size
 
 
-@pytest.mark.skipif(
-    ((os.environ.get('CDSAPI_URL') is None) and
-     (os.environ.get('CDSAPI_KEY') is None)),
-    reason="requires CDSAPI_KEY and CDSAPI_URL environment variables")
 @pytest.mark.parametrize("selection_limit, expected_files", [(64, 1), (6, 8), (3, 16)])
-def test_download(era5_downloader, tmp_path, selection_limit, expected_files):
+def test_download(fake_cds, era5_downloader, tmp_path, selection_limit, expected_files):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
     era5_downloader.cds_webapi["selection_limit"] = selection_limit
     tmpdir = tmp_path / "data"
     tmpdir.mkdir()
     all_processes = era5_downloader.get_data(tmpdir)
-    assert len(os.listdir(tmpdir)) == len(all_processes)
-    assert len(os.listdir(tmpdir)) == expected_files
+    data_files = list(tmpdir.glob("*.grib"))
+    assert len(data_files) == len(all_processes)
+    assert len(data_files) == expected_files
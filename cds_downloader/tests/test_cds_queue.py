@@ -0,0 +1,64 @@
+import pytest
+
+from cds_downloader import Downloader
+from cds_downloader.cds_queue import RequestQueue
+
+
+PRODUCT = "reanalysis-era5-single-levels"
+
+
+def test_claim_by_canonical_filter(fake_cds, fake_client):
+    queued = fake_cds.submit(PRODUCT, {"variable": ["2m_temperature"], "year": ["2001", "2000"]})
+    completed = fake_cds.submit(PRODUCT, {"year": "2000", "variable": "2m_temperature"})
+    fake_cds.tasks[completed["request_id"]]["state"] = "completed"
+    fake_cds.submit("other-product", {"variable": "2m_temperature", "year": "2000"})
+
+    queue = RequestQueue(fake_client).refresh(PRODUCT)
+    assert len(queue) == 2
+
+    # Completed requests are preferred, every request is handed out once
+    assert queue.claim(PRODUCT, {"variable": ["2m_temperature"], "year": ["2000"]})["request_id"] == \
+        completed["request_id"]
+    assert queue.claim(PRODUCT, {"variable": "2m_temperature", "year": "2000"}) is None
+    assert queue.claim(PRODUCT, {"year": ["2000", "2001"], "variable": "2m_temperature"})["request_id"] == \
+        queued["request_id"]
+
+
+def test_delete_failed(fake_cds, fake_client):
+    failed = fake_cds.submit(PRODUCT, {"year": "2000"})
+    fake_cds.tasks[failed["request_id"]]["state"] = "failed"
+
+    assert len(RequestQueue(fake_client).refresh(PRODUCT)) == 0
+    assert failed["request_id"] in fake_cds.tasks
+
+    RequestQueue(fake_client, delete_failed=True).refresh(PRODUCT)
+    assert fake_cds.deleted == [failed["request_id"]]
+
+
+def test_wait(fake_cds, fake_client):
+    fake_cds.queued_polls = fake_cds.running_polls = 1
+    reply = fake_cds.submit(PRODUCT, {"year": "2000"})
+    queue = RequestQueue(fake_client)
+
+    assert queue.wait(reply, sleep=0.01)["state"] == "completed"
+
+    failed = fake_cds.submit(PRODUCT, {"year": "2001"})
+    fake_cds.tasks[failed["request_id"]]["state"] = "failed"
+    fake_cds.queued_polls = 10
+    with pytest.raises(Exception):
+        queue.wait(failed)
+
+
+@pytest.mark.parametrize("engine", ["pool", "async"])
+def test_get_data_attaches_to_queue(fake_cds, fake_metadata_cache, tmp_path, engine):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    cds_filter = {"format": "grib", "variable": "2m_temperature", "year": ["2000", "2001"]}
+    pending = fake_cds.submit(PRODUCT, dict(cds_filter, year="2000"))
+
+    downloader = Downloader(PRODUCT, cds_filter, metadata_cache=fake_metadata_cache)
+    downloader.get_data(str(tmp_path), ["year"], max_workers=2, engine=engine)
+
+    assert len(list(tmp_path.glob("*.grib"))) == 2
+    # Only the missing year is submitted again
+    assert [request["year"] for product, request in fake_cds.submitted] == ["2000", "2001"]
+    assert pending["request_id"] in fake_cds.deleted
@@ -0,0 +1,91 @@
+import json
+import pickle
+import itertools
+import pytest
+
+from cds_downloader.chunk_plan import ChunkPlan, Chunk
+from cds_downloader.planner import Planner
+
+
+CDS_FILTER = {"format": "grib", "variable": ["t", "u", "v"], "year": ["2000", "2001"],
+              "month": ["01", "02", "03", "04"], "day": "01"}
+
+
+def _expected(cds_filter, keys):
+    return [dict(cds_filter, **dict(zip(keys, values)))
+            for values in itertools.product(*[cds_filter[k] for k in keys])]
+
+
+def test_order_and_random_access():
+    plan = ChunkPlan(CDS_FILTER, ["variable", "year", "month"])
+    expected = _expected(CDS_FILTER, ["variable", "year", "month"])
+    assert len(plan) == 24
+    assert [dict(c) for c in plan] == expected
+    assert dict(plan[17]) == expected[17]
+    assert dict(plan[-1]) == expected[-1]
+    assert plan[5] == expected[5]
+    with pytest.raises(IndexError):
+        plan[24]
+
+
+def test_scalar_split_keys_are_kept():
+    plan = ChunkPlan(CDS_FILTER, ["variable", "day"])
+    assert plan.split_keys == ["variable"]
+    assert [c["day"] for c in plan] == ["01"] * 3
+    assert [c["variable"] for c in plan] == ["t", "u", "v"]
+
+
+def test_slices_and_shards():
+    plan = ChunkPlan(CDS_FILTER, ["variable", "year", "month"])
+    expected = _expected(CDS_FILTER, ["variable", "year", "month"])
+    assert [dict(c) for c in plan[3:10:2]] == expected[3:10:2]
+    assert [dict(c) for c in plan[3:10][1:3]] == expected[3:10][1:3]
+
+    shards = [plan.shard(5, i) for i in range(5)]
+    assert sum(len(s) for s in shards) == len(plan)
+    assert sorted(c.index for s in shards for c in s) == list(range(24))
+    with pytest.raises(ValueError):
+        plan.shard(5, 5)
+
+
+def test_cursor():
+    plan = ChunkPlan(CDS_FILTER, ["variable", "year", "month"])
+    cursor = plan.cursor()
+    first = [next(cursor) for _ in range(10)]
+    position = cursor.position
+
+    # Restore the cursor of a serialised plan
+    restored = ChunkPlan.from_dict(json.loads(json.dumps(plan.to_dict()))).cursor(position)
+    assert [dict(c) for c in first] + [dict(c) for c in restored] == [dict(c) for c in plan]
+    assert len(plan.cursor(position).remaining()) == 14
+
+
+def test_pickle():
+    plan = ChunkPlan(CDS_FILTER, ["variable", "year", "month"])[2:20]
+    assert [dict(c) for c in pickle.loads(pickle.dumps(plan))] == [dict(c) for c in plan]
+    # Workers receive a plain filter
+    chunk = pickle.loads(pickle.dumps(plan[0]))
+    assert type(chunk) is dict and chunk == dict(plan[0])
+    assert not hasattr(plan[0], "__dict__") and isinstance(plan[0], Chunk)
+
+
+def test_planner_groups():
+    months = [str(m).zfill(2) for m in range(1, 13)]
+    cds_filter = {"variable": ["t"], "year": ["2000"], "month": months, "time": ["00:00", "12:00"]}
+    planner = Planner(4)
+    split_keys, groups = planner.plan(cds_filter)
+    plan = planner.expand(cds_filter, split_keys, groups)
+    assert len(plan) == 6
+    assert [c["month"] for c in plan] == [months[i:i + 2] for i in range(0, 12, 2)]
+
+
+def test_large_plan():
+    # Hourly data of 40 years split by time
+    cds_filter = {"variable": ["t"], "year": [str(y) for y in range(1980, 2020)],
+                  "month": [str(m).zfill(2) for m in range(1, 13)],
+                  "day": [str(d).zfill(2) for d in range(1, 32)],
+                  "time": ["{:02d}:00".format(h) for h in range(24)]}
+    plan = ChunkPlan(cds_filter, ["year", "month", "day", "time"])
+    assert len(plan) == 40 * 12 * 31 * 24
+    assert dict(plan[len(plan) // 2]) == dict(cds_filter, year="2000", month="01", day="01", time="00:00")
+    assert len(pickle.dumps(plan)) < 10000
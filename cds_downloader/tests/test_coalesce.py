@@ -0,0 +1,140 @@
+import json
+import threading
+
+from cds_downloader.batch import Batch
+from cds_downloader.coalesce import Coalescer
+from cds_downloader.grib_index import GribIndex
+from cds_downloader.journal import Journal, RUN_COMPLETE, RUN_INCOMPLETE
+from cds_downloader.manifest import Manifest
+
+
+def _batch(tmp_path, fake_metadata_cache, product, configs, grib_params=None, **kwargs):
+    (tmp_path / "configs").mkdir()
+    for name, variables in configs.items():
+        config = {"cds_product": product,
+                  "cds_filter": {"format": "grib", "variable": variables, "year": ["2000"], "month": ["01"],
+                                 "day": ["01"], "time": ["00:00", "12:00"]}}
+        if grib_params:
+            config["grib_params"] = {v: "0.0.{}".format(p) for v, p in grib_params.items()}
+        (tmp_path / "configs" / "{}.json".format(name)).write_text(json.dumps(config))
+    return Batch.from_paths([str(tmp_path / "configs")], str(tmp_path / "data"),
+                            metadata_cache=fake_metadata_cache, **kwargs)
+
+
+def _targets(batch):
+    for job in batch.jobs:
+        split_filter, kwargs_run = job.downloader._prepare(job.mode, job.storage_path, job.split_keys)
+        for task in job.downloader._iter_tasks(job.storage_path, split_filter, Manifest(job.storage_path)):
+            yield job.downloader, task
+
+
+def test_coalesce_batch(fake_cds, fake_metadata_cache, tmp_path, product, grib_params):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    fake_cds.params = grib_params
+    batch = _batch(tmp_path, fake_metadata_cache, product, {"ado": ["a", "b"], "update": ["b", "c"]}, grib_params,
+                   split_keys=["variable"])
+    summary = batch.run(coalesce=True)
+
+    # One union request for the four files of both configurations, nothing left for the jobs
+    assert [r["variable"] for p, r in fake_cds.submitted] == [["a", "b", "c"]]
+    assert summary["coalesced"] == {"requests": 1, "files": 4, "failed": 0}
+    assert summary["done"] == summary["chunks"] and summary["failed"] == 0
+    for name, variables in [("ado", ["a", "b"]), ("update", ["b", "c"])]:
+        assert summary["jobs"][name]["done"] == 2
+        # The chunks of the union request are journaled by their runs
+        journal = Journal(str(tmp_path / "data" / name))
+        run = journal.runs(product)[-1]
+        assert run["status"] == RUN_COMPLETE
+        assert sorted(c["file_name"] for c in journal.chunks(run["run_id"])) == \
+            ["{}_{}.grib".format(v, product) for v in variables]
+        manifest = Manifest(str(tmp_path / "data" / name))
+        for variable in variables:
+            file_name = "{}_{}.grib".format(variable, product)
+            assert manifest.status(file_name) == "done"
+            index = GribIndex(str(tmp_path / "data" / name / file_name))
+            assert len(index) == 2 and {m["param"] for m in index.messages} == {"0.0.{}".format(grib_params[variable])}
+    assert not list((tmp_path / "data").glob("*/.coalesced_*"))
+
+
+def test_coalesce_overwrite(fake_cds, fake_metadata_cache, tmp_path, product, grib_params):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    fake_cds.params = grib_params
+    batch = _batch(tmp_path, fake_metadata_cache, product, {"ado": ["a", "b"], "update": ["b", "c"]}, grib_params,
+                   split_keys=["variable"], job_kwargs={"overwrite": True})
+    # The jobs would request their files again, the union request delivered them already
+    summary = batch.run(coalesce=True)
+    assert len(fake_cds.submitted) == 1
+    assert summary["coalesced"]["files"] == 4
+    assert summary["jobs"]["ado"]["done"] == summary["jobs"]["update"]["done"] == 2
+
+
+def test_coalesce_unsplit(fake_cds, fake_metadata_cache, tmp_path, product, grib_params):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    fake_cds.params = grib_params
+    batch = _batch(tmp_path, fake_metadata_cache, product, {"ado": ["a", "b"], "update": ["b", "c"]}, grib_params)
+    assert batch.run(coalesce=True)["coalesced"] == {"requests": 1, "files": 2, "failed": 0}
+    index = GribIndex(str(tmp_path / "data" / "update" / "all_{}.grib".format(product)))
+    assert [m["param"] for m in index.messages] == ["0.0.11", "0.0.12"] * 2
+
+
+def test_coalesce_unknown_params(fake_cds, fake_metadata_cache, tmp_path, product):
+    batch = _batch(tmp_path, fake_metadata_cache, product,
+                   {"ado": ["a", "b"], "same": ["a", "b"], "update": ["b", "c"]})
+    # Only identical chunks share a request without parameters
+    requests = Coalescer([job.downloader for job in batch.jobs]).plan(_targets(batch))
+    assert [(r.cds_filter["variable"], len(r.targets)) for r in requests] == [(["a", "b"], 2)]
+
+
+def test_coalesce_resume(fake_cds, fake_metadata_cache, tmp_path, product, grib_params):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    fake_cds.params = grib_params
+    poll = fake_cds.poll
+
+    def failing_poll(request_id):
+        if outage:
+            return {"request_id": request_id, "state": "failed",
+                    "error": {"message": "failed", "reason": "test"}}
+        return poll(request_id)
+
+    outage = True
+    fake_cds.poll = failing_poll
+    configs = {"ado": ["a", "b"], "update": ["b", "c"]}
+    batch = _batch(tmp_path, fake_metadata_cache, product, configs, grib_params, split_keys=["variable"],
+                   downloader_kwargs={"reuse_requests": False})
+    assert batch.run(coalesce=True)["coalesced"] == {"requests": 1, "files": 0, "failed": 4}
+    for name in configs:
+        assert Journal(str(tmp_path / "data" / name)).runs(product)[-1]["status"] == RUN_INCOMPLETE
+
+    # The chunks of the failed union request are coalesced again from the journals
+    outage = False
+    batch = Batch(batch.jobs)
+    assert batch.run(resume=True, coalesce=True)["coalesced"] == {"requests": 1, "files": 4, "failed": 0}
+    assert [r["variable"] for p, r in fake_cds.submitted] == [["a", "b", "c"]] * 2
+    for name in configs:
+        assert Journal(str(tmp_path / "data" / name)).runs(product)[-1]["status"] == RUN_COMPLETE
+
+
+def test_coalesce_hosts(fake_cds, fake_metadata_cache, tmp_path, product, grib_params):
+    fake_cds.params = grib_params
+    configs = {"ado": ["a", "b"], "update": ["b", "c"]}
+    _batch(tmp_path, fake_metadata_cache, product, configs, grib_params)
+    summaries = []
+
+    def host():
+        hosted = Batch.from_paths([str(tmp_path / "configs")], str(tmp_path / "data"),
+                                  metadata_cache=fake_metadata_cache, split_keys=["variable"],
+                                  downloader_kwargs={"leases": True, "reuse_requests": False})
+        summaries.append(hosted.run(coalesce=True))
+
+    threads = [threading.Thread(target=host) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The union request is leased by one of the hosts
+    assert len(fake_cds.submitted) == 1
+    assert sorted(s["coalesced"]["files"] for s in summaries) == [0, 4]
+    for name, variables in configs.items():
+        manifest = Manifest(str(tmp_path / "data" / name))
+        assert all(manifest.status("{}_{}.grib".format(v, product)) == "done" for v in variables)
@@ -0,0 +1,117 @@
+import time
+import threading
+import pytest
+
+from cds_downloader import Downloader
+from cds_downloader.concurrency import AdaptiveLimit
+from cds_downloader.metrics import Metrics, PrometheusSink
+from cds_downloader.scheduler import Scheduler
+
+
+PRODUCT = "reanalysis-era5-single-levels"
+
+
+def test_additive_increase():
+    limit = AdaptiveLimit(max_limit=6, initial=4, target_wait=10.)
+    # About one step per round of limit requests
+    for _ in range(5):
+        limit.observe_wait(1.)
+    assert limit.value == 5
+    for _ in range(100):
+        limit.observe_wait(1.)
+    assert limit.value == 6
+
+
+def test_multiplicative_decrease_and_cooldown():
+    limit = AdaptiveLimit(max_limit=16, initial=16, target_wait=10., cooldown=60.)
+    limit.observe_rejection()
+    assert limit.value == 8
+    # Requests in flight stem from the old limit
+    limit.observe_wait(100.)
+    assert limit.value == 8
+
+    limit = AdaptiveLimit(max_limit=16, min_limit=3, initial=4, cooldown=0.)
+    limit.observe_wait(1000.)
+    limit.observe_wait(1000.)
+    assert limit.value == 3
+
+
+def test_throughput_drop():
+    limit = AdaptiveLimit(max_limit=16, initial=8, cooldown=0.)
+    for throughput in [100., 100., 100.]:
+        limit.observe_throughput(throughput)
+    assert limit.value == 8
+    for _ in range(3):
+        limit.observe_throughput(10.)
+    assert limit.value < 8
+
+
+def test_invalid_limits():
+    with pytest.raises(ValueError):
+        AdaptiveLimit(max_limit=2, min_limit=3)
+    with pytest.raises(ValueError):
+        AdaptiveLimit(decrease=1.5)
+
+
+def test_events_and_reports():
+    reports = []
+    metrics = Metrics(sinks=[reports.append])
+    limit = AdaptiveLimit(max_limit=8, initial=4, target_wait=0.01, cooldown=0., metrics=metrics)
+    prometheus = PrometheusSink()
+    metrics.add_sink(limit)
+    metrics.add_sink(prometheus)
+
+    metrics.emit("submitted", "a.grib", PRODUCT)
+    time.sleep(0.05)
+    metrics.emit("running", "a.grib", PRODUCT)
+    assert limit.value == 2
+    metrics.emit("failed", "b.grib", PRODUCT, error="Exception('429 Too Many Requests')")
+    assert limit.value == 1
+
+    concurrency = [r for r in reports if r["event"] == "concurrency"]
+    assert [r["limit"] for r in concurrency] == [2, 1]
+    assert "cds_downloader_concurrency_limit 1" in prometheus.render()
+
+
+class _Limit(object):
+    value = 1
+
+
+def test_scheduler_follows_limit():
+    lock = threading.Lock()
+    running, peak = [0], []
+
+    def work(i):
+        with lock:
+            running[0] += 1
+            peak.append(running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return i
+
+    limit = _Limit()
+    scheduler = Scheduler(max_workers=4, limit=limit)
+    futures = scheduler.run(work, [(i,) for i in range(12)])
+    for i, future in enumerate(futures):
+        if i == 3:
+            limit.value = 10
+    assert max(peak[:4]) == 1
+    assert max(peak) <= 4
+    assert max(peak[6:]) > 1
+
+
+def test_downloader_adapts(fake_cds, fake_metadata_cache, tmp_path):
+    fake_cds.queued_polls, fake_cds.running_polls = 1, 0
+    reports = []
+    limit = AdaptiveLimit(max_limit=4, initial=4, target_wait=0.01, cooldown=0.)
+    downloader = Downloader(PRODUCT, {"format": "grib", "variable": ["a", "b", "c", "d", "e", "f"],
+                                      "year": ["2000"], "month": ["01"], "day": ["01"], "time": ["00:00"]},
+                            metadata_cache=fake_metadata_cache, concurrency=limit,
+                            metrics=Metrics(sinks=[reports.append]))
+    futures = downloader.get_data(str(tmp_path), ["variable"])
+
+    assert len(futures) == 6 and all(f.exception() is None for f in futures)
+    # Every request waited about a second in the queue
+    assert limit.value == 1
+    assert [r["limit"] for r in reports if r["event"] == "concurrency"] == [2, 1]
@@ -0,0 +1,63 @@
+import datetime
+import pytest
+
+from cds_downloader import Downloader
+from cds_downloader.daily import DailyBatcher
+from cds_downloader.grib_index import GribIndex
+from cds_downloader.manifest import Manifest
+from cds_downloader.integrity import count_messages
+
+
+def _day(day, month=1):
+    return datetime.date(2000, month, day)
+
+
+def test_plan():
+    batcher = DailyBatcher(120000, params={"a": "0.0.10", "b": "0.0.11"})
+    cds_filter = {"format": "grib", "variable": ["a", "b", "c"], "time": ["00:00", "12:00"]}
+    missing = [(v, d) for d in [_day(30), _day(31), _day(1, 2)] for v in ["a", "b", "c"]]
+    batches = batcher.plan(cds_filter, missing)
+
+    # Runs of days end at the month, unknown variables are requested alone
+    assert [(b["variable"], b["month"], b["day"]) for b in batches] == [
+        (["a", "b"], "1", ["30", "31"]), ("c", "1", ["30", "31"]), (["a", "b"], "2", "1"), ("c", "2", "1")]
+    assert [dict(m)["variable"] for m in batcher.members(batches[0])] == ["a", "a", "b", "b"]
+    assert not DailyBatcher.is_batch(batches[-1])
+
+    # Days with other missing variables are not combined
+    assert len(batcher.plan(cds_filter, [("a", _day(1)), ("a", _day(2)), ("b", _day(2))])) == 2
+
+
+def test_plan_selection_limit():
+    batcher = DailyBatcher(8, params={"a": "0.0.10", "b": "0.0.11"})
+    cds_filter = {"format": "grib", "variable": ["a", "b"], "time": ["00:00", "12:00"]}
+    batches = batcher.plan(cds_filter, [(v, _day(d)) for d in range(1, 8) for v in ["a", "b"]])
+    assert all(len(b["variable"]) * len(b["day"]) * 2 <= 8 for b in batches)
+    assert sum(1 for b in batches for m in batcher.members(b)) == 14
+
+
+@pytest.mark.parametrize("engine", ["pool", "async"])
+def test_daily_batches(fake_cds, fake_metadata_cache, tmp_path, engine, product, grib_params):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    fake_cds.params = grib_params
+    downloader = Downloader(product, {"format": "grib", "variable": ["a", "b", "c"]},
+                            metadata_cache=fake_metadata_cache,
+                            grib_params={v: "0.0.{}".format(p) for v, p in grib_params.items()})
+    # One file of the first day exists already
+    (tmp_path / "a_2000_1_1_{}.grib".format(product)).write_bytes(b"")
+
+    futures = downloader.get_data_for_date(str(tmp_path), "2000-01-03", days=3, engine=engine)
+
+    assert all(f.exception() is None for f in futures)
+    assert sorted((r["variable"], r["day"]) for p, r in fake_cds.submitted) == \
+        [(["a", "b", "c"], ["2", "3"]), (["b", "c"], "1")]
+    names = ["{}_2000_1_{}_{}.grib".format(v, d, product) for v in ["a", "b", "c"] for d in [1, 2, 3]]
+    assert sorted(p.name for p in tmp_path.glob("*.grib")) == names
+
+    manifest = Manifest(str(tmp_path))
+    for name in names[1:]:
+        assert count_messages(str(tmp_path / name)) == 24
+        assert manifest.status(name) == "done"
+    index = GribIndex(str(tmp_path / "c_2000_1_3_{}.grib".format(product)))
+    assert {m["param"] for m in index.messages} == {"0.0.12"}
+    assert {m["valid_time"][:10] for m in index.messages} == {"2000-01-03"}
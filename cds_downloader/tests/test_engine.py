@@ -0,0 +1,65 @@
+import os
+import pytest
+
+from cds_downloader import Downloader
+from cds_downloader.engine import AsyncEngine
+
+
+@pytest.fixture
+def offline_downloader():
+    return Downloader.from_cds(
+        "reanalysis-era5-single-levels",
+        {
+            "product_type": "reanalysis",
+            "format": "grib",
+            "variable": ["2m_temperature", "potential_evaporation"],
+            "year": ["1980", "1981"],
+            "month": ["01"],
+            "day": ["01"],
+            "time": ["00:00"],
+        }
+    )
+
+
+def test_engine_downloads(fake_cds, fake_client, tmp_path):
+    tasks = [("product", {"year": str(y)}, str(tmp_path / "{}.grib".format(y)), False)
+             for y in range(1980, 1990)]
+    engine = AsyncEngine(fake_client, max_requests=4, download_workers=2, poll_interval=0.01)
+    futures = engine.run(iter(tasks))
+
+    assert len(futures) == 10
+    assert all(f.exception() is None for f in futures)
+    assert sorted(p.name for p in tmp_path.glob("*.grib")) == \
+        sorted("{}.grib".format(y) for y in range(1980, 1990))
+    assert all(os.path.getsize(f.result()) == fake_cds.result_size for f in futures)
+    assert len(fake_cds.submitted) == 10
+
+
+def test_engine_failed_request(fake_cds, fake_client, tmp_path):
+    def failing_poll(request_id):
+        return {"request_id": request_id, "state": "failed",
+                "error": {"message": "failed", "reason": "test"}}
+
+    fake_cds.poll = failing_poll
+    engine = AsyncEngine(fake_client, poll_interval=0.01)
+    futures = engine.run([("product", {}, str(tmp_path / "x.grib"), False)])
+
+    assert len(futures) == 1
+    assert isinstance(futures[0].exception(), Exception)
+    assert not os.path.exists(str(tmp_path / "x.grib"))
+
+
+def test_get_data_async(fake_cds, offline_downloader, tmp_path):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    futures = offline_downloader.get_data(str(tmp_path), ["variable", "year"],
+                                          engine="async", max_workers=2, download_workers=1)
+    assert len(futures) == 4
+    assert len(list(tmp_path.glob("*.grib"))) == 4
+    assert {p for p, r in fake_cds.submitted} == {"reanalysis-era5-single-levels"}
+
+
+def test_invalid_engine(offline_downloader):
+    split_filter = offline_downloader._expand_by_keys(offline_downloader.cds_filter, [])
+    offline_downloader.split_keys = []
+    with pytest.raises(ValueError):
+        offline_downloader._retrieve_files("NO_STORAGE_PATH", split_filter, engine="unknown")
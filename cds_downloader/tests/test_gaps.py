@@ -0,0 +1,92 @@
+import datetime
+import pytest
+
+from cds_downloader import Downloader
+from cds_downloader.gaps import GapDetector
+from cds_downloader.manifest import Manifest
+from cds_downloader.fake_cds import WEBAPI
+
+
+TEMPORAL = {form["name"]: form["details"]["values"] for form in WEBAPI["form"]}
+
+
+def test_missing_days_skip_impossible_dates():
+    detector = GapDetector(["year", "month", "day"], TEMPORAL)
+    existing = [("2000", "02", "27"), ("2000", "02", "28")]
+    ranges = detector.missing(existing, until=datetime.datetime(2000, 3, 2),
+                              start=datetime.datetime(2000, 2, 27), keep_last=False)
+    assert len(ranges) == 1
+    assert ranges[0].start == {"year": "2000", "month": "02", "day": "29"}
+    assert ranges[0].end == {"year": "2000", "month": "03", "day": "02"}
+    assert [d["day"] for d in detector.expand(ranges)] == ["29", "01", "02"]
+
+
+def test_keep_last():
+    detector = GapDetector(["year", "month"], TEMPORAL)
+    existing = [("2000", "01"), ("2000", "02")]
+    ranges = detector.missing(existing, until=datetime.datetime(2000, 3, 1), start="existing")
+    assert list(detector.expand(ranges)) == [{"year": "2000", "month": "02"},
+                                             {"year": "2000", "month": "03"}]
+
+
+def test_grouped_labels():
+    detector = GapDetector(["year", "month"], TEMPORAL)
+    assert detector.members(("2000", "01-03")) == [("2000", "01"), ("2000", "02"), ("2000", "03")]
+    # Groups of planned files count as existing, keep_last requests the last group again
+    existing = [("2000", "01-06"), ("2000", "07-12")]
+    ranges = detector.missing(existing, until=datetime.datetime(2000, 12, 1), start="existing", keep_last=False)
+    assert ranges == []
+    ranges = detector.missing(existing, until=datetime.datetime(2000, 12, 1), start="existing")
+    assert [d["month"] for d in detector.expand(ranges)] == ["07", "08", "09", "10", "11", "12"]
+
+
+def test_non_temporal_split_keys():
+    candidates = dict(TEMPORAL, variable=["2m_temperature", "total_precipitation"])
+    detector = GapDetector(["variable", "year"], candidates)
+    existing = [("2m_temperature", "2000"), ("2m_temperature", "2001"), ("runoff", "2000")]
+    ranges = detector.missing(existing, until=datetime.datetime(2001, 6, 1), start="existing",
+                              keep_last=False)
+    assert [(r.fixed["variable"], r.start["year"], r.end["year"], r.count) for r in ranges] == \
+        [("total_precipitation", "2000", "2001", 2)]
+
+
+def test_restricted_values():
+    candidates = dict(TEMPORAL, month=["06", "07"])
+    detector = GapDetector(["year", "month"], candidates)
+    ranges = detector.missing([], until=datetime.datetime(2001, 12, 1),
+                              start=datetime.datetime(2000, 1, 1))
+    assert [r.count for r in ranges] == [2, 2]
+    assert len(list(detector.expand(ranges))) == 4
+
+
+def test_compact_hourly_ranges():
+    detector = GapDetector(["year", "month", "day", "time"], TEMPORAL)
+    ranges = detector.missing([], until=datetime.datetime(2019, 12, 31, 23))
+    assert len(ranges) == 1
+    assert ranges[0].count == (datetime.datetime(2020, 1, 1) - datetime.datetime(1979, 1, 1)).days * 24
+
+
+def test_invalid_temporal_chain():
+    with pytest.raises(ValueError):
+        GapDetector(["year", "day"], TEMPORAL)
+
+
+def test_update_data(fake_cds, fake_metadata_cache, tmp_path):
+    product = "reanalysis-era5-single-levels"
+    downloader = Downloader(product, {"format": "grib",
+                                      "variable": ["2m_temperature", "total_precipitation"]},
+                            metadata_cache=fake_metadata_cache)
+    split_keys = ["variable", "year", "month"]
+    manifest = Manifest(str(tmp_path))
+    for variable in ["2m_temperature", "total_precipitation"]:
+        manifest.record("{}_2000_01_{}.grib".format(variable, product), product,
+                        {"variable": variable, "year": "2000", "month": "01"}, split_keys)
+
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    downloader.update_data(str(tmp_path), split_keys, date_until=datetime.datetime(2000, 3, 15),
+                           start_from_files=True, engine="async")
+
+    requested = sorted((r["variable"], r["month"]) for p, r in fake_cds.submitted)
+    assert requested == [(v, m) for v in ["2m_temperature", "total_precipitation"]
+                         for m in ["01", "02", "03"]]
+    assert len(manifest.split_values(product, split_keys)) == 6
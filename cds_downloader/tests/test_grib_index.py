@@ -0,0 +1,89 @@
+import os
+import datetime
+import struct
+
+from cds_downloader import Downloader
+from cds_downloader.grib_index import GribIndex, build_index, index_path
+from cds_downloader.integrity import count_messages
+from cds_downloader.fake_cds import grib_messages
+
+
+PRODUCT = "reanalysis-era5-pressure-levels"
+
+
+def _grib1_message(param, level, valid_time, p1=0):
+    # Indicator section, product definition section of 28 octets and end marker
+    pds = struct.pack(">I", 28)[1:] + bytes(bytearray([128, 98, 0, 255, 128, param, 100])) + \
+        struct.pack(">H", level) + bytes(bytearray([
+            valid_time.year % 100, valid_time.month, valid_time.day, valid_time.hour, 0,
+            1, p1, 0, 0, 0, 0, 0, valid_time.year // 100 + 1, 0, 0, 0]))
+    length = 8 + len(pds) + 4
+    return b"GRIB" + struct.pack(">I", length)[1:] + b"\x01" + pds + b"7777"
+
+
+def test_grib1_headers(tmp_path):
+    path = str(tmp_path / "a.grib")
+    with open(path, 'wb') as f:
+        f.write(_grib1_message(167, 0, datetime.datetime(2000, 1, 1, 6), p1=6) +
+                _grib1_message(130, 500, datetime.datetime(1999, 12, 31, 18)))
+
+    messages = build_index(path)
+    assert [(m["offset"], m["length"], m["edition"]) for m in messages] == [(0, 40, 1), (40, 40, 1)]
+    assert [(m["param"], m["level"], m["valid_time"]) for m in messages] == [
+        ("167.128", 0, "2000-01-01T12:00:00"), ("130.128", 500, "1999-12-31T18:00:00")]
+
+
+def test_grib2_headers(tmp_path):
+    path = str(tmp_path / "a.grib")
+    fields = [(p, level, datetime.datetime(2000, 1, 1, h))
+              for h in (0, 12) for p in (0, 1) for level in (500, 850)]
+    with open(path, 'wb') as f:
+        f.write(grib_messages(fields, 800))
+
+    index = GribIndex(path)
+    assert os.path.exists(index_path(path))
+    assert len(index) == 8
+    assert [(m["param"], m["level"]) for m in index.select(valid_time=datetime.datetime(2000, 1, 1, 12),
+                                                           param="0.0.1")] == \
+        [("0.0.1", 50000), ("0.0.1", 85000)]
+    assert len(index.select(level=[50000, 85000], param="0.0.0")) == 4
+
+
+def test_extract(tmp_path):
+    path = str(tmp_path / "a.grib")
+    fields = [(p, 0, datetime.datetime(2000, 1, 1, h)) for h in range(4) for p in range(3)]
+    data = grib_messages(fields, 1200)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    target = str(tmp_path / "b.grib")
+    assert GribIndex(path).extract(target, param="0.0.2") == 4
+    assert count_messages(target) == 4
+    with open(target, 'rb') as f:
+        assert f.read() == b"".join(data[i * 100:(i + 1) * 100] for i in (2, 5, 8, 11))
+
+
+def test_stale_index(tmp_path):
+    path = str(tmp_path / "a.grib")
+    with open(path, 'wb') as f:
+        f.write(grib_messages([(0, 0, datetime.datetime(2000, 1, 1))], 100))
+    assert len(GribIndex(path)) == 1
+
+    with open(path, 'ab') as f:
+        f.write(grib_messages([(1, 0, datetime.datetime(2000, 1, 1))], 100))
+    assert len(GribIndex(path)) == 2
+
+
+def test_index_written_on_download(fake_cds, fake_metadata_cache, tmp_path):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    downloader = Downloader(PRODUCT, {"format": "grib", "variable": "temperature",
+                                      "pressure_level": ["500", "850"], "year": "2000",
+                                      "month": "01", "day": ["01", "02"], "time": "12:00"},
+                            metadata_cache=fake_metadata_cache)
+    downloader.get_data(str(tmp_path), [])
+
+    path = str(tmp_path / "all_{}.grib".format(PRODUCT))
+    assert os.path.exists(index_path(path))
+    index = GribIndex(path)
+    assert [m["valid_time"] for m in index.select(level=85000)] == \
+        ["2000-01-01T12:00:00", "2000-01-02T12:00:00"]
@@ -0,0 +1,119 @@
+import os
+import datetime
+import pytest
+
+from cds_downloader import Downloader
+from cds_downloader.integrity import Checksum, IntegrityError, expected_fields
+from cds_downloader.integrity import scan_grib, verify_file
+from cds_downloader.manifest import Manifest, file_checksum, STATUS_FAILED
+from cds_downloader.transfer import download, segmented_download
+from cds_downloader.fake_cds import grib_messages as _grib_messages
+
+
+PRODUCT = "reanalysis-era5-single-levels"
+
+
+def grib_messages(count, size):
+    return _grib_messages([(0, 0, datetime.datetime(2000, 1, 1))] * count, size)
+
+
+def _write(path, data):
+    with open(str(path), 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def test_expected_fields():
+    assert expected_fields({"variable": ["a", "b"], "time": ["00:00", "12:00"], "year": "2000"}) == 4
+    # 29 days in February 2000, 28 in 2001
+    assert expected_fields({"year": ["2000", "2001"], "month": "02",
+                            "day": [str(d) for d in range(1, 32)]}) == 57
+    assert expected_fields({"date": "2000-01-01/2000-01-31"}) is None
+    # Seasonal lead months and ensemble numbers are not modelled, the area does not add fields
+    assert expected_fields({"variable": "a", "leadtime_month": ["1", "2"], "year": "2000"}) is None
+    assert expected_fields({"variable": "a", "number": ["0", "1"], "year": "2000"}) is None
+    assert expected_fields({"variable": "a", "leadtime_month": ["1"], "area": [60, -10, 30, 40]}) == 1
+
+
+def test_scan_grib(tmp_path):
+    path = _write(tmp_path / "a.grib", grib_messages(3, 300))
+    assert [length for offset, length, edition in scan_grib(path)] == [100, 100, 100]
+
+    for data in [b"", grib_messages(3, 300)[:250], grib_messages(3, 300)[:-1] + b"x",
+                 grib_messages(1, 100) + b"garbage"]:
+        with pytest.raises(IntegrityError):
+            scan_grib(_write(tmp_path / "b.grib", data))
+
+
+def test_verify_file(tmp_path):
+    path = _write(tmp_path / "a.grib", grib_messages(2, 200))
+    assert verify_file(path, {"variable": ["a", "b"]}) == []
+    assert verify_file(path, {"variable": "a"}) == ["2 GRIB messages instead of 1"]
+    assert verify_file(path, size=99) == ["size 200 instead of 99"]
+    assert verify_file(path, checksum="0") == ["checksum mismatch"]
+    assert verify_file(path, checksum=file_checksum(path)) == []
+
+
+def test_streaming_checksum_of_resumed_download(fake_cds, tmp_path):
+    fake_cds.interruptions = 1
+    fake_cds.result_size = 1 << 18
+    request_id = fake_cds.submit(PRODUCT, {})["request_id"]
+    fake_cds.tasks[request_id]["state"] = "completed"
+    target = str(tmp_path / "data.grib")
+
+    checksum = Checksum()
+    download(fake_cds.url + fake_cds.reply(request_id)["location"], target,
+             size=fake_cds.result_size, sleep=0, checksum=checksum)
+
+    assert checksum.hexdigest() == file_checksum(target)
+
+
+def test_streaming_checksum_of_segments(fake_cds, tmp_path):
+    fake_cds.interruptions = 2
+    fake_cds.result_size = 1 << 18
+    request_id = fake_cds.submit(PRODUCT, {})["request_id"]
+    fake_cds.tasks[request_id]["state"] = "completed"
+    target = str(tmp_path / "data.grib")
+
+    # Segments arrive out of order and are interrupted
+    checksum = Checksum()
+    segmented_download(fake_cds.url + fake_cds.reply(request_id)["location"], target, fake_cds.result_size,
+                       segments=4, min_segment_size=1 << 14, sleep=0, checksum=checksum)
+
+    assert checksum.hexdigest() == file_checksum(target)
+
+
+def test_verify_data(fake_cds, fake_metadata_cache, tmp_path):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    downloader = Downloader(PRODUCT, {"format": "grib", "variable": "2m_temperature",
+                                      "year": ["2000", "2001"], "time": ["00:00", "12:00"]},
+                            metadata_cache=fake_metadata_cache)
+    downloader.get_data(str(tmp_path), ["year"])
+
+    manifest = Manifest(str(tmp_path))
+    entry = manifest.get("2000_{}.grib".format(PRODUCT))
+    assert entry["checksum"] == file_checksum(str(tmp_path / entry["file_name"]))
+    assert downloader.verify_data(str(tmp_path), ["year"]) == {}
+
+    # Truncate one chunk, it is marked as failed and requested again
+    path = str(tmp_path / entry["file_name"])
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 10)
+    assert list(downloader.verify_data(str(tmp_path), ["year"])) == [entry["file_name"]]
+    assert manifest.status(entry["file_name"]) == STATUS_FAILED
+
+    downloader.get_data(str(tmp_path), ["year"])
+    assert len(fake_cds.submitted) == 3
+    assert downloader.verify_data(str(tmp_path), ["year"]) == {}
+
+
+def test_corrupt_download_fails(fake_cds, fake_metadata_cache, tmp_path):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    fake_cds.fields = lambda request_id: [(0, 0, datetime.datetime(2000, 1, 1))]
+    downloader = Downloader(PRODUCT, {"format": "grib", "variable": ["a", "b"], "year": "2000"},
+                            metadata_cache=fake_metadata_cache)
+    futures = downloader.get_data(str(tmp_path), [])
+
+    assert isinstance(futures[0].exception(), IntegrityError)
+    assert list(tmp_path.glob("*.grib")) == []
+    assert Manifest(str(tmp_path)).status("all_{}.grib".format(PRODUCT)) == STATUS_FAILED
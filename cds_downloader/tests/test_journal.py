@@ -0,0 +1,177 @@
+import pytest
+
+from cds_downloader.journal import Journal, RUN_COMPLETE, RUN_INCOMPLETE
+from cds_downloader.scheduler import backoff_delay
+
+
+def test_journal(tmp_path, product):
+    journal = Journal(str(tmp_path))
+    assert journal.resume_run(product) is None
+
+    run_id = journal.open_run(product, ["variable"])
+    assert journal.plan([("a.grib", {"variable": "a"}), ("b.grib", {"variable": "b"})]) == 2
+    journal.record("submitted", str(tmp_path / "a.grib"), request_id="r1")
+    journal.record("running", "a.grib")
+    journal.record("retry", "a.grib", error="Exception('boom')")
+    journal.record("done", "a.grib")
+
+    assert journal.request_id("a.grib") == "r1"
+    assert journal.request_id("b.grib") is None
+    assert [s for s, r, t in journal.transitions("a.grib")] == ["planned", "submitted", "running", "retry", "done"]
+    a, b = journal.chunks()
+    assert (a["state"], a["attempts"], a["error"]) == ("done", 1, "Exception('boom')")
+    assert b["cds_filter"] == {"variable": "b"}
+    assert [c["file_name"] for c in journal.chunks(pending=True)] == ["b.grib"]
+    assert journal.finish_run() == RUN_INCOMPLETE
+
+    # A new journal object continues the incomplete run, known chunks keep their state
+    journal = Journal(str(tmp_path))
+    run = journal.resume_run(product)
+    assert run["run_id"] == run_id and run["split_keys"] == ["variable"]
+    assert journal.plan([("a.grib", {"variable": "a"})]) == 0
+    journal.record("done", "b.grib")
+    assert journal.finish_run() == RUN_COMPLETE
+    assert journal.resume_run(product) is None
+
+
+def test_iter_chunks_pages(tmp_path, product):
+    journal = Journal(str(tmp_path))
+    journal.open_run(product, ["variable"])
+    journal.plan(("{}.grib".format(i), {"variable": str(i)}) for i in range(25))
+    names = []
+    for chunk in journal.iter_chunks(pending=True, page_size=10):
+        # States change while iterating
+        journal.record("done", chunk["file_name"])
+        names.append(chunk["file_name"])
+    assert names == ["{}.grib".format(i) for i in range(25)]
+
+
+def test_backoff_delay():
+    for attempt in range(10):
+        assert 0 <= backoff_delay(attempt, 1., 30.) <= min(2 ** attempt, 30.)
+
+
+def test_retry_failed_chunks(fake_cds, tmp_path, make_downloader, product):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    poll = fake_cds.poll
+    failed = {}
+
+    def failing_poll(request_id):
+        # The first request of every chunk fails
+        variable = fake_cds.tasks[request_id]["request"]["variable"]
+        if failed.setdefault(variable, request_id) == request_id:
+            return {"request_id": request_id, "state": "failed",
+                    "error": {"message": "failed", "reason": "test"}}
+        return poll(request_id)
+
+    fake_cds.poll = failing_poll
+    events = []
+    downloader = make_downloader(["a", "b"], retries=2, retry_backoff=0.)
+    downloader.metrics.add_sink(events.append)
+    futures = downloader.get_data(str(tmp_path), ["variable"])
+
+    assert len(futures) == 2 and all(f.exception() is None for f in futures)
+    assert len(fake_cds.submitted) == 4
+    assert [e["event"] for e in events].count("retry") == 2
+    summary = downloader.metrics.summary()
+    assert summary["done"] == 2 and summary["failed"] == 0
+
+    journal = Journal(str(tmp_path))
+    run = journal.runs(product)[-1]
+    assert run["status"] == RUN_COMPLETE
+    assert [(c["state"], c["attempts"]) for c in journal.chunks(run["run_id"])] == [("done", 1), ("done", 1)]
+
+
+def test_resume_reattaches_requests(fake_cds, tmp_path, make_downloader, product):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    downloader = make_downloader(["a", "b", "c"], reuse_requests=False)
+    downloader._prepare_data(str(tmp_path), ["variable"])
+    split_filter = list(downloader._plan(["variable"])[1])
+
+    # A killed run: all chunks planned, one done, one submitted
+    journal = Journal(str(tmp_path))
+    journal.open_run(product, ["variable"])
+    journal.plan((downloader._file_name(f), f) for f in split_filter)
+    journal.record("done", downloader._file_name(split_filter[0]))
+    reply = fake_cds.submit(product, split_filter[1])
+    journal.record("submitted", downloader._file_name(split_filter[1]), request_id=reply["request_id"])
+    journal.close()
+
+    futures = make_downloader(["a", "b", "c"], reuse_requests=False).resume(str(tmp_path))
+
+    assert sorted(f.result() for f in futures) == \
+        [str(tmp_path / downloader._file_name(f)) for f in split_filter[1:]]
+    # Only the chunk without request was submitted again
+    assert [r["variable"] for p, r in fake_cds.submitted] == ["b", "c"]
+    assert Journal(str(tmp_path)).runs(product)[-1]["status"] == RUN_COMPLETE
+    assert make_downloader(["a"]).resume(str(tmp_path)) == []
+
+
+@pytest.mark.parametrize("engine", ["pool", "async"])
+def test_resume_failed_run(fake_cds, tmp_path, engine, make_downloader, product):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    poll = fake_cds.poll
+    failed = set()
+
+    def failing_poll(request_id):
+        if outage or request_id in failed:
+            failed.add(request_id)
+            return {"request_id": request_id, "state": "failed",
+                    "error": {"message": "failed", "reason": "test"}}
+        return poll(request_id)
+
+    outage = True
+    fake_cds.poll = failing_poll
+    # The task list of the fake does not know the failures, attach by journal only
+    futures = make_downloader(["a", "b"], reuse_requests=False).get_data(
+        str(tmp_path), ["variable"], engine=engine)
+    assert all(f.exception() is not None for f in futures)
+    assert Journal(str(tmp_path)).runs(product)[-1]["status"] == RUN_INCOMPLETE
+
+    # The failed requests are submitted again
+    outage = False
+    futures = make_downloader(["a", "b"], reuse_requests=False).resume(
+        str(tmp_path), engine=engine)
+    assert len(futures) == 2 and all(f.exception() is None for f in futures)
+    assert len(fake_cds.submitted) == 4
+    assert [r["status"] for r in Journal(str(tmp_path)).runs(product)] == [RUN_COMPLETE]
+
+
+def test_resume_unplanned_chunks(fake_cds, tmp_path, make_downloader, product):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    downloader = make_downloader(["a", "b", "c", "d", "e"], reuse_requests=False)
+    downloader.split_keys, plan = downloader._plan(["variable"])
+
+    # Chunks are journaled when the workers take them
+    tasks, run = downloader._open_run(str(tmp_path), plan)
+    assert run["journal"].chunks() == []
+    next(tasks)
+    assert len(run["journal"].chunks()) == 5
+    run["journal"].close()
+
+    # Killed after the first two chunks were planned
+    journal = Journal(str(tmp_path))
+    journal.open_run(product, ["variable"], plan=plan)
+    journal.plan([(downloader._file_name(f), f) for f in plan[:2]], consumed=2)
+    journal.close()
+    futures = make_downloader(["a", "b", "c", "d", "e"]).resume(str(tmp_path))
+    assert sorted(r["variable"] for p, r in fake_cds.submitted) == ["a", "b", "c", "d", "e"]
+    assert len(futures) == 5
+    journal = Journal(str(tmp_path))
+    assert [c["file_name"] for c in journal.chunks(journal.runs(product)[-1]["run_id"])] == \
+        ["{}_{}.grib".format(v, product) for v in "abcde"]
+    assert journal.runs(product)[-1]["status"] == RUN_COMPLETE
+
+
+def test_resume_client_error(tmp_path, make_downloader, product, monkeypatch):
+    journal = Journal(str(tmp_path))
+    journal.open_run(product, ["variable"])
+    journal.close()
+
+    def invalid_key(session=None):
+        raise ValueError("invalid key")
+
+    # The error of the client is raised, not a TypeError of its handling
+    monkeypatch.setattr("cds_downloader.cds_downloader.Client", invalid_key)
+    with pytest.raises(ValueError, match="invalid key"):
+        make_downloader(["a"]).resume(str(tmp_path))
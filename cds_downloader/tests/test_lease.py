@@ -0,0 +1,105 @@
+import time
+import sqlite3
+import pickle
+import threading
+
+from cds_downloader.journal import Journal, RUN_COMPLETE, RUN_INCOMPLETE
+from cds_downloader.lease import LeaseTable, LEASE_DONE
+
+
+def test_claim_and_release(tmp_path):
+    host_a = LeaseTable(str(tmp_path), owner="a")
+    host_b = LeaseTable(str(tmp_path), owner="b")
+    assert host_a.claim("x.grib") and host_a.claim("x.grib")
+    assert not host_b.claim("x.grib")
+    assert host_b.holder("x.grib")["owner"] == "a"
+
+    # A failed chunk is free for the others
+    host_a.release("x.grib")
+    assert host_b.claim("x.grib")
+    host_b.release("x.grib", done=True)
+    assert host_b.holder("x.grib")["state"] == LEASE_DONE
+
+    # Finished while planned elsewhere: skipped, finished before the planning: requested again
+    assert not host_a.claim("x.grib") and host_a.finished_elsewhere("x.grib")
+    assert LeaseTable(str(tmp_path), owner="c").claim("x.grib")
+
+
+def test_expired_lease(tmp_path):
+    dead = LeaseTable(str(tmp_path), owner="dead", ttl=0.05)
+    assert dead.claim("x.grib")
+    dead._held.clear()
+    time.sleep(0.1)
+    host = LeaseTable(str(tmp_path), owner="b")
+    assert host.claim("x.grib")
+    dead._held.add("x.grib")
+    assert dead.renew() == ["x.grib"]
+
+
+def test_renewal(tmp_path):
+    host_a = LeaseTable(str(tmp_path), owner="a", ttl=0.3)
+    assert host_a.claim("x.grib")
+    time.sleep(0.6)
+    assert not LeaseTable(str(tmp_path), owner="b").claim("x.grib")
+    host_a.release("x.grib")
+    assert LeaseTable(str(tmp_path), owner="b").claim("x.grib")
+
+    # Process workers get a table without held leases
+    copy = pickle.loads(pickle.dumps(host_a))
+    assert copy.owner == "a" and not copy._held
+
+
+def test_hosts_share_storage_path(fake_cds, tmp_path, make_downloader, product):
+    variables = ["a", "b", "c", "d", "e", "f"]
+    results = {}
+
+    def host(name):
+        results[name] = make_downloader(variables, leases=True, reuse_requests=False).get_data(
+            str(tmp_path), ["variable"], max_workers=2)
+
+    threads = [threading.Thread(target=host, args=(name,)) for name in ["a", "b"]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Every chunk was requested once
+    assert sorted(r["variable"] for p, r in fake_cds.submitted) == variables
+    assert sorted(p.name for p in tmp_path.glob("*.grib")) == \
+        ["{}_{}.grib".format(v, product) for v in variables]
+    assert all(f.exception() is None for futures in results.values() for f in futures)
+
+
+def test_skip_leased_chunk(fake_cds, tmp_path, make_downloader, product):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    other = LeaseTable(str(tmp_path), owner="other")
+    other.claim("a_{}.grib".format(product))
+
+    futures = make_downloader(["a", "b"], leases=True).get_data(str(tmp_path), ["variable"])
+    assert {f.result() for f in futures} == {None, str(tmp_path / "b_{}.grib".format(product))}
+    assert [r["variable"] for p, r in fake_cds.submitted] == ["b"]
+    assert Journal(str(tmp_path)).runs(product)[-1]["status"] == RUN_INCOMPLETE
+
+    # The other host finished it, the resumed run completes without a request
+    other.release("a_{}.grib".format(product), done=True)
+    make_downloader(["a", "b"], leases=True).resume(str(tmp_path))
+    assert len(fake_cds.submitted) == 1
+    assert Journal(str(tmp_path)).runs(product)[-1]["status"] == RUN_COMPLETE
+
+
+def test_lost_lease(fake_cds, tmp_path, make_downloader, product):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    poll = fake_cds.poll
+
+    def stealing_poll(request_id):
+        # The lease expires while the request is processed, another host takes over
+        with sqlite3.connect(str(tmp_path / ".cds_leases.sqlite")) as con:
+            con.execute("UPDATE leases SET owner = 'other'")
+        return poll(request_id)
+
+    fake_cds.poll = stealing_poll
+    futures = make_downloader(["a"], leases=True).get_data(str(tmp_path), ["variable"])
+    assert [f.result() for f in futures] == [None]
+    assert fake_cds.downloads == []
+    assert not (tmp_path / "a_{}.grib".format(product)).exists()
+    assert LeaseTable(str(tmp_path), owner="other").holds("a_{}.grib".format(product))
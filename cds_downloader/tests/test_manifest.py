@@ -0,0 +1,74 @@
+import pytest
+
+from cds_downloader import Downloader
+from cds_downloader.manifest import Manifest, filter_hash, parse_split_values
+from cds_downloader.manifest import STATUS_DONE, STATUS_FAILED
+
+
+PRODUCT = "reanalysis-era5-single-levels"
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    return Manifest(str(tmp_path))
+
+
+def test_record_and_query(manifest, tmp_path):
+    file_name = "2m_temperature_2000_{}.grib".format(PRODUCT)
+    (tmp_path / file_name).write_bytes(b"GRIB7777")
+    cds_filter = {"variable": "2m_temperature", "year": "2000", "format": "grib"}
+    manifest.record(file_name, PRODUCT, cds_filter, ["variable", "year"])
+
+    entry = manifest.get(file_name)
+    assert entry["size"] == 8
+    assert entry["status"] == STATUS_DONE
+    assert entry["checksum"] is not None
+    assert entry["split_values"] == ["2m_temperature", "2000"]
+    assert manifest.split_values(PRODUCT, ["variable", "year"]) == {("2m_temperature", "2000")}
+    assert manifest.split_values(PRODUCT, ["year"]) == set()
+
+
+def test_failed_status(manifest):
+    manifest.record("x.grib", PRODUCT, {"year": "2000"}, ["year"], status=STATUS_FAILED)
+    assert manifest.status("x.grib") == STATUS_FAILED
+    assert manifest.split_values(PRODUCT, ["year"]) == set()
+
+
+def test_filter_hash_canonical():
+    assert filter_hash(PRODUCT, {"year": ["2001", "2000"], "month": "01"}) == \
+        filter_hash(PRODUCT, {"month": ["01"], "year": ["2000", "2001"]})
+    assert filter_hash(PRODUCT, {"area": [1, 2, 3, 4]}) != filter_hash(PRODUCT, {"area": [4, 3, 2, 1]})
+
+
+def test_parse_split_values_underscores():
+    candidates = {"variable": ["2m", "2m_temperature", "total_precipitation"], "year": ["2000"]}
+    assert parse_split_values("2m_temperature_2000", ["variable", "year"], candidates) == \
+        ("2m_temperature", "2000")
+    assert parse_split_values("runoff_2000", ["variable", "year"], candidates) is None
+    assert parse_split_values("all", [], candidates) == ()
+
+
+def test_rebuild(manifest, tmp_path):
+    for name in ["total_precipitation_2000_{}.grib", "2m_temperature_2001_{}.grib", "other.nc"]:
+        (tmp_path / name.format(PRODUCT)).write_bytes(b"GRIB")
+    count = manifest.rebuild(PRODUCT, ["variable", "year"],
+                             {"variable": ["2m_temperature", "total_precipitation"],
+                              "year": ["2000", "2001"]})
+    assert count == 2
+    assert manifest.split_values(PRODUCT, ["variable", "year"]) == \
+        {("total_precipitation", "2000"), ("2m_temperature", "2001")}
+
+
+def test_retrieve_files_records(fake_cds, fake_metadata_cache, tmp_path):
+    downloader = Downloader(PRODUCT, {"format": "grib", "variable": ["2m_temperature"],
+                                      "year": ["2000", "2001"]},
+                            metadata_cache=fake_metadata_cache)
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    downloader.get_data(str(tmp_path), ["year"], engine="async")
+
+    manifest = Manifest(str(tmp_path))
+    assert manifest.split_values(PRODUCT, ["year"]) == {("2000",), ("2001",)}
+
+    # Existing chunks are looked up in the manifest
+    assert downloader.get_data(str(tmp_path), ["year"], engine="async") == []
+    assert len(fake_cds.submitted) == 2
@@ -0,0 +1,54 @@
+import time
+import pytest
+
+from cds_downloader import Downloader
+from cds_downloader.metadata import MetadataCache
+
+
+PRODUCT = "reanalysis-era5-single-levels"
+
+
+def test_cache_hit(fake_cds, fake_metadata_cache):
+    first = fake_metadata_cache.get(PRODUCT)
+    second = fake_metadata_cache.get(PRODUCT)
+    assert first == second == fake_cds.webapi
+    assert len(fake_cds.metadata_requests) == 1
+
+
+def test_cache_shared_on_disk(fake_cds, fake_metadata_cache):
+    fake_metadata_cache.get(PRODUCT)
+    other = MetadataCache(cache_dir=fake_metadata_cache.cache_dir, url="http://127.0.0.1:1/{}")
+    assert other.get(PRODUCT) == fake_cds.webapi
+    assert len(fake_cds.metadata_requests) == 1
+
+
+def test_revalidate_not_modified(fake_cds, fake_metadata_cache):
+    fake_metadata_cache.ttl = 0
+    fake_metadata_cache.get(PRODUCT)
+    time.sleep(0.01)
+    assert fake_metadata_cache.get(PRODUCT) == fake_cds.webapi
+    assert len(fake_cds.metadata_requests) == 2
+    assert fake_metadata_cache._load(PRODUCT)["etag"] is not None
+
+
+def test_stale_fallback(fake_cds, fake_metadata_cache):
+    fake_metadata_cache.get(PRODUCT)
+    fake_metadata_cache.ttl = 0
+    fake_metadata_cache.url = "http://127.0.0.1:1/{}"
+    time.sleep(0.01)
+    assert fake_metadata_cache.get(PRODUCT) == fake_cds.webapi
+
+
+def test_no_cache_entry_unreachable(tmp_path):
+    cache = MetadataCache(cache_dir=str(tmp_path), url="http://127.0.0.1:1/{}", timeout=1)
+    with pytest.raises(Exception):
+        cache.get(PRODUCT)
+
+
+def test_lazy_webapi(fake_cds, fake_metadata_cache):
+    downloader = Downloader(PRODUCT, {"variable": ["2m_temperature"], "year": ["2000", "2001"]},
+                            metadata_cache=fake_metadata_cache)
+    assert downloader._get_org_keys() == ["variable", "year"]
+    assert len(fake_cds.metadata_requests) == 0
+    assert downloader._get_split_keys() == []
+    assert len(fake_cds.metadata_requests) == 1
@@ -0,0 +1,114 @@
+import json
+import pytest
+import requests
+
+from cds_downloader import Downloader
+from cds_downloader.metrics import (Metrics, JsonLinesSink, PrometheusSink, PrometheusTextfileSink,
+                                    PrometheusHTTPSink, phase_seconds)
+
+
+PRODUCT = "reanalysis-era5-single-levels"
+
+
+@pytest.fixture
+def downloader(fake_metadata_cache):
+    return Downloader(PRODUCT, {"format": "grib", "variable": ["2m_temperature", "total_precipitation"],
+                                "year": ["2000"], "month": ["01"], "day": ["01"], "time": ["00:00"]},
+                      metadata_cache=fake_metadata_cache)
+
+
+def test_phase_seconds():
+    times = {"planned": 0., "submitted": 1., "queued": 1.5, "running": 4., "downloading": 6., "done": 10.}
+    assert phase_seconds(times) == {"queue": 2.5, "running": 2., "download": 4., "total": 10.}
+    assert phase_seconds({"planned": 0., "failed": 3.}) == {"total": 3.}
+
+
+def test_events_and_summary():
+    events = []
+    metrics = Metrics(sinks=[events.append])
+    for event in ["planned", "submitted", "queued", "running", "downloading"]:
+        metrics.emit(event, "/data/a.grib", PRODUCT)
+    metrics.retry("/data/a.grib")
+    done = metrics.emit("done", "/data/a.grib", PRODUCT, bytes=100)
+    metrics.emit("planned", "b.grib", PRODUCT)
+    metrics.emit("failed", "b.grib", PRODUCT, error="boom")
+
+    assert [e["event"] for e in events] == ["planned", "submitted", "queued", "running",
+                                            "downloading", "done", "planned", "failed"]
+    assert done["file_name"] == "a.grib"
+    assert done["bytes"] == 100 and done["retries"] == 1
+    assert {"queue_seconds", "running_seconds", "download_seconds", "total_seconds"} <= set(done)
+    assert events[-1]["error"] == "boom"
+
+    run = metrics.finish_run(PRODUCT)
+    assert run["event"] == "run"
+    assert (run["chunks"], run["done"], run["failed"], run["bytes"], run["retries"]) == (2, 1, 1, 100, 1)
+    assert "download_seconds_mean" in run
+
+
+def test_broken_sink_is_ignored():
+    def broken(record):
+        raise RuntimeError("broken")
+
+    events = []
+    metrics = Metrics(sinks=[broken, events.append])
+    metrics.emit("planned", "a.grib")
+    assert len(events) == 1
+
+
+def test_prometheus_render():
+    sink = PrometheusSink()
+    metrics = Metrics(sinks=[sink])
+    metrics.emit("planned", "a.grib", PRODUCT)
+    metrics.emit("downloading", "a.grib", PRODUCT)
+    metrics.emit("done", "a.grib", PRODUCT, bytes=100)
+    metrics.finish_run(PRODUCT)
+
+    text = sink.render()
+    assert 'cds_downloader_chunk_events_total{event="done",product="%s"} 1' % PRODUCT in text
+    assert 'cds_downloader_bytes_total{product="%s"} 100' % PRODUCT in text
+    assert 'cds_downloader_phase_seconds_count{phase="download",product="%s"} 1' % PRODUCT in text
+    assert 'cds_downloader_last_run_chunks{product="%s"} 1' % PRODUCT in text
+
+
+def test_prometheus_http():
+    sink = PrometheusHTTPSink(0, address="127.0.0.1")
+    try:
+        sink({"event": "planned", "product": PRODUCT, "file_name": "a.grib"})
+        response = requests.get("http://127.0.0.1:{}/metrics".format(sink.port))
+        assert response.status_code == 200
+        assert "cds_downloader_chunk_events_total" in response.text
+    finally:
+        sink.close()
+
+
+def test_downloader_sinks(fake_cds, downloader, tmp_path):
+    fake_cds.queued_polls = fake_cds.running_polls = 1
+    path_events = str(tmp_path / "events.jsonl")
+    path_prom = str(tmp_path / "cds.prom")
+    downloader.metrics = Metrics(sinks=[JsonLinesSink(path_events), PrometheusTextfileSink(path_prom)])
+    downloader.get_data(str(tmp_path / "data"), ["variable"], max_workers=2)
+    downloader.metrics.close()
+
+    with open(path_events) as f:
+        events = [json.loads(line) for line in f]
+    for file_name in ["2m_temperature_{}.grib".format(PRODUCT), "total_precipitation_{}.grib".format(PRODUCT)]:
+        assert [e["event"] for e in events if e.get("file_name") == file_name] == \
+            ["planned", "submitted", "queued", "running", "downloading", "done"]
+    done = [e for e in events if e["event"] == "done"]
+    assert all(e["bytes"] == fake_cds.result_size for e in done)
+    assert all(e["queue_seconds"] > 0 for e in done)
+    assert events[-1]["event"] == "run" and events[-1]["done"] == 2
+
+    with open(path_prom) as f:
+        assert 'cds_downloader_bytes_total{product="%s"} %d' % (PRODUCT, 2 * fake_cds.result_size) in f.read()
+
+
+def test_downloader_async_events(fake_cds, downloader, tmp_path):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    events = []
+    downloader.metrics.add_sink(events.append)
+    downloader.get_data(str(tmp_path), ["variable"], engine="async", max_workers=2)
+
+    assert sorted(e["event"] for e in events if e["event"] != "run") == sorted(
+        ["planned", "submitted", "queued", "downloading", "done"] * 2)
@@ -0,0 +1,66 @@
+import pytest
+
+from cds_downloader import Downloader
+from cds_downloader.planner import Planner, group_values, value_label
+
+
+MONTHS = [str(m).zfill(2) for m in range(1, 13)]
+
+
+def test_half_years():
+    cds_filter = {"variable": ["2m_temperature"], "year": ["2000"], "month": MONTHS,
+                  "area": [50, 3, 42, 17]}
+    split_keys, groups = Planner(6).plan(cds_filter)
+    assert split_keys == ["month"]
+    assert groups["month"] == [MONTHS[:6], MONTHS[6:]]
+
+
+@pytest.mark.parametrize("limit, expected_requests", [(64, 1), (31, 2), (6, 8), (3, 16), (1, 32)])
+def test_minimal_requests(limit, expected_requests):
+    cds_filter = {k: ["a", "b"] for k in ["variable", "year", "month", "day", "time"]}
+    planner = Planner(limit)
+    split_keys, groups = planner.plan(cds_filter)
+    chunks = list(planner.expand(cds_filter, split_keys, groups))
+    assert len(chunks) == expected_requests
+    for chunk in chunks:
+        size = 1
+        for k in cds_filter:
+            size *= len(chunk[k]) if isinstance(chunk[k], list) else 1
+        assert size <= limit
+
+
+def test_fewer_requests_than_greedy_split():
+    cds_filter = {"variable": ["a", "b", "c"], "year": [str(y) for y in range(2000, 2010)],
+                  "month": MONTHS}
+    # Greedy splitting of whole keys needs 3 * 10 = 30 requests
+    split_keys, groups = Planner(200).plan(cds_filter)
+    n_requests = 1
+    for k in split_keys:
+        n_requests *= len(groups[k])
+    assert n_requests == 2
+
+
+def test_deterministic_plan():
+    cds_filter = {"variable": ["a", "b"], "month": MONTHS}
+    assert Planner(12).plan(cds_filter) == Planner(12).plan(cds_filter)
+    assert Planner(12).plan(cds_filter)[0] == ["variable"]
+
+
+def test_group_values_and_label():
+    assert group_values(list(range(5)), 2) == [[0, 1, 2], [3, 4]]
+    assert value_label(["01", "02", "03"]) == "01-03"
+    assert value_label(["01"]) == "01"
+    assert value_label("01") == "01"
+
+
+def test_downloader_plan(fake_metadata_cache):
+    downloader = Downloader("reanalysis-era5-single-levels",
+                            {"format": "grib", "variable": ["2m_temperature"], "year": ["2000"],
+                             "month": MONTHS}, metadata_cache=fake_metadata_cache)
+    downloader.cds_webapi["selection_limit"] = 6
+    chunks = downloader.plan()
+    assert [c["month"] for c in chunks] == [MONTHS[:6], MONTHS[6:]]
+    assert len(downloader.plan(["month"])) == 12
+
+    downloader.split_keys = ["month"]
+    assert downloader._file_name(chunks[0]) == "01-06_reanalysis-era5-single-levels.grib"
@@ -0,0 +1,79 @@
+import json
+import time
+import pytest
+
+from cds_downloader import Downloader
+from cds_downloader.batch import Batch
+from cds_downloader.chunk_plan import ChunkPlan
+from cds_downloader.priority import prioritize, chunk_size
+from cds_downloader.scheduler import Scheduler
+
+
+CHUNKS = [{"variable": v, "year": y, "month": ["01", "02"] if v == "t" else "01"}
+          for v in ["t", "u"] for y in ["2000", "2001", "2002"]]
+
+
+def _labels(chunks):
+    return ["{}{}".format(c["variable"], c["year"][-1]) for c in chunks]
+
+
+def test_prioritize():
+    assert prioritize(CHUNKS, "plan") is CHUNKS
+    assert _labels(prioritize(CHUNKS, "newest")) == ["t2", "u2", "t1", "u1", "t0", "u0"]
+    assert _labels(prioritize(CHUNKS, "oldest")) == ["t0", "u0", "t1", "u1", "t2", "u2"]
+    assert _labels(prioritize(CHUNKS, "round-robin")) == ["t0", "u0", "t1", "u1", "t2", "u2"]
+    assert _labels(prioritize(CHUNKS, "cheapest")) == ["u0", "u1", "u2", "t0", "t1", "t2"]
+    assert [chunk_size(c) for c in CHUNKS] == [2, 2, 2, 1, 1, 1]
+    assert _labels(prioritize(CHUNKS, lambda c: c["variable"] != "u")) == ["u0", "u1", "u2", "t0", "t1", "t2"]
+    with pytest.raises(ValueError):
+        prioritize(CHUNKS, "largest")
+
+
+def test_prioritize_plan():
+    plan = ChunkPlan({"variable": ["t", "u"], "year": ["2000", "2001"], "month": ["01", "12"]},
+                     ["variable", "year", "month"])
+    chunks = [dict(c) for c in prioritize(plan, "newest")]
+    assert [(c["year"], c["month"]) for c in chunks] == \
+        [("2001", "12")] * 2 + [("2001", "01")] * 2 + [("2000", "12")] * 2 + [("2000", "01")] * 2
+    assert [c["variable"] for c in chunks[:2]] == ["t", "u"]
+
+
+def test_get_data_newest_first(fake_cds, fake_metadata_cache, tmp_path, product):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    downloader = Downloader(product, {"format": "grib", "variable": ["t"], "year": ["2000", "2001"],
+                                      "month": ["01", "02"], "day": ["01"], "time": ["00:00"]},
+                            metadata_cache=fake_metadata_cache)
+    futures = downloader.get_data(str(tmp_path), ["year", "month"], max_workers=1, priority="newest")
+
+    assert all(f.exception() is None for f in futures)
+    assert [(r["year"], r["month"]) for p, r in fake_cds.submitted] == \
+        [("2001", "02"), ("2001", "01"), ("2000", "02"), ("2000", "01")]
+
+
+def test_run_fair_priorities():
+    started = []
+
+    def work(group, i):
+        started.append(group)
+        time.sleep(0.001)
+
+    groups = {"backfill": [("backfill", i) for i in range(6)], "urgent": [("urgent", i) for i in range(3)]}
+    list(Scheduler(max_workers=1).run_fair(work, groups, priorities={"urgent": 1}))
+    assert started == ["urgent"] * 3 + ["backfill"] * 6
+
+
+def test_batch_urgency(fake_cds, fake_metadata_cache, tmp_path, product):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    (tmp_path / "configs").mkdir()
+    for name, variables, job in [("backfill", ["a", "b", "c"], {}), ("recent", ["t", "u"], {"urgency": 1})]:
+        config = dict({"cds_product": product,
+                       "cds_filter": {"format": "grib", "variable": variables, "year": ["2000"],
+                                      "month": ["01"], "day": ["01"], "time": ["00:00"]}}, **job)
+        (tmp_path / "configs" / "{}.json".format(name)).write_text(json.dumps(config))
+
+    batch = Batch.from_paths([str(tmp_path / "configs")], str(tmp_path / "data"), split_keys=["variable"],
+                             metadata_cache=fake_metadata_cache, max_workers=1,
+                             job_kwargs={"priority": "round-robin"})
+    assert batch.run()["done"] == 5
+    # The urgent configuration of the same product drains before the backfill
+    assert [r["variable"] for p, r in fake_cds.submitted] == ["t", "u", "a", "b", "c"]
@@ -0,0 +1,118 @@
+import os
+import subprocess
+import sys
+
+from cds_downloader import Downloader
+from cds_downloader.grib_index import GribIndex
+from cds_downloader.result_cache import ResultCache, link_file, parse_size, subset_criteria
+
+
+PRODUCT = "reanalysis-era5-single-levels"
+
+
+def _write(path, size):
+    with open(str(path), 'wb') as f:
+        f.write(b"x" * size)
+    return str(path)
+
+
+def test_put_get(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    source = _write(tmp_path / "a.grib", 10)
+    cache.put(PRODUCT, {"year": ["2000"], "variable": "t"}, source)
+
+    target = str(tmp_path / "b.grib")
+    assert cache.get(PRODUCT, {"variable": ["t"], "year": "2000"}, target) == target
+    assert os.path.samefile(source, target)
+    assert cache.get(PRODUCT, {"variable": "t", "year": "2001"}, target) is None
+    assert cache.stats()["entries"] == 1 and cache.stats()["hits"] == 1
+
+
+def test_lru_eviction(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_size=25)
+    for year in ["2000", "2001"]:
+        cache.put(PRODUCT, {"year": year}, _write(tmp_path / year, 10))
+    # Access 2000, hence 2001 is least recently used
+    cache.get(PRODUCT, {"year": "2000"}, str(tmp_path / "copy"))
+    cache.put(PRODUCT, {"year": "2002"}, _write(tmp_path / "2002", 10))
+
+    assert cache.stats()["size"] == 20
+    assert cache.get(PRODUCT, {"year": "2001"}, str(tmp_path / "x")) is None
+    assert cache.get(PRODUCT, {"year": "2000"}, str(tmp_path / "x")) is not None
+
+    assert len(cache.prune(0)) == 2
+    assert cache.stats()["entries"] == 0
+
+
+def test_link_fallback(tmp_path, monkeypatch):
+    source = _write(tmp_path / "a", 10)
+    monkeypatch.setattr(os, "link", lambda *args: (_ for _ in ()).throw(OSError("cross device")))
+    assert link_file(source, str(tmp_path / "b")) in ("reflink", "copy")
+    assert os.path.getsize(str(tmp_path / "b")) == 10
+
+
+def test_parse_size():
+    assert parse_size("10") == 10
+    assert parse_size("2K") == 2048
+    assert parse_size("1.5GB") == 3 << 29
+
+
+def test_shared_between_storage_paths(fake_cds, fake_metadata_cache, tmp_path):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    cache = ResultCache(str(tmp_path / "cache"))
+    cds_filter = {"format": "grib", "variable": "2m_temperature", "year": ["2000", "2001"]}
+
+    for path in ["a", "b"]:
+        downloader = Downloader(PRODUCT, cds_filter, metadata_cache=fake_metadata_cache,
+                                result_cache=cache)
+        downloader.get_data(str(tmp_path / path), ["year"])
+
+    assert len(fake_cds.submitted) == 2
+    assert len(list((tmp_path / "b").glob("*.grib"))) == 2
+    assert cache.stats()["hits"] == 2
+
+
+def test_subset_criteria():
+    cached = {"format": "grib", "variable": ["a", "b"], "year": "2000", "month": ["01", "02"],
+              "day": ["01", "02"], "time": ["00:00", "12:00"]}
+    params = {"a": "0.0.10", "b": "0.0.11"}
+    assert subset_criteria(cached, dict(cached, variable="b"), params) == {"param": ["0.0.11"]}
+    assert subset_criteria(cached, dict(cached, month="2", day="2", time="12:00"), params) == \
+        {"valid_time": ["2000-02-02T12:00:00"]}
+    assert subset_criteria(cached, dict(cached, month="1"), params)["valid_time"][0] == "2000-01-01T00:00:00"
+
+    # Variables of unknown parameter, other values, keys and formats are not served
+    assert subset_criteria(cached, dict(cached, variable="b")) is None
+    assert subset_criteria(cached, dict(cached, year="2001"), params) is None
+    assert subset_criteria(cached, dict(cached, area=[90, 0, 0, 90]), params) is None
+    assert subset_criteria(dict(cached, format="netcdf"), dict(cached, format="netcdf", variable="b"),
+                           params) is None
+
+
+def test_shared_between_split_layouts(fake_cds, fake_metadata_cache, tmp_path, product, grib_params):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    fake_cds.params = grib_params
+    cache = ResultCache(str(tmp_path / "cache"))
+    cds_filter = {"format": "grib", "variable": ["a", "b"], "year": ["2000"], "month": ["01"],
+                  "day": ["01", "02"], "time": ["00:00", "12:00"]}
+    params = {v: "0.0.{}".format(p) for v, p in grib_params.items()}
+
+    Downloader(product, cds_filter, metadata_cache=fake_metadata_cache, result_cache=cache,
+               grib_params=params).get_data(str(tmp_path / "yearly"), ["year"])
+    # The daily files of every variable are extracted from the yearly result
+    futures = Downloader(product, cds_filter, metadata_cache=fake_metadata_cache, result_cache=cache,
+                         grib_params=params).get_data(str(tmp_path / "daily"), ["variable", "day"])
+
+    assert futures == [] and len(fake_cds.submitted) == 1
+    assert cache.stats()["hits"] == 4
+    index = GribIndex(str(tmp_path / "daily" / "b_02_{}.grib".format(product)))
+    assert {m["param"] for m in index.messages} == {"0.0.11"}
+    assert [m["valid_time"] for m in index.messages] == ["2000-01-02T00:00:00", "2000-01-02T12:00:00"]
+
+
+def test_cli_stats(tmp_path):
+    ResultCache(str(tmp_path)).put(PRODUCT, {"year": "2000"}, _write(tmp_path / "a", 10))
+    script = os.path.join(os.path.dirname(__file__), "..", "..", "scripts", "cds_cache.py")
+    env = dict(os.environ, PYTHONPATH=os.path.join(os.path.dirname(__file__), "..", ".."))
+    output = subprocess.check_output([sys.executable, script, "-cd", str(tmp_path), "stats"], env=env)
+    assert b"entries: 1" in output
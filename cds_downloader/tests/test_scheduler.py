@@ -0,0 +1,77 @@
+import threading
+import time
+import pytest
+
+from cds_downloader.scheduler import Scheduler
+from cds_downloader.concurrency import AdaptiveLimit
+
+
+def _sleep_and_return(value, delay=0.01):
+    time.sleep(delay)
+    return value
+
+
+def test_results_of_all_tasks():
+    scheduler = Scheduler(max_workers=3)
+    futures = list(scheduler.run(_sleep_and_return, ((i,) for i in range(10))))
+    assert sorted(f.result() for f in futures) == list(range(10))
+
+
+def test_bounded_concurrency():
+    lock = threading.Lock()
+    state = {"running": 0, "peak": 0}
+
+    def task(i):
+        with lock:
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+        time.sleep(0.01)
+        with lock:
+            state["running"] -= 1
+        return i
+
+    scheduler = Scheduler(max_workers=2)
+    futures = list(scheduler.run(task, ((i,) for i in range(8))))
+    assert len(futures) == 8
+    assert state["peak"] <= 2
+
+
+def test_lazy_backlog():
+    consumed = []
+
+    def tasks():
+        for i in range(100):
+            consumed.append(i)
+            yield (i,)
+
+    scheduler = Scheduler(max_workers=2)
+    first = next(scheduler.run(_sleep_and_return, tasks()))
+    assert first.done()
+    assert len(consumed) < 100
+
+
+def test_completion_order():
+    scheduler = Scheduler(max_workers=2)
+    futures = list(scheduler.run(_sleep_and_return, [("slow", 0.2), ("fast", 0.01)]))
+    assert [f.result() for f in futures] == ["fast", "slow"]
+
+
+def test_failed_task():
+    def fail(i):
+        raise RuntimeError(i)
+
+    futures = list(Scheduler(max_workers=1).run(fail, [(1,)]))
+    assert isinstance(futures[0].exception(), RuntimeError)
+
+
+def test_process_workers():
+    scheduler = Scheduler(max_workers=2, worker_type="process")
+    futures = list(scheduler.run(_sleep_and_return, ((i,) for i in range(4))))
+    assert sorted(f.result() for f in futures) == list(range(4))
+
+
+@pytest.mark.parametrize("kwargs", [{"max_workers": 0}, {"worker_type": "fiber"},
+                                    {"worker_type": "process", "limit": AdaptiveLimit()}])
+def test_invalid_arguments(kwargs):
+    with pytest.raises(ValueError):
+        Scheduler(**kwargs)
@@ -0,0 +1,59 @@
+import pickle
+
+from cds_downloader import Downloader
+from cds_downloader.metadata import MetadataCache
+from cds_downloader.session import Client, create_session, session_stats
+
+
+def test_client_uses_shared_session(fake_cds):
+    session = create_session(pool_size=4)
+    client = Client(session=session, url=fake_cds.api_url, key="1:abcdef", quiet=True)
+
+    assert client.session is session
+    assert session.auth == ("1", "abcdef")
+    assert client.status() == {}
+    client.status()
+
+    stats = session_stats(session)
+    assert stats["requests"] == 2
+    assert stats["connections"] == 1 and stats["reused"] == 1
+
+
+def test_get_data_reuses_connections(fake_cds, tmp_path_factory, tmp_path):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    session = create_session()
+    metadata_cache = MetadataCache(cache_dir=str(tmp_path_factory.mktemp("metadata")),
+                                   url=fake_cds.url + "/api/v2.ui/resources/{}")
+    downloader = Downloader("reanalysis-era5-single-levels",
+                            {"format": "grib", "variable": ["2m_temperature"],
+                             "year": ["2000", "2001"]},
+                            metadata_cache=metadata_cache, session=session)
+    assert downloader.metadata_cache.session is session
+
+    downloader.get_data(str(tmp_path), ["year"], max_workers=1)
+
+    assert len(list(tmp_path.glob("*.grib"))) == 2
+    stats = session_stats(session)
+    # metadata, then submit, poll, download and delete for every year
+    assert stats["requests"] >= 1 + 2 * 4
+    assert stats["connections"] == fake_cds.connections == 1
+
+
+def test_process_workers(fake_cds, fake_metadata_cache, tmp_path):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    downloader = Downloader("reanalysis-era5-single-levels",
+                            {"format": "grib", "variable": ["2m_temperature"], "year": ["2000", "2001"]},
+                            metadata_cache=fake_metadata_cache)
+    assert downloader.cds_webapi is not None
+    downloader.cdsapi_client = Client(session=downloader.session)
+
+    # Workers get neither the metadata nor the session of the parent
+    copy = pickle.loads(pickle.dumps(downloader))
+    assert copy._cds_webapi is None and downloader._cds_webapi is not None
+    assert copy.session is copy.cdsapi_client.session is copy.metadata_cache.session
+    assert copy.session is not downloader.session and copy.session.auth == downloader.session.auth
+    assert downloader.metadata_cache.session is downloader.session
+
+    futures = downloader.get_data(str(tmp_path), ["year"], max_workers=2, worker_type="process")
+    assert all(f.exception() is None for f in futures)
+    assert len(list(tmp_path.glob("*.grib"))) == 2
@@ -0,0 +1,161 @@
+import os
+import pytest
+import requests
+
+from cds_downloader import Downloader
+from cds_downloader.transfer import download, resume_result, save_result
+from cds_downloader.transfer import segmented_download, segment_count
+from cds_downloader.transfer import partial_path, result_path, segments_path, IncompleteDownload
+
+
+def _result(fake_cds):
+    request_id = fake_cds.submit("product", {})["request_id"]
+    fake_cds.tasks[request_id]["state"] = "completed"
+    return fake_cds.reply(request_id)
+
+
+def test_resume_interrupted_download(fake_cds, tmp_path):
+    fake_cds.interruptions = 1
+    fake_cds.result_size = 1 << 18
+    reply = _result(fake_cds)
+    target = str(tmp_path / "data.grib")
+
+    download(fake_cds.url + reply["location"], target, size=fake_cds.result_size, sleep=0)
+
+    assert os.path.getsize(target) == fake_cds.result_size
+    assert not os.path.exists(partial_path(target))
+    offsets = [offset for path, offset in fake_cds.downloads]
+    assert len(offsets) == 2 and offsets[0] == 0
+    assert 0 < offsets[1] <= fake_cds.result_size // 2
+    with open(target, 'rb') as f:
+        assert f.read() == fake_cds.content(reply["request_id"])
+
+
+def test_restart_without_range_support(fake_cds, tmp_path):
+    fake_cds.interruptions = 1
+    fake_cds.range_support = False
+    reply = _result(fake_cds)
+    target = str(tmp_path / "data.grib")
+
+    download(fake_cds.url + reply["location"], target, size=fake_cds.result_size, sleep=0)
+
+    assert os.path.getsize(target) == fake_cds.result_size
+    assert [offset for path, offset in fake_cds.downloads] == [0, 0]
+
+
+def test_length_mismatch(fake_cds, tmp_path):
+    reply = _result(fake_cds)
+    target = str(tmp_path / "data.grib")
+
+    with pytest.raises(IncompleteDownload):
+        download(fake_cds.url + reply["location"], target, size=fake_cds.result_size + 1, sleep=0)
+    assert not os.path.exists(target)
+
+
+def test_interrupted_without_length(tmp_path):
+    class Response(object):
+        status_code = 200
+        headers = {}
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def raise_for_status(self):
+            pass
+
+        def iter_content(self, chunk_size):
+            yield b"GRIB"
+            raise requests.exceptions.ConnectionError("reset")
+
+    class Session(object):
+        def get(self, url, **kwargs):
+            return Response()
+
+    target = str(tmp_path / "data.grib")
+    with pytest.raises(IncompleteDownload):
+        download("http://localhost/data.grib", target, session=Session(), retry_max=2, sleep=0)
+    assert not os.path.exists(target)
+    assert os.path.exists(partial_path(target))
+
+
+def test_resume_saved_result(fake_cds, fake_client, tmp_path):
+    reply = _result(fake_cds)
+    target = str(tmp_path / "data.grib")
+    save_result(target, reply)
+    with open(partial_path(target), 'wb') as f:
+        f.write(fake_cds.content(reply["request_id"])[:100])
+
+    assert resume_result(fake_client, target) == target
+    assert os.path.getsize(target) == fake_cds.result_size
+    assert not os.path.exists(result_path(target))
+    assert fake_cds.downloads[0][1] == 100
+
+
+def test_resume_expired_result(fake_cds, fake_client, tmp_path):
+    target = str(tmp_path / "data.grib")
+    save_result(target, {"request_id": "0", "location": "/download/0.grib",
+                         "content_length": 10, "content_type": "application/x-grib"})
+    assert resume_result(fake_client, target) is None
+    assert not os.path.exists(result_path(target))
+
+
+def test_get_data_atomic(fake_cds, fake_metadata_cache, tmp_path):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    downloader = Downloader("reanalysis-era5-single-levels",
+                            {"format": "grib", "variable": ["2m_temperature"], "year": ["2000"]},
+                            metadata_cache=fake_metadata_cache)
+    downloader.get_data(str(tmp_path), [], max_workers=1)
+
+    target = tmp_path / "all_reanalysis-era5-single-levels.grib"
+    assert target.stat().st_size == fake_cds.result_size
+    assert sorted(os.listdir(tmp_path)) == sorted([".cds_manifest.sqlite", ".cds_journal.sqlite", target.name,
+                                                   target.name + ".index.json"])
+
+
+def test_segmented_download(fake_cds, tmp_path):
+    fake_cds.result_size = 100000
+    reply = _result(fake_cds)
+    target = str(tmp_path / "data.grib")
+
+    segmented_download(fake_cds.url + reply["location"], target, fake_cds.result_size,
+                       segments=4, min_segment_size=10000, sleep=0)
+
+    with open(target, 'rb') as f:
+        assert f.read() == fake_cds.content(reply["request_id"])
+    # Range probe and four segments
+    assert sorted(offset for path, offset in fake_cds.downloads)[1:] == [0, 25000, 50000, 75000]
+    assert not os.path.exists(segments_path(target))
+
+
+def test_segmented_download_resume(fake_cds, tmp_path):
+    fake_cds.result_size = 100000
+    fake_cds.interruptions = 2
+    reply = _result(fake_cds)
+    target = str(tmp_path / "data.grib")
+
+    segmented_download(fake_cds.url + reply["location"], target, fake_cds.result_size,
+                       segments=2, min_segment_size=10000, sleep=0)
+
+    with open(target, 'rb') as f:
+        assert f.read() == fake_cds.content(reply["request_id"])
+
+
+def test_segmented_fallback(fake_cds, tmp_path):
+    fake_cds.range_support = False
+    reply = _result(fake_cds)
+    target = str(tmp_path / "data.grib")
+
+    segmented_download(fake_cds.url + reply["location"], target, fake_cds.result_size,
+                       segments=4, min_segment_size=1, sleep=0)
+
+    assert os.path.getsize(target) == fake_cds.result_size
+    assert [offset for path, offset in fake_cds.downloads] == [0, 0]
+
+
+def test_segment_count():
+    assert segment_count(10, 8, min_segment_size=100) == 1
+    assert segment_count(1000, 8, min_segment_size=100) == 8
+    assert segment_count(350, 8, min_segment_size=100) == 3
@@ -0,0 +1,85 @@
+import copy
+import datetime
+import pytest
+
+from cds_downloader import Downloader
+from cds_downloader.watch import Watcher, available_until
+from cds_downloader.fake_cds import WEBAPI
+
+
+PRODUCT = "reanalysis-era5-single-levels"
+
+
+def test_available_until():
+    now = datetime.datetime(2021, 6, 15, 12)
+    # The last complete day before the publication latency, with every time of the day
+    assert available_until(WEBAPI, now=now) == datetime.datetime(2021, 6, 9, 23, 59, 59)
+    assert available_until(WEBAPI, now=now, latency=datetime.timedelta(0)) == datetime.datetime(2021, 6, 14, 23, 59, 59)
+    assert available_until(dict(WEBAPI, update_date="2021-06-10"), now=now) == \
+        datetime.datetime(2021, 6, 10, 23, 59, 59)
+
+    webapi = copy.deepcopy(WEBAPI)
+    webapi["form"][0]["details"]["values"] = ["2018", "2019"]
+    webapi["form"][1]["details"]["values"] = ["01", "02"]
+    assert available_until(webapi, now=now) == datetime.datetime(2019, 2, 28, 23, 59, 59)
+    assert available_until({"form": []}) is None
+
+
+@pytest.fixture
+def watcher(fake_cds, fake_metadata_cache, tmp_path):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    fake_cds.webapi = dict(WEBAPI, update_date="2000-01-02")
+    downloader = Downloader(PRODUCT, {"format": "grib", "variable": "2m_temperature"},
+                            metadata_cache=fake_metadata_cache)
+    return Watcher(downloader, str(tmp_path / "data"), ["year", "month", "day"], interval=0)
+
+
+def test_watch_new_dates(fake_cds, watcher, tmp_path):
+    # A new collection starts at the first available date
+    assert len(watcher.cycle()) == 1
+    assert [r["day"] for p, r in fake_cds.submitted] == ["02"]
+
+    # Nothing published, nothing requested
+    assert watcher.cycle() == []
+    assert len(fake_cds.submitted) == 1
+
+    fake_cds.webapi = dict(WEBAPI, update_date="2000-01-04")
+    assert len(watcher.cycle()) == 2
+    assert sorted(r["day"] for p, r in fake_cds.submitted) == ["02", "03", "04"]
+    assert sorted(p.name for p in (tmp_path / "data").glob("*.grib")) == \
+        ["2000_01_{}_{}.grib".format(d, PRODUCT) for d in ["02", "03", "04"]]
+
+
+def test_watch_latency_and_run(fake_cds, watcher):
+    fake_cds.webapi = dict(WEBAPI, update_date="2000-01-05")
+    watcher.date_latency = "2D"
+    watcher.run(max_cycles=3)
+    assert [r["day"] for p, r in fake_cds.submitted] == ["03"]
+    assert watcher.last_available == datetime.datetime(2000, 1, 3, 23, 59, 59)
+
+
+def test_watch_failed_cycle_is_retried(fake_cds, watcher):
+    def failing_poll(request_id):
+        return {"request_id": request_id, "state": "failed",
+                "error": {"message": "failed", "reason": "test"}}
+
+    poll = fake_cds.poll
+    fake_cds.poll = failing_poll
+    futures = watcher.cycle()
+    assert len(futures) == 1 and futures[0].exception() is not None
+    assert watcher.last_available is None
+
+    fake_cds.poll = poll
+    assert len(watcher.cycle()) == 1
+    assert watcher.last_available == datetime.datetime(2000, 1, 2, 23, 59, 59)
+
+
+def test_watch_time_chunks(fake_cds, fake_metadata_cache, tmp_path):
+    fake_cds.queued_polls = fake_cds.running_polls = 0
+    fake_cds.webapi = dict(WEBAPI, update_date="2000-01-02")
+    downloader = Downloader(PRODUCT, {"format": "grib", "variable": "2m_temperature"},
+                            metadata_cache=fake_metadata_cache)
+    watcher = Watcher(downloader, str(tmp_path / "data"), ["year", "month", "day", "time"], interval=0)
+    # Every hour of the last available day, not only its midnight
+    assert len(watcher.cycle()) == 24
+    assert {(r["day"], r["time"]) for p, r in fake_cds.submitted} == {("02", "{:02d}:00".format(h)) for h in range(24)}
@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+
+"""
+transfer.py:
+Resumable and atomic download of cds results
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import os
+import json
+import time
+import threading
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from cdsapi.api import Result
+
+
+PARTIAL_SUFFIX = ".partial"
+RESULT_SUFFIX = ".partial.json"
+SEGMENTS_SUFFIX = ".partial.segments"
+
+# Smallest segment of a segmented download
+MIN_SEGMENT_SIZE = 32 << 20
+
+# Bytes of an interrupted chunk are lost, keep chunks small
+CHUNK_SIZE = 1 << 16
+
+
+class IncompleteDownload(Exception):
+    """Raised if the length of a download does not match its Content-Length"""
+    pass
+
+
+def partial_path(target):
+    return target + PARTIAL_SUFFIX
+
+
+def result_path(target):
+    return target + RESULT_SUFFIX
+
+
+def segments_path(target):
+    return target + SEGMENTS_SUFFIX
+
+
+def save_result(target, reply):
+    """Save the reply of a completed cds request next to the target, the
+    download can be resumed from its location after a crash"""
+    path_temp = result_path(target) + ".tmp"
+    with open(path_temp, 'w') as f:
+        json.dump(reply, f)
+    os.replace(path_temp, result_path(target))
+
+
+def load_result(target):
+    """Load the saved reply of a completed cds request or None"""
+    try:
+        with open(result_path(target), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class _HashFollower(object):
+    """Hash the bytes of a file in order while they are written, e.g. the
+    prefix of a resumed download or segments arriving out of order
+
+    A background thread reads the bytes back (usually from the page cache)
+    as soon as they are contiguous from the start of the file, hence the
+    checksum is complete shortly after the last byte is written.
+    """
+
+    def __init__(self, checksum, path, available=0, block_size=1 << 20):
+        self.checksum = checksum
+        self.path = path
+        self.block_size = block_size
+        self.available = available
+        self.hashed = 0
+        self._closed = False
+        self._cancelled = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="hash-follower", daemon=True)
+        self._thread.start()
+
+
+    def advance(self, available):
+        """The first available bytes of the file are written"""
+        with self._condition:
+            self.available = max(self.available, available)
+            self._condition.notify()
+
+
+    def close(self, cancel=False):
+        """Wait until every available byte is hashed, or stop at once"""
+        with self._condition:
+            self._closed = True
+            self._cancelled = cancel
+            self._condition.notify()
+        self._thread.join()
+
+
+    def _run(self):
+        with open(self.path, 'rb') as f:
+            while True:
+                with self._condition:
+                    while self.hashed >= self.available and not self._closed:
+                        self._condition.wait()
+                    if self._cancelled or self.hashed >= self.available:
+                        return
+                    limit = self.available
+                f.seek(self.hashed)
+                while self.hashed < limit:
+                    block = f.read(min(self.block_size, limit - self.hashed))
+                    if not block:
+                        break
+                    self.checksum.update(block)
+                    self.hashed += len(block)
+
+
+def _total_length(response, offset):
+    # Total length of the resource from Content-Range or Content-Length
+    content_range = response.headers.get("Content-Range")
+    if content_range and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        if total.isdigit():
+            return int(total)
+    if response.headers.get("Content-Length") is not None:
+        return int(response.headers["Content-Length"]) + offset
+    return None
+
+
+def download(url, target, size=None, session=None, verify=True, timeout=60,
+             retry_max=5, sleep=10., sleep_max=120., checksum=None, on_retry=None):
+    """Download url into target.partial and rename it to target when complete
+
+    An existing partial file is continued with an HTTP Range request. If the
+    server ignores the range, the download starts from scratch. The final
+    length has to match the expected size and the Content-Length of the
+    server and the stream has to end without an error, otherwise the partial
+    file is kept for the next attempt.
+
+    Parameters
+    ----------
+    url : string
+        location of the result
+    target : string
+        final file name
+    size : int, optional
+        expected size in bytes
+    session : requests.Session, optional
+        http session, defaults to the requests module
+    verify : boolean, optional
+        verify tls certificates
+    timeout : int or float, optional
+        timeout of http requests in seconds
+    retry_max : int, optional
+        number of attempts, each attempt continues the partial file
+    sleep, sleep_max : float, optional
+        initial and maximum sleep between two attempts in seconds
+    checksum : cds_downloader.integrity.Checksum, optional
+        checksum updated with the bytes while they are streamed in, the part
+        of a resumed download is hashed while the rest is streamed
+    on_retry : callable, optional
+        called without arguments before every further attempt
+
+    Returns
+    -------
+    target : string
+        final file name
+    """
+    getter = session.get if session is not None else requests.get
+    path_partial = partial_path(target)
+
+    # A preallocated file of a segmented download can not be continued by a single stream
+    if os.path.exists(segments_path(target)):
+        os.remove(segments_path(target))
+        if os.path.exists(path_partial):
+            os.remove(path_partial)
+
+    for attempt in range(retry_max):
+        offset = os.path.getsize(path_partial) if os.path.exists(path_partial) else 0
+        if size is not None and offset > size:
+            offset = 0
+
+        headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+        total = size
+        interrupted = False
+        try:
+            with getter(url, stream=True, headers=headers, verify=verify, timeout=timeout) as r:
+                if r.status_code == 416 and size is not None and offset == size:
+                    # Partial file is already complete
+                    if checksum is not None:
+                        checksum.reset()
+                        checksum.update_file(path_partial)
+                else:
+                    r.raise_for_status()
+                    if offset and r.status_code != 206:
+                        logging.warning('Server does not support range requests, restart download ' + target)
+                        offset = 0
+                    total = _total_length(r, offset) or size
+                    if offset:
+                        logging.info('Resume download of {} at byte {}'.format(target, offset))
+                    follower = None
+                    if checksum is not None:
+                        checksum.reset()
+                        if offset:
+                            # The existing part is read back while the rest arrives
+                            follower = _HashFollower(checksum, path_partial, offset)
+                    streamed = False
+                    try:
+                        with open(path_partial, 'ab' if offset else 'wb') as f:
+                            written = offset
+                            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                                f.write(chunk)
+                                written += len(chunk)
+                                if follower is not None:
+                                    f.flush()
+                                    follower.advance(written)
+                                elif checksum is not None:
+                                    checksum.update(chunk)
+                        streamed = True
+                    finally:
+                        if follower is not None:
+                            follower.close(cancel=not streamed)
+        except requests.exceptions.HTTPError:
+            raise
+        except requests.exceptions.RequestException as e:
+            logging.warning('Download of {} interrupted: {}'.format(target, repr(e)))
+            interrupted = True
+
+        length = os.path.getsize(path_partial) if os.path.exists(path_partial) else 0
+        if total is not None and size is not None and total != size:
+            raise IncompleteDownload("Content-Length {} of {} does not match expected size {}".format(
+                total, url, size))
+        # Without a known length only a stream, which ended normally, is complete
+        if not interrupted and (total is None or length == total):
+            os.replace(path_partial, target)
+            return target
+
+        logging.warning('Download of {} incomplete, {} of {} bytes (attempt {} of {})'.format(
+            target, length, total, attempt + 1, retry_max))
+        if on_retry is not None:
+            on_retry()
+        time.sleep(min(sleep * 1.5 ** attempt, sleep_max))
+
+    raise IncompleteDownload("Download of {} failed after {} attempts".format(url, retry_max))
+
+
+def supports_ranges(url, session=None, verify=True, timeout=60):
+    """Check if the server advertises byte range support for url"""
+    getter = session.get if session is not None else requests.get
+    try:
+        with getter(url, stream=True, headers={"Range": "bytes=0-0"},
+                    verify=verify, timeout=timeout) as r:
+            return r.status_code == 206 or r.headers.get("Accept-Ranges") == "bytes"
+    except requests.exceptions.RequestException:
+        return False
+
+
+def segment_count(size, max_segments, min_segment_size=MIN_SEGMENT_SIZE):
+    """Number of segments adapted to the file size"""
+    return int(max(1, min(max_segments, size // max(1, min_segment_size))))
+
+
+def _write_at(fd, data, offset, lock):
+    if hasattr(os, "pwrite"):
+        os.pwrite(fd, data, offset)
+    else:
+        with lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+
+
+def segmented_download(url, target, size, segments=4, session=None, verify=True, timeout=60,
+                       retry_max=5, sleep=10., sleep_max=120., min_segment_size=MIN_SEGMENT_SIZE,
+                       checksum=None, on_retry=None):
+    """Download url with several parallel range requests into a preallocated
+    target.partial and rename it to target when complete
+
+    The number of segments is adapted to the size of the file. If the server
+    does not support range requests, :func:`download` is used. Finished
+    segments are recorded in target.partial.segments, a crashed download only
+    fetches the missing segments.
+
+    Parameters
+    ----------
+    url : string
+        location of the result
+    target : string
+        final file name
+    size : int
+        size in bytes
+    segments : int, optional
+        maximum number of parallel connections
+    min_segment_size : int, optional
+        minimum size of a segment in bytes
+    checksum : cds_downloader.integrity.Checksum, optional
+        checksum of the file, segments arrive out of order, hence the bytes
+        are hashed as soon as they are contiguous from the start of the file
+
+    See :func:`download` for the remaining parameters.
+
+    Returns
+    -------
+    target : string
+        final file name
+    """
+    kwargs = {"session": session, "verify": verify, "timeout": timeout,
+              "retry_max": retry_max, "sleep": sleep, "sleep_max": sleep_max, "on_retry": on_retry}
+
+    n_segments = segment_count(size, segments, min_segment_size)
+    if n_segments < 2 or not supports_ranges(url, session, verify, timeout):
+        return download(url, target, size=size, checksum=checksum, **kwargs)
+
+    getter = session.get if session is not None else requests.get
+    path_partial = partial_path(target)
+    path_segments = segments_path(target)
+
+    bounds = [size * i // n_segments for i in range(n_segments + 1)]
+    ranges = [(bounds[i], bounds[i + 1] - 1) for i in range(n_segments)]
+
+    # Finished segments of a previous attempt
+    done = set()
+    if os.path.exists(path_partial) and os.path.exists(path_segments):
+        try:
+            with open(path_segments, 'r') as f:
+                state = json.load(f)
+            if state.get("size") == size and state.get("ranges") == [list(r) for r in ranges]:
+                done = set(tuple(r) for r in state.get("done", []))
+        except (OSError, ValueError):
+            pass
+    else:
+        with open(path_partial, 'wb') as f:
+            f.truncate(size)
+
+    lock = threading.Lock()
+    # Bytes written of every segment, finished segments of a previous attempt are complete
+    progress = {r: (r[1] + 1 if r in done else r[0]) for r in ranges}
+
+    def _contiguous():
+        for start, end in ranges:
+            if progress[(start, end)] <= end:
+                return progress[(start, end)]
+        return size
+
+    def _save_state():
+        path_temp = path_segments + ".tmp"
+        with open(path_temp, 'w') as f:
+            json.dump({"size": size, "ranges": ranges, "done": sorted(done)}, f)
+        os.replace(path_temp, path_segments)
+
+    _save_state()
+
+    def _fetch(segment):
+        start, end = segment
+        position = start
+        for attempt in range(retry_max):
+            try:
+                headers = {"Range": "bytes={}-{}".format(position, end)}
+                with getter(url, stream=True, headers=headers, verify=verify, timeout=timeout) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise IncompleteDownload("Server ignored range request for " + url)
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        chunk = chunk[:end + 1 - position]
+                        _write_at(fd, chunk, position, lock)
+                        position += len(chunk)
+                        if follower is not None:
+                            with lock:
+                                progress[segment] = position
+                                available = _contiguous()
+                            follower.advance(available)
+            except requests.exceptions.HTTPError:
+                raise
+            except requests.exceptions.RequestException as e:
+                logging.warning('Segment {}-{} of {} interrupted: {}'.format(start, end, target, repr(e)))
+            if position > end:
+                with lock:
+                    done.add(segment)
+                    _save_state()
+                return segment
+            if on_retry is not None:
+                on_retry()
+            time.sleep(min(sleep * 1.5 ** attempt, sleep_max))
+        raise IncompleteDownload("Segment {}-{} of {} failed after {} attempts".format(
+            start, end, url, retry_max))
+
+    follower = None
+    if checksum is not None:
+        checksum.reset()
+        follower = _HashFollower(checksum, path_partial, _contiguous())
+    fd = os.open(path_partial, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+    complete = False
+    try:
+        missing = [r for r in ranges if r not in done]
+        logging.info('Segmented download of {} with {} of {} segments'.format(
+            target, len(missing), n_segments))
+        with ThreadPoolExecutor(max_workers=n_segments) as executor:
+            for _ in executor.map(_fetch, missing):
+                pass
+        complete = True
+    finally:
+        os.close(fd)
+        if follower is not None:
+            follower.close(cancel=not complete)
+
+    if os.path.getsize(path_partial) != size:
+        raise IncompleteDownload("Download of {} has {} instead of {} bytes".format(
+            url, os.path.getsize(path_partial), size))
+    os.replace(path_partial, target)
+    os.remove(path_segments)
+    return target
+
+
+def download_result(client, reply, target, segments=1, **kwargs):
+    """Download the result of a completed cds request resumable and atomic
+
+    The reply is saved next to the target until the download is complete,
+    hence a crashed run can continue the transfer with
+    :func:`resume_result` instead of requesting the data again.
+
+    Parameters
+    ----------
+    client : cdsapi.Client
+        cdsapi client of the request
+    reply : dict
+        reply of the completed request with location and content_length
+    target : string
+        final file name
+    segments : int, optional
+        maximum number of parallel connections, see :func:`segmented_download`
+    kwargs : optional
+        keyword arguments of :func:`download`
+
+    Returns
+    -------
+    target : string
+        final file name
+    """
+    result = Result(client, reply)
+    # The result has to survive failed downloads in order to resume them
+    result.cleanup = False
+    save_result(target, reply)
+
+    kwargs.setdefault("session", client.session)
+    kwargs.setdefault("verify", client.verify)
+    kwargs.setdefault("timeout", client.timeout)
+    kwargs.setdefault("sleep_max", client.sleep_max)
+    kwargs.setdefault("sleep", min(10., client.sleep_max))
+    if segments > 1:
+        segmented_download(result.location, target, result.content_length, segments=segments, **kwargs)
+    else:
+        download(result.location, target, size=result.content_length, **kwargs)
+
+    os.remove(result_path(target))
+    if client.delete:
+        result.delete()
+    return target
+
+
+def resume_result(client, target, **kwargs):
+    """Continue the download of a saved cds result
+
+    Returns
+    -------
+    target : string or None
+        final file name, None if there is no saved result or the result is
+        no longer available at the cds
+    """
+    reply = load_result(target)
+    if reply is None:
+        return None
+    try:
+        return download_result(client, reply, target, **kwargs)
+    except requests.exceptions.HTTPError as e:
+        logging.warning('Saved result of {} is not available anymore: {}'.format(target, repr(e)))
+        for path in (result_path(target), partial_path(target)):
+            if os.path.exists(path):
+                os.remove(path)
+        return None
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+"""
+watch.py:
+Resident daemon, which downloads newly published dates of a product
+"""
+
+__author__ = "Georg Seyerl"
+__license__ = "MIT"
+__maintainer__ = "Georg Seyerl"
+__status__ = "Development"
+
+import time
+import datetime
+import threading
+import logging
+
+from pathlib import Path
+
+from .manifest import Manifest
+
+
+DEFAULT_INTERVAL = 600
+
+# ERA5 publishes new dates about five days behind real time
+DEFAULT_LATENCY = datetime.timedelta(days=5)
+
+# Split keys, whose chunks are complete as soon as their date is published
+COMPLETE_KEYS = ["day", "time"]
+
+
+def _parse_date(value):
+    try:
+        return datetime.datetime.strptime(str(value)[:10], "%Y-%m-%d")
+    except ValueError:
+        return None
+
+
+def available_until(metadata, now=None, latency=DEFAULT_LATENCY):
+    """Last published date of a product according to its webapi metadata
+
+    The temporal form of the webapi bounds the years, months and days of a
+    product. The last valid date of the form is capped by the 'update_date'
+    of the product or, if the metadata does not contain one, by the present
+    minus the publication latency of the product. The result is the end of
+    the last complete day, hence every time of this day is available.
+
+    Parameters
+    ----------
+    metadata : dict
+        webapi metadata of the product
+    now : datetime.datetime, optional
+        present date, defaults to utc now
+    latency : datetime.timedelta, optional
+        publication latency of products without update_date
+
+    Returns
+    -------
+    date : datetime.datetime or None
+        end of the last available day, None if the form has no temporal
+        values
+    """
+    now = now or datetime.datetime.utcnow()
+    values = {form_ele.get("name"): form_ele.get("details", {}).get("values")
+              for form_ele in metadata.get("form", [])}
+    if not values.get("year"):
+        return None
+
+    update_date = _parse_date(metadata.get("update_date"))
+    if update_date is not None:
+        last_day = update_date.date()
+    else:
+        # The day of the present is not complete
+        last_day = (now - latency).date() - datetime.timedelta(days=1)
+
+    years = sorted(int(y) for y in values["year"])
+    if years[-1] < last_day.year:
+        months = sorted(int(m) for m in values.get("month") or range(1, 13))
+        end_of_form = datetime.date(years[-1], months[-1], 28) + datetime.timedelta(days=4)
+        last_day = min(last_day, end_of_form - datetime.timedelta(days=end_of_form.day))
+    return datetime.datetime.combine(last_day, datetime.time(23, 59, 59))
+
+
+class Watcher(object):
+    """The :class:`Watcher` class keeps a data collection up to date with
+    the published dates of its product.
+
+    Every `interval` seconds the product metadata is revalidated (a single
+    304 response, if nothing changed) and the last available date is derived
+    with `extent` (see :func:`available_until`). Only if it advanced, the
+    missing chunks up to that date are requested with
+    :meth:`cds_downloader.Downloader.update_data`, hence no request is sent
+    to the cds queue before a date is published. The downloader, its
+    session and the metadata cache stay warm between the cycles.
+
+    A new collection starts at the first available date seen by the watcher
+    unless `date_from` is given.
+
+    """
+
+    def __init__(self, downloader, storage_path, split_keys, interval=DEFAULT_INTERVAL,
+                 date_latency=None, date_from=None, extent=available_until, **kwargs):
+        """
+        Parameters
+        ----------
+        downloader : cds_downloader.Downloader
+            downloader of the product
+        storage_path : string
+            storage path of the data collection
+        split_keys : list of strings
+            split keys of the data collection, see
+            :meth:`cds_downloader.Downloader.update_data`
+        interval : int or float, optional
+            seconds between two checks of the metadata
+        date_latency : datetime.timedelta or str, optional
+            publication latency subtracted from the available date
+        date_from : datetime.datetime, optional
+            first date of a new collection
+        extent : callable, optional
+            last available date of the product from its metadata
+        kwargs : optional
+            execution parameters of update_data, e.g. max_workers
+        """
+        self.downloader = downloader
+        self.storage_path = str(storage_path)
+        self.split_keys = list(split_keys)
+        self.interval = interval
+        self.date_latency = date_latency
+        self.date_from = date_from
+        self.extent = extent
+        self.kwargs = kwargs
+        # Chunks of longer periods grow with every published date
+        self.keep_last = not any(k in self.split_keys for k in COMPLETE_KEYS)
+        self.last_available = None
+        self._stop = threading.Event()
+
+
+    def check(self):
+        """Revalidate the product metadata and return the last available date"""
+        downloader = self.downloader
+        downloader.cds_webapi = downloader.metadata_cache.get(downloader.cds_product, max_age=0)
+        until = self.extent(downloader.cds_webapi)
+        if until is not None and self.date_latency:
+            if isinstance(self.date_latency, str):
+                until = until - downloader._parse_time(self.date_latency)
+            else:
+                until = until - self.date_latency
+        return until
+
+
+    def cycle(self):
+        """Download the dates published since the last cycle
+
+        Returns
+        -------
+        futures : list of concurrent.futures.Future
+            finished download tasks, empty if no new date is available
+        """
+        until = self.check()
+        if until is None or (self.last_available is not None and until <= self.last_available):
+            logging.info('No new dates of {} available'.format(self.downloader.cds_product))
+            return []
+
+        logging.info('Dates of {} available until {}'.format(self.downloader.cds_product, until.date()))
+        Path(self.storage_path).mkdir(parents=True, exist_ok=True)
+        kwargs = dict(self.kwargs, date_until=until, keep_last=self.keep_last)
+        if Manifest(self.storage_path).split_values(self.downloader.cds_product, self.split_keys):
+            kwargs["start_from_files"] = True
+        else:
+            kwargs["date_from"] = self.date_from or until.replace(hour=0, minute=0, second=0)
+
+        futures = self.downloader.update_data(self.storage_path, self.split_keys, **kwargs)
+        # Failed chunks are requested again in the next cycle
+        if all(f.exception() is None for f in futures):
+            self.last_available = until
+        return futures
+
+
+    def run(self, max_cycles=None):
+        """Run cycles until :meth:`stop` is called
+
+        Parameters
+        ----------
+        max_cycles : int, optional
+            stop after this number of cycles
+        """
+        cycles = 0
+        while not self._stop.is_set():
+            start = time.time()
+            try:
+                self.cycle()
+            except Exception as e:
+                # A daemon survives unreachable endpoints and failed cycles
+                logging.exception('Watch cycle failed: ' + repr(e))
+            cycles += 1
+            if max_cycles is not None and cycles >= max_cycles:
+                break
+            self._stop.wait(max(self.interval - (time.time() - start), 0))
+        logging.info('Watcher of {} stopped after {} cycles'.format(self.downloader.cds_product, cycles))
+
+
+    def stop(self):
+        """Stop the watcher after the current cycle"""
+        self._stop.set()
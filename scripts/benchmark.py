@@ -0,0 +1,67 @@
+import json
+import click
+import logging
+import itertools
+
+from cds_downloader.result_cache import parse_size
+from cds_downloader.benchmark import run_benchmark, SCENARIOS
+
+COLUMNS = ["scenario", "engine", "worker_type", "max_workers", "requests", "failed",
+           "wall_time", "requests_per_hour", "bytes_per_second", "peak_rss", "peak_processes"]
+
+@click.command()
+@click.option('--scenario', '-s', 'scenarios', multiple=True, default=SCENARIOS,
+              type=click.Choice(SCENARIOS), help="""Scenarios to run, all by default""")
+@click.option('--chunks', '-c', 'chunks', type=int, default=16,
+              help="""Number of chunks (requests) of every scenario""")
+@click.option('--engine', '-e', 'engines', multiple=True, default=["pool", "async"],
+              type=click.Choice(["pool", "async"]), help="""Execution engines to compare""")
+@click.option('--worker-type', '-wt', 'worker_types', multiple=True, default=["thread"],
+              type=click.Choice(["thread", "process"]), help="""Worker types of the pool engine""")
+@click.option('--max-workers', '-mw', 'max_workers', multiple=True, type=int, default=[8],
+              help="""Maximum numbers of workers (or active requests) to compare""")
+@click.option('--download-workers', '-dw', 'download_workers', type=int, default=None,
+              help="""Number of parallel downloads of the async engine""")
+@click.option('--download-segments', '-ds', 'download_segments', type=int, default=1,
+              help="""Number of parallel connections of every download""")
+@click.option('--queue-delay', '-qd', 'queue_delay', type=float, default=0.,
+              help="""Seconds every request stays queued at the fake cds""")
+@click.option('--result-size', '-rs', 'result_size', type=str, default="1M",
+              help="""Minimum size of every result, e.g. '20M'""")
+@click.option('--bandwidth', '-bw', 'bandwidth', type=str, default=None,
+              help="""Bandwidth of every transfer per second, e.g. '10M', unlimited by default""")
+@click.option('--output', '-o', 'output', type=click.File('a'), default=None,
+              help="""Append the results as json lines to a file""")
+@click.option('--log-level', '-ll', 'log_level', default="WARNING",
+              type=click.Choice(["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"], case_sensitive=True),
+              help="""Logging Level""")
+def benchmark(scenarios, chunks, engines, worker_types, max_workers, download_workers,
+              download_segments, queue_delay, result_size, bandwidth, output, log_level):
+    """Offline throughput benchmark of the CDS Downloader against a local fake cds
+
+    The peak rss covers this process and its children on Linux. Without /proc
+    (e.g. on Windows) it is the peak of the python allocations of this process.
+    """
+    logging.basicConfig(format='%(asctime)s %(message)s', level=log_level)
+
+    click.echo("\t".join(COLUMNS))
+    for scenario, engine, worker_type, workers in itertools.product(
+            scenarios, engines, worker_types, max_workers):
+        if engine == "async" and worker_type != worker_types[0]:
+            # The async engine has no worker types
+            continue
+        results = run_benchmark(scenario, chunks=chunks, engine=engine, worker_type=worker_type,
+                                max_workers=workers, download_workers=download_workers,
+                                download_segments=download_segments, queue_delay=queue_delay,
+                                result_size=parse_size(result_size), bandwidth=parse_size(bandwidth))
+        click.echo("\t".join(
+            "{:.2f}".format(results[c]) if isinstance(results[c], float) else str(results[c])
+            for c in COLUMNS))
+        if output is not None:
+            output.write(json.dumps(results) + "\n")
+            output.flush()
+
+
+
+if __name__ == '__main__':
+    benchmark()
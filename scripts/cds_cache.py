@@ -0,0 +1,39 @@
+import click
+import logging
+
+from cds_downloader.result_cache import ResultCache, DEFAULT_CACHE_DIR, parse_size
+
+@click.group()
+@click.option('--cache-dir', '-cd', 'cache_dir', type=click.Path(), default=DEFAULT_CACHE_DIR,
+              help="""Directory of the result cache""")
+@click.option('--log-level', '-ll', 'log_level', default="WARNING",
+              type=click.Choice(["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"], case_sensitive=True),
+              help="""Logging Level""")
+@click.pass_context
+def cache(ctx, cache_dir, log_level):
+    """CDS Downloader result cache"""
+    logging.basicConfig(format='%(asctime)s %(message)s', level=log_level)
+    ctx.obj = ResultCache(cache_dir)
+
+@cache.command()
+@click.pass_obj
+def stats(result_cache):
+    """Show number of entries, size and hits of the cache"""
+    dct_stats = result_cache.stats()
+    click.echo("entries: {entries}\nsize: {size} bytes\nhits: {hits}".format(**dct_stats))
+    for product, count in sorted(dct_stats["products"].items()):
+        click.echo("  {}: {}".format(product, count))
+
+@cache.command()
+@click.option('--max-size', '-ms', 'max_size', type=str, required=True,
+              help="""Size limit of the cache, e.g. '500G', 0 empties the cache""")
+@click.pass_obj
+def prune(result_cache, max_size):
+    """Evict least recently used results beyond a size limit"""
+    evicted = result_cache.prune(parse_size(max_size))
+    click.echo("evicted: {}".format(len(evicted)))
+
+
+
+if __name__ == '__main__':
+    cache()
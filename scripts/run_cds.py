@@ -1,7 +1,18 @@
+import os
 import click
+import signal
 import logging
 
 from cds_downloader import Downloader
+from cds_downloader.metadata import MetadataCache
+from cds_downloader.session import create_session, DEFAULT_POOL_SIZE
+from cds_downloader.result_cache import ResultCache, parse_size
+from cds_downloader.metrics import Metrics, JsonLinesSink, PrometheusTextfileSink, PrometheusHTTPSink
+from cds_downloader.batch import Batch, BATCH_MODES
+from cds_downloader.watch import Watcher, DEFAULT_INTERVAL
+from cds_downloader.concurrency import AdaptiveLimit, DEFAULT_MAX_LIMIT, DEFAULT_TARGET_WAIT
+from cds_downloader.priority import PRIORITIES
+from cds_downloader.lease import DEFAULT_TTL
 
 def default_none(ctx, param, value):
     if len(value) == 0:
@@ -10,11 +21,19 @@ def default_none(ctx, param, value):
         return value
 
 @click.command()
-@click.option('--config', '-c', required=True, type=click.Path(exists=True), help='JSON configuration file')
-@click.option('--path', '-p', 'storage_path', required=True, type=click.Path(), help="""Target storage path""")
-@click.option('--mode', '-m', default='download', type=click.Choice(['download', 'update', 'daily'], case_sensitive=True),
+@click.option('--config', '-c', 'configs', required=True, multiple=True, type=click.Path(exists=True),
+              help="""JSON configuration file, several files or directories of them run as one batch
+              with a global scheduler""")
+@click.option('--path', '-p', 'storage_path', required=True, type=click.Path(), help="""Target storage path,
+              in batch mode the root of a storage path per configuration""")
+@click.option('--mode', '-m', default='download', type=click.Choice(['download', 'update', 'daily', 'rebuild-manifest', 'verify',
+                                                                                 'aggregate', 'watch'], case_sensitive=True),
               help="""The operational mode 'update' is experimental. It is recommended to provide
-              the exact same set of split-keys from the already existing data collection.""")
+              the exact same set of split-keys from the already existing data collection.
+              The mode 'rebuild-manifest' indexes an existing data collection with the given split-keys.
+              The mode 'verify' checks structure and checksums of an existing data collection.
+              The mode 'aggregate' merges the chunks of an existing data collection into period files.
+              The mode 'watch' stays resident and downloads newly published dates of the product.""")
 @click.option('--split-keys', "-sk", multiple=True, callback=default_none,
               help="""By setting multiple values of split_key from cds_filter keys,
               one can manually control the splitting (e.g. -sp year -sp month -sp day)""")
@@ -23,12 +42,90 @@ def default_none(ctx, param, value):
 @click.option('--date-latency', '-dl', 'date_latency', type=str, default=False,
               help="""Only available in update mode. Specify start date latency from now backwards, e.g.
               '5D' or '2D 8h 5m 2s' (experimental)""")
+@click.option('--days', '-d', 'days', type=int, default=1,
+              help="""Only available in daily mode. Number of days up to the latest day, missing files of
+              the days before are combined with the latest day into as few requests as possible""")
+@click.option('--resume', '-r', 'resume', is_flag=True,
+              help="""Continue the last incomplete run of the storage path from its journal instead of
+              planning the chunks of the mode again, submitted requests are reattached""")
+@click.option('--retries', '-rt', 'retries', type=int, default=3,
+              help="""Number of retries of a failed chunk""")
+@click.option('--retry-backoff', '-rb', 'retry_backoff', type=float, default=60.,
+              help="""Base delay of the retries in seconds, it grows exponentially with random jitter""")
+@click.option('--journal/--no-journal', 'journal', default=True,
+              help="""Record planned chunks, request ids and state transitions of every run in the storage path""")
+@click.option('--leases/--no-leases', 'leases', default=False,
+              help="""Claim every chunk in a lease table of the storage path, hence several hosts share
+              the chunks of one storage path (e.g. on NFS) without duplicate requests""")
+@click.option('--lease-ttl', '-lt', 'lease_ttl', type=float, default=DEFAULT_TTL,
+              help="""Only available with --leases. Seconds until the lease of a dead host expires""")
+@click.option('--priority', '-pr', 'priority', default='plan', type=click.Choice(PRIORITIES, case_sensitive=True),
+              help="""Order in which the chunks are requested, e.g. 'newest' fetches recent dates before
+              the backfill of older ones""")
+@click.option('--urgency', '-u', 'urgency', type=int, default=0,
+              help="""Only available in batch mode. Configurations with a higher urgency take free workers
+              before the others, set 'urgency' in a configuration file to override it""")
+@click.option('--watch-interval', '-wi', 'watch_interval', type=float, default=DEFAULT_INTERVAL,
+              help="""Only available in watch mode. Seconds between two checks for newly published dates""")
+@click.option('--max-workers', '-mw', 'max_workers', type=int, default=None,
+              help="""Maximum number of concurrent cds requests""")
+@click.option('--adaptive', '-ad', 'adaptive', is_flag=True,
+              help="""Adapt the number of concurrent cds requests to queue waits, rejections and throughput,
+              --max-workers is the upper bound""")
+@click.option('--min-workers', '-miw', 'min_workers', type=int, default=1,
+              help="""Only available with --adaptive. Lower bound of concurrent cds requests""")
+@click.option('--target-queue-wait', '-tqw', 'target_queue_wait', type=float, default=DEFAULT_TARGET_WAIT,
+              help="""Only available with --adaptive. Acceptable wait of a request in the cds queue in seconds""")
+@click.option('--coalesce', '-co', 'coalesce', is_flag=True,
+              help="""Only available in batch mode. Request chunks, which several configurations share, once
+              with union requests and split them into the files of each configuration""")
+@click.option('--max-per-product', '-mpp', 'max_per_product', type=int, default=None,
+              help="""Only available in batch mode. Maximum number of concurrent cds requests of a product""")
+@click.option('--worker-type', '-wt', 'worker_type', default='thread',
+              type=click.Choice(['thread', 'process'], case_sensitive=True),
+              help="""Run cds requests in thread or process workers""")
+@click.option('--engine', '-e', default='pool', type=click.Choice(['pool', 'async'], case_sensitive=True),
+              help="""Execution mode, 'async' submits all requests up front and downloads
+              finished results with a separate pool of download workers""")
+@click.option('--download-workers', '-dw', 'download_workers', type=int, default=None,
+              help="""Number of concurrent downloads in async mode""")
+@click.option('--download-segments', '-ds', 'download_segments', type=int, default=1,
+              help="""Maximum number of parallel connections for the transfer of a single large result""")
+@click.option('--metadata-ttl', '-mt', 'metadata_ttl', type=int, default=3600,
+              help="""Time to live of cached cds product metadata in seconds""")
+@click.option('--pool-size', '-ps', 'pool_size', type=int, default=DEFAULT_POOL_SIZE,
+              help="""Maximum number of keep-alive connections of the shared http session""")
+@click.option('--reuse-requests/--no-reuse-requests', 'reuse_requests', default=True,
+              help="""Attach to matching queued, running or completed requests of the account
+              instead of submitting them again""")
+@click.option('--delete-failed', '-df', 'delete_failed', is_flag=True,
+              help="""Delete failed requests of the product from the cds queue""")
+@click.option('--result-cache', '-rc', 'result_cache', type=click.Path(), default=None,
+              help="""Directory of a content-addressed result cache shared by storage paths and configs""")
+@click.option('--cache-max-size', '-cms', 'cache_max_size', type=str, default=None,
+              help="""Maximum size of the result cache, e.g. '500G', least recently used results are evicted""")
+@click.option('--verify/--no-verify', 'verify', default=True,
+              help="""Verify every download against the number of fields of its request""")
+@click.option('--aggregate', '-ag', 'aggregate', default=None,
+              type=click.Choice(['month', 'year'], case_sensitive=True),
+              help="""Merge finished chunks into monthly or yearly files""")
+@click.option('--metrics-file', '-mf', 'metrics_file', type=click.Path(), default=None,
+              help="""Append per-chunk timing events and run aggregates as json lines, '-' for stdout""")
+@click.option('--prometheus-textfile', '-pt', 'prometheus_textfile', type=click.Path(), default=None,
+              help="""Write prometheus metrics to a .prom file for the node exporter textfile collector""")
+@click.option('--prometheus-port', '-pp', 'prometheus_port', type=int, default=None,
+              help="""Serve prometheus metrics over http at this port""")
 @click.option('--log-path', '-lp', 'log_path', type=click.Path(), help="""Path to logging file""")
 @click.option('--log-level', '-ll', 'log_level', default="WARNING",
               type=click.Choice(["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"], case_sensitive=True),
               help="""Logging Level""")
 
-def start(config, storage_path, mode, split_keys, start_from_files, date_latency, log_path, log_level):
+def start(configs, storage_path, mode, split_keys, start_from_files, date_latency, days, resume, retries, retry_backoff,
+          journal, leases, lease_ttl, priority, urgency, watch_interval,
+          max_workers, adaptive, min_workers, target_queue_wait, coalesce, max_per_product, worker_type, engine, download_workers, download_segments,
+          metadata_ttl, pool_size,
+          reuse_requests, delete_failed, result_cache, cache_max_size, verify,
+          aggregate, metrics_file, prometheus_textfile, prometheus_port, log_path, log_level):
     """CDS Downloader command line interface"""
 
     if log_path != None:
@@ -40,16 +137,101 @@ def start(config, storage_path, mode, split_keys, start_from_files, date_latency
     if isinstance(split_keys, tuple):
         split_keys = list(split_keys)
 
+    metrics = Metrics()
+    if metrics_file is not None:
+        metrics.add_sink(JsonLinesSink(metrics_file))
+    if prometheus_textfile is not None:
+        metrics.add_sink(PrometheusTextfileSink(prometheus_textfile))
+    if prometheus_port is not None:
+        metrics.add_sink(PrometheusHTTPSink(prometheus_port))
+
+    concurrency = None
+    if adaptive:
+        concurrency = AdaptiveLimit(max_limit=max_workers or DEFAULT_MAX_LIMIT, min_limit=min_workers,
+                                    target_wait=target_queue_wait)
+
     # Create Downloader object
-    cds_downloader = Downloader.from_json(config)
+    session = create_session(pool_size=pool_size)
+    metadata_cache = MetadataCache(ttl=metadata_ttl, session=session)
+    if result_cache is not None:
+        result_cache = ResultCache(result_cache, max_size=parse_size(cache_max_size))
+    downloader_kwargs = {"download_segments": download_segments, "reuse_requests": reuse_requests,
+                         "delete_failed": delete_failed, "result_cache": result_cache, "verify": verify,
+                         "aggregate": aggregate, "metrics": metrics, "journal": journal, "retries": retries,
+                         "retry_backoff": retry_backoff, "leases": leases, "lease_ttl": lease_ttl}
+
+    if resume and mode not in BATCH_MODES:
+        raise click.UsageError("A run can be resumed in the modes {}".format(BATCH_MODES))
+
+    if len(configs) > 1 or os.path.isdir(configs[0]):
+        if mode not in BATCH_MODES:
+            raise click.UsageError("Batch mode is only available for the modes {}".format(BATCH_MODES))
+        if engine != "pool":
+            raise click.UsageError("Batch mode runs all configurations with one worker pool")
+        batch = Batch.from_paths(configs, storage_path, mode=mode, split_keys=split_keys, session=session,
+                                 metadata_cache=metadata_cache, downloader_kwargs=downloader_kwargs,
+                                 job_kwargs={"date_latency": date_latency, "start_from_files": start_from_files,
+                                             "priority": priority, "urgency": urgency, "days": days},
+                                 max_workers=max_workers, worker_type=worker_type,
+                                 max_per_product=max_per_product, metrics=metrics, concurrency=concurrency)
+        try:
+            summary = batch.run(resume=resume, coalesce=coalesce)
+        finally:
+            metrics.close()
+        if summary["coalesced"] is not None:
+            click.echo("coalesced: {files} files in {requests} requests, {failed} failed".format(
+                **summary["coalesced"]))
+        for name, job in sorted(summary["jobs"].items()):
+            click.echo("{}: {} done, {} failed ({})".format(name, job["done"], job["failed"], job["storage_path"]))
+        click.echo("total: {done} done, {failed} failed, {bytes} bytes in {wall_seconds:.1f} seconds".format(
+            **summary))
+        if summary["failed"]:
+            raise SystemExit(1)
+        return
+
+    cds_downloader = Downloader.from_json(configs[0], session=session, metadata_cache=metadata_cache,
+                                          concurrency=concurrency, **downloader_kwargs)
+    kwargs_exec = {"max_workers": max_workers, "worker_type": worker_type,
+                   "engine": engine, "download_workers": download_workers}
 
-    if mode == "download":
-        cds_downloader.get_data(storage_path, split_keys)
-    elif mode == "update":
-        cds_downloader.update_data(storage_path, split_keys, start_from_files=start_from_files, date_latency=date_latency)
-    elif mode == "daily":
-        cds_downloader.get_latest_daily_data(storage_path, date_latency=date_latency)
+    futures = []
+    try:
+        if resume:
+            futures = cds_downloader.resume(storage_path, **kwargs_exec)
+        elif mode == "download":
+            futures = cds_downloader.get_data(storage_path, split_keys, priority=priority, **kwargs_exec)
+        elif mode == "update":
+            futures = cds_downloader.update_data(storage_path, split_keys, start_from_files=start_from_files,
+                                                 date_latency=date_latency, priority=priority, **kwargs_exec)
+        elif mode == "daily":
+            futures = cds_downloader.get_latest_daily_data(storage_path, date_latency=date_latency, priority=priority,
+                                                           days=days, **kwargs_exec)
+        elif mode == "rebuild-manifest":
+            cds_downloader.rebuild_manifest(storage_path, split_keys or [])
+        elif mode == "watch":
+            watcher = Watcher(cds_downloader, storage_path, split_keys or ["year", "month", "day"],
+                              interval=watch_interval, date_latency=date_latency or None, priority=priority,
+                              **kwargs_exec)
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, lambda *args: watcher.stop())
+            watcher.run()
+        elif mode == "aggregate":
+            cds_downloader.aggregate_data(storage_path, split_keys or [], period=aggregate or "month")
+        elif mode == "verify":
+            problems = cds_downloader.verify_data(storage_path, split_keys)
+            for file_name, file_problems in sorted(problems.items()):
+                click.echo("{}: {}".format(file_name, ", ".join(file_problems)))
+            if problems:
+                raise SystemExit(1)
+    finally:
+        metrics.close()
 
+    # Failed chunks are continued with --resume
+    failed = [f.task[2] for f in futures if f.exception() is not None]
+    for file_name in failed:
+        click.echo("failed: {}".format(file_name))
+    if failed:
+        raise SystemExit(1)
 
 
 if __name__ == '__main__':
@@ -11,5 +11,6 @@ setup(name='cds_downloader',
       author_email='g.seyerl@geoase.eu',
       packages=setuptools.find_packages(),
       keywords=['climate', ],
+      python_requires='>=3.7',
       # tests_require=['pytest'],
      )